@@ -13,13 +13,37 @@ Made available under GNU GENERAL PUBLIC LICENSE
 """
 #
 #
-import smbus
+try:
+   import smbus
+except ImportError: # only needed for the real bus, a fake bus can be passed in off the Pi
+   smbus = None
 from time import *
 
+# An SMBus I2C block write carries a command byte followed by up to 32 data bytes.
+# The PCF8574 expander has no registers, it simply latches every byte it receives
+# onto its outputs in order, so the command byte is just the first byte of the stream.
+I2C_BLOCK_SIZE = 32
+
 class i2c_device:
-   def __init__(self, addr, port=1):
+   # bus is anything with the smbus write_byte / write_i2c_block_data methods,
+   # by default the real bus on the given port
+   def __init__(self, addr, port=1, bus=None):
       self.addr = addr
-      self.bus = smbus.SMBus(port)
+      if bus is None:
+         bus = smbus.SMBus(port)
+      self.bus = bus
+
+   # Write a stream of bytes to the expander using as few block writes as possible
+   def write_stream(self, data):
+      try:
+         for i in range(0, len(data), I2C_BLOCK_SIZE + 1):
+            chunk = data[i:i + I2C_BLOCK_SIZE + 1]
+            if len(chunk) == 1:
+               self.bus.write_byte(self.addr, chunk[0])
+            else:
+               self.bus.write_i2c_block_data(self.addr, chunk[0], list(chunk[1:]))
+      except IOError as e:
+         print(f"I2C communication error: {e}")
 
    # Write a single command
    def write_cmd(self, cmd):
@@ -102,64 +126,90 @@ En = 0b00000100 # Enable bit
 Rw = 0b00000010 # Read/Write bit
 Rs = 0b00000001 # Register select bit
 
+# DDRAM address of the first character of each line of a 20x4 display
+LINE_ADDRESSES = {1: 0x00, 2: 0x40, 3: 0x14, 4: 0x54}
+
+# Execution times from the HD44780 datasheet (fosc = 270 kHz) with some margin.
+# Every other instruction and data write takes 37 us, which is less than the time it
+# takes to clock the next byte out to the expander, so those need no explicit delay.
+CLEAR_DELAY = 0.002  # clear display, 1.52 ms
+HOME_DELAY = 0.002   # return home, 1.52 ms
+INIT_DELAY = 0.005   # function set during the 4 bit init sequence, > 4.1 ms
+
+# how long to wait after sending an instruction before the next one is accepted
+def command_delay(cmd, mode=0):
+   if mode & Rs:
+      return 0
+   if cmd == LCD_CLEARDISPLAY:
+      return CLEAR_DELAY
+   if cmd & 0xFE == LCD_RETURNHOME:
+      return HOME_DELAY
+   return 0
+
+# Encode one byte as the expander byte stream that clocks it into the display:
+# for each nibble, set the data lines, raise EN, then drop EN to latch it
+def encode_byte(value, mode=0, backlight=LCD_BACKLIGHT):
+   stream = []
+   for nibble in (value & 0xF0, (value << 4) & 0xF0):
+      data = mode | nibble
+      stream.append(data | backlight)
+      stream.append(data | En | backlight)
+      stream.append((data & ~En) | backlight)
+   return stream
+
+def encode_string(string, backlight=LCD_BACKLIGHT):
+   stream = []
+   for char in string:
+      stream += encode_byte(ord(char), Rs, backlight)
+   return stream
+
 class lcd:
    #initializes objects and lcd
-   def __init__(self):
-      self.lcd_device = i2c_device(ADDRESS)
+   # bus can be swapped for a fake SMBus and sleep for a simulated clock to run the driver off the Pi
+   def __init__(self, address=ADDRESS, port=1, bus=None, sleep=sleep):
+      self.lcd_device = i2c_device(address, port, bus)
+      self.sleep = sleep
 
       self.lcd_write(0x03)
+      self.sleep(INIT_DELAY)
       self.lcd_write(0x03)
+      self.sleep(INIT_DELAY)
       self.lcd_write(0x03)
+      self.sleep(INIT_DELAY)
       self.lcd_write(0x02)
 
       self.lcd_write(LCD_FUNCTIONSET | LCD_2LINE | LCD_5x8DOTS | LCD_4BITMODE)
       self.lcd_write(LCD_DISPLAYCONTROL | LCD_DISPLAYON | LCD_CURSOROFF | LCD_BLINKOFF)  # Disable cursor and blinking
       self.lcd_write(LCD_CLEARDISPLAY)
       self.lcd_write(LCD_ENTRYMODESET | LCD_ENTRYLEFT)
-      sleep(0.2)
-
+      self.sleep(0.2)
 
-   # clocks EN to latch command
-   def lcd_strobe(self, data):
-      self.lcd_device.write_cmd(data | En | LCD_BACKLIGHT)
-      sleep(.0005)
-      self.lcd_device.write_cmd(((data & ~En) | LCD_BACKLIGHT))
-      sleep(.0001)
 
-   def lcd_write_four_bits(self, data):
-      self.lcd_device.write_cmd(data | LCD_BACKLIGHT)
-      self.lcd_strobe(data)
+   # send an encoded byte stream, then wait for the last instruction to finish
+   def lcd_write_stream(self, stream, delay=0):
+      self.lcd_device.write_stream(stream)
+      if delay:
+         self.sleep(delay)
 
    # write a command to lcd
    def lcd_write(self, cmd, mode=0):
-      self.lcd_write_four_bits(mode | (cmd & 0xF0))
-      self.lcd_write_four_bits(mode | ((cmd << 4) & 0xF0))
+      self.lcd_write_stream(encode_byte(cmd, mode), command_delay(cmd, mode))
 
    # write a character to lcd (or character rom) 0x09: backlight | RS=DR<
    # works!
    def lcd_write_char(self, charvalue, mode=1):
-      self.lcd_write_four_bits(mode | (charvalue & 0xF0))
-      self.lcd_write_four_bits(mode | ((charvalue << 4) & 0xF0))
+      self.lcd_write_stream(encode_byte(charvalue, mode))
   
 
    # put string function
+   # the address and all characters go out as one stream
    def lcd_display_string(self, string, line):
-      if line == 1:
-         self.lcd_write(0x80)
-      if line == 2:
-         self.lcd_write(0xC0)
-      if line == 3:
-         self.lcd_write(0x94)
-      if line == 4:
-         self.lcd_write(0xD4)
-
-      for char in string:
-         self.lcd_write(ord(char), Rs)
+      self.lcd_display_string_pos(string, line, 0)
 
    # clear lcd and set to home
+   # (clear display also returns the cursor home, no separate return home needed)
    def lcd_clear(self):
       self.lcd_write(LCD_CLEARDISPLAY)
-      self.lcd_write(LCD_RETURNHOME)
 
    # define backlight on/off (lcd.backlight(1); off= lcd.backlight(0)
    def backlight(self, state): # for state, 1 = on, 0 = off
@@ -170,23 +220,14 @@ class lcd:
 
    # add custom characters (0 - 7)
    def lcd_load_custom_chars(self, fontdata):
-      self.lcd_write(0x40);
+      stream = encode_byte(LCD_SETCGRAMADDR)
       for char in fontdata:
          for line in char:
-            self.lcd_write_char(line)         
+            stream += encode_byte(line, Rs)
+      self.lcd_write_stream(stream)
          
    # define precise positioning (addition from the forum)
    def lcd_display_string_pos(self, string, line, pos):
-    if line == 1:
-      pos_new = pos
-    elif line == 2:
-      pos_new = 0x40 + pos
-    elif line == 3:
-      pos_new = 0x14 + pos
-    elif line == 4:
-      pos_new = 0x54 + pos
-
-    self.lcd_write(0x80 + pos_new)
-
-    for char in string:
-      self.lcd_write(ord(char), Rs)
+      stream = encode_byte(LCD_SETDDRAMADDR | (LINE_ADDRESSES[line] + pos))
+      stream += encode_string(string)
+      self.lcd_write_stream(stream)
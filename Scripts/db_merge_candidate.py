@@ -1,83 +1,219 @@
 import sqlite3
 import os
+import sys
+import csv
 import argparse
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db_interface
 
-def merge_databases(db_file, output_db_file):
-    """
-    Migrates user data from a source SQLite database to a target SQLite database,
-    handling potential differences in column names and types.
+# Merge the users of one or more databases into an output database
+#
+# Source rows are streamed CHUNK_SIZE at a time with fetchmany(), so memory use
+# does not depend on the size of the sources. For every chunk the output rows
+# with the same ramcard_uids are looked up, each source row is resolved against
+# them with the conflict policy, and the winners are written with one batched
+# UPSERT in one transaction. Sources can use any of the older schemas: columns
+# are read by name. A csu_id or fullname the source does not have (a missing
+# column or an empty value) never clears the one already in the output; for a
+# new uid it is left empty. Every written row is logged as an ADD or UPDATE, so
+# the merge reaches the other stations with the next sync (see db_sync.py).
+#
+# Conflict policies, for a uid that is already in the output:
+#  newest   the row with the latest expiration date wins (the default)
+#  admin    an admin row wins over a user row, then the latest expiration date wins
+#  source   the source row always wins
+#  keep     the output row always wins
+#
+# Example: python3 db_merge_candidate.py old_pi.db new_pi.db merged.db --diff merge_diff.csv
 
-    Args:
-        source_db_file (str): Path to the source .db file.
-        target_db_file (str): Path to the target .db file.
-    """
+CHUNK_SIZE = 1000
+USER_COLUMNS = ['ramcard_uid', 'csu_id', 'fullname', 'is_admin', 'expiration_date']
 
-    # Connect to source database
+def _newest(new, old):
+    return new[4] > old[4]
+
+def _admin(new, old):
+    if new[3] != old[3]:
+        return new[3] > old[3]
+    return new[4] > old[4]
+
+POLICIES = {
+    'newest': _newest,
+    'admin': _admin,
+    'source': lambda new, old: True,
+    'keep': lambda new, old: False,
+}
+
+# rows of a source users table as USER_COLUMNS tuples, chunk_size rows at a time
+def read_source_chunks(db_file, chunk_size=CHUNK_SIZE):
+    conn = sqlite3.connect("file:%s?mode=ro" % db_file, uri=True)
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-    except sqlite3.Error as e:
-        print(f"Error connecting to source database: {e}")
-        return
-    
-    # Connect to the output database
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+        if 'ramcard_uid' not in columns:
+            raise Exception("%s has no users table with a ramcard_uid column" % db_file)
+        select = ", ".join(column if column in columns else "NULL" for column in USER_COLUMNS)
+        cursor = conn.execute("SELECT %s FROM users ORDER BY rowid" % select)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+# convert a source row to the output column types, None if it cannot be used
+def normalize_row(row):
+    uid, csu_id, fullname, is_admin, expiration_date = row
     try:
-        output_conn = sqlite3.connect(output_db_file)
-        output_cursor = output_conn.cursor()
-
-        tables = {
-            'users': 'CREATE TABLE IF NOT EXISTS users(ramcard_uid TEXT, csu_id TEXT, fullname TEXT, is_admin INTEGER, expiration_date INTEGER)',
-            'users_log': 'CREATE TABLE IF NOT EXISTS users_log(timestamp TEXT, action TEXT, data TEXT)',
-            'laser_log': 'CREATE TABLE IF NOT EXISTS laser_log(timestamp TEXT, action TEXT, data TEXT)'
-        }
-
-        for table, creation_query in tables.items():
-          output_cursor.execute(creation_query)
-          print(f"Table {table} created.")
-    except sqlite3.Error as e:
-        print(f"Error connecting to the output database: {e}")
-        conn.close()  # Close first connection on error
-        return
-
-    # Fetch data from first database
-    cursor.execute("SELECT * FROM users")
-    rows = cursor.fetchall()
-
-    # Insert into target database, handling data conversions
-    for row in rows:
-        ramcard_uid = int(row[0])  # Convert to TEXT if needed
-        fullname = str(row[1])
-        is_admin = int(row[2])  # Convert boolean to INTEGER (0 or 1)
-        expiration_date = int(row[3])  # Convert to INTEGER if needed
-        # Dont add duplicate
-
-        output_cursor.execute(
-            """
-            INSERT INTO users (ramcard_uid, csu_id, fullname, is_admin, expiration_date)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            (ramcard_uid, "", fullname, is_admin, expiration_date)  # Blank csu_id
-        )
-
-    # Save changes
-    conn.close()
-    output_conn.commit()
-    output_conn.close()
-    print("Data migration successful!")
+        uid = int(uid)
+    except (TypeError, ValueError):
+        return None
+    try:
+        csu_id = int(csu_id) if csu_id not in (None, '') else None
+    except ValueError:
+        csu_id = None
+    try:
+        expiration_date = int(expiration_date or 0)
+    except ValueError:
+        expiration_date = 0
+    return (uid, csu_id, str(fullname or ''), 1 if is_admin in (1, '1', True) else 0, expiration_date)
 
+class merge_summary:
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Merge data from two databases into a new database.')
-    parser.add_argument('db_file', help='Source .db filename')
-    parser.add_argument('output_db_file', help='Output .db filename')
+    def __init__(self):
+        self.read = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.kept = 0
+        self.rejected = 0
 
-    args = parser.parse_args()
+    def __str__(self):
+        return ("%d rows read: %d inserted, %d updated, %d unchanged, %d kept the output row, %d rejected" %
+                (self.read, self.inserted, self.updated, self.unchanged, self.kept, self.rejected))
+
+# Merge the users table of every file in db_files into output_db_file
+# on_change(kind, old, new) is called for every inserted ('insert') or updated
+# ('update') row, with old None for inserts, e.g. to write a diff; the rows of a
+# chunk are passed once the chunk is committed
+# Returns a merge_summary per source file
+def merge_databases(db_files, output_db_file, policy='newest', chunk_size=CHUNK_SIZE, on_change=None):
+    if isinstance(db_files, str):
+        db_files = [db_files]
+    prefer = POLICIES[policy]
+    summaries = {}
+
+    # opening through db_interface creates or upgrades the output schema
+    with db_interface.db_interface(output_db_file) as output:
+        cursor = output._db.cursor()
+        for db_file in db_files:
+            summary = summaries[db_file] = merge_summary()
+            for rows in read_source_chunks(db_file, chunk_size):
+                summary.read += len(rows)
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    winners, new_uids, changes = _resolve_chunk(cursor, rows, prefer, summary)
+                    cursor.executemany("""
+                        INSERT INTO users(ramcard_uid, csu_id, fullname, is_admin, expiration_date) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(ramcard_uid) DO UPDATE SET
+                          csu_id = COALESCE(excluded.csu_id, users.csu_id),
+                          fullname = COALESCE(NULLIF(excluded.fullname, ''), users.fullname),
+                          is_admin = excluded.is_admin,
+                          expiration_date = excluded.expiration_date""", winners.values())
+                    # a merged card is active, as after _add_entry
+                    uids = list(winners)
+                    for start in range(0, len(uids), 500):
+                        part = uids[start:start + 500]
+                        cursor.execute("DELETE FROM users_archive WHERE ramcard_uid IN (%s)" % ", ".join("?" * len(part)), part)
+                    for uid, row in winners.items():
+                        action = output.USER_ADD_ACTION if uid in new_uids else output.USER_UPDATE_ACTION
+                        output.log_change(cursor, action, uid, row)
+                    output._db.commit()
+                except:
+                    output._db.rollback()
+                    raise
+                if on_change:
+                    for change in changes:
+                        on_change(*change)
+        cursor.close()
+        output._invalidate_cache()
+    return summaries
 
-    db_file = args.db_file
-    output_db_file = args.output_db_file
+# decide which rows of a chunk are written
+# returns ({uid: row}, uids not in the output yet, [(kind, old, new)] in order)
+def _resolve_chunk(cursor, rows, prefer, summary):
+    rows = [normalize_row(row) for row in rows]
+    summary.rejected += rows.count(None)
+    rows = [row for row in rows if row is not None]
+
+    uids = list({row[0] for row in rows})
+    current = {}
+    # look the uids up in slices, SQLite limits the number of parameters per statement
+    for start in range(0, len(uids), 500):
+        part = uids[start:start + 500]
+        res = cursor.execute("SELECT %s FROM users WHERE ramcard_uid IN (%s)" % (", ".join(USER_COLUMNS), ", ".join("?" * len(part))), part)
+        for row in res:
+            current[row[0]] = row
+
+    winners = {}
+    new_uids = set()
+    changes = []
+    for row in rows:
+        old = current.get(row[0])
+        if old is not None:
+            # keep what the output knows and the source does not
+            row = (row[0], old[1] if row[1] is None else row[1], row[2] or old[2], row[3], row[4])
+        if old is None:
+            kind = 'insert'
+        elif old == row:
+            summary.unchanged += 1
+            continue
+        elif prefer(row, old):
+            kind = 'update'
+        else:
+            summary.kept += 1
+            continue
+        if kind == 'insert':
+            summary.inserted += 1
+            new_uids.add(row[0])
+        else:
+            summary.updated += 1
+        changes.append((kind, old, row))
+        current[row[0]] = row
+        winners[row[0]] = row
+    return winners, new_uids, changes
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the users of one or more databases into an output database.')
+    parser.add_argument('db_files', nargs='+', help='Source .db filenames')
+    parser.add_argument('output_db_file', help='Output .db filename, created if it does not exist')
+    parser.add_argument('--policy', choices=sorted(POLICIES), default='newest', help='which row wins when a uid is in both')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='rows read and written per transaction')
+    parser.add_argument('--diff', help='write every inserted and updated row to this CSV file')
+    args = parser.parse_args()
 
     # Make sure input files exist
-    if not os.path.isfile(db_file):
-        print(f"First database file not found: {db_file}")
-    else:
-        merge_databases(db_file, output_db_file)
\ No newline at end of file
+    for db_file in args.db_files:
+        if not os.path.isfile(db_file):
+            print(f"Database file not found: {db_file}")
+            return 1
+
+    diff_file = open(args.diff, 'w', newline='') if args.diff else None
+    try:
+        on_change = None
+        if diff_file:
+            writer = csv.writer(diff_file)
+            writer.writerow(['change'] + ['old_' + c for c in USER_COLUMNS] + ['new_' + c for c in USER_COLUMNS])
+            def on_change(kind, old, new):
+                writer.writerow([kind] + list(old or [''] * len(USER_COLUMNS)) + list(new))
+        summaries = merge_databases(args.db_files, args.output_db_file, args.policy, args.chunk_size, on_change)
+    finally:
+        if diff_file:
+            diff_file.close()
+
+    for db_file, summary in summaries.items():
+        print(f"{db_file}: {summary}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+# Enroll many users at once, e.g. everyone trained at the start of a semester
+#
+# The roster is a CSV file with a header row, a JSON array of objects, or JSON
+# Lines (one object per line), with these columns / keys:
+#  uid (or ramcard_uid)          the RamCard uid, decimal or 0x... hex
+#  csu_id (or id)                the 9 digit CSU ID
+#  name (or fullname)
+#  admin (or is_admin)           optional, true/false, yes/no or 1/0
+#  expiration (or expiration_date)  optional, YYYY-MM-DD or a Unix timestamp
+#
+# Example: python3 import_users.py trained_fall.csv --db ../prod.db
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db_interface
+
+# the records of a roster file, read as they are needed
+def read_roster(path, file_format=None):
+    if file_format is None:
+        file_format = os.path.splitext(path)[1].lstrip('.').lower()
+    with open(path, newline='') as f:
+        if file_format == 'csv':
+            yield from csv.DictReader(f)
+        elif file_format == 'jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        elif file_format == 'json':
+            yield from json.load(f)
+        else:
+            raise Exception("Unknown roster format %s, expected csv, json or jsonl" % file_format)
+
+def main():
+    parser = argparse.ArgumentParser(description="Add or update users from a CSV or JSON roster")
+    parser.add_argument("roster", help="CSV, JSON or JSON Lines file")
+    parser.add_argument("--db", default="prod.db", help="database to import into")
+    parser.add_argument("--format", choices=['csv', 'json', 'jsonl'], help="file format (default: from the extension)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with db_interface.db_interface(args.db) as db:
+        report = db.import_users(read_roster(args.roster, args.format))
+    elapsed = time.perf_counter() - start
+
+    print("%d records read in %.2f s" % (report['records'], elapsed))
+    print("  inserted:   %d" % report['inserted'])
+    print("  updated:    %d" % report['updated'])
+    print("  rejected:   %d" % report['rejected'])
+    print("  duplicates: %d (the last record for a uid wins)" % report['duplicates'])
+    for number, reason in report['errors']:
+        print("  record %d: %s" % (number, reason))
+    if report['rejected'] > len(report['errors']):
+        print("  ... and %d more rejected records" % (report['rejected'] - len(report['errors'])))
+    return 1 if report['rejected'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
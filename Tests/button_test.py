@@ -0,0 +1,86 @@
+import unittest
+import os
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import button
+import fake_gpio
+import simulator
+
+PIN = 10
+OTHER_PIN = 12
+
+class TestButton(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.gpio = fake_gpio.fake_gpio()
+        self.gpio.setup(PIN, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+        self.notified = 0
+        self.button = button.button(self.gpio, PIN, debounce_seconds=0.02, hold_seconds=0.05,
+                                    long_press_seconds=2, clock=lambda: self.now)
+        self.button.add_listener(self.count_notification)
+
+    def tearDown(self):
+        self.button.close()
+
+    def count_notification(self):
+        self.notified += 1
+
+    def kinds(self):
+        return [event.kind for event in self.button.get_events()]
+
+    def test_press_is_reported_immediately(self):
+        self.gpio.set_input(PIN, self.gpio.LOW)
+        self.assertTrue(self.button.is_pressed())
+        self.assertEqual(self.notified, 1)
+        self.assertEqual(self.kinds(), [button.button.PRESS])
+
+    def test_bounce_is_ignored(self):
+        self.gpio.set_input(PIN, self.gpio.LOW)
+        self.now = 0.005
+        self.gpio.set_input(PIN, self.gpio.HIGH)
+        self.now = 0.01
+        self.gpio.set_input(PIN, self.gpio.LOW)
+        self.assertEqual(self.kinds(), [button.button.PRESS])
+        self.assertTrue(self.button.is_pressed())
+
+    def test_bounce_settles_to_pin_level(self):
+        self.gpio.set_input(PIN, self.gpio.LOW)
+        self.now = 0.005
+        # released during the debounce window, picked up once it settles
+        self.gpio.set_input(PIN, self.gpio.HIGH)
+        time.sleep(0.1)
+        self.assertFalse(self.button.is_pressed())
+        self.assertEqual(self.kinds(), [button.button.PRESS, button.button.RELEASE])
+
+    def test_long_press(self):
+        self.gpio.set_input(PIN, self.gpio.LOW)
+        self.now = 3
+        self.gpio.set_input(PIN, self.gpio.HIGH)
+        events = self.button.get_events()
+        self.assertEqual([event.kind for event in events], [button.button.PRESS, button.button.RELEASE, button.button.LONG_PRESS])
+        self.assertEqual(events[1].duration, 3)
+
+    def test_hold(self):
+        self.gpio.set_input(PIN, self.gpio.LOW)
+        time.sleep(0.1)
+        self.assertEqual(self.kinds(), [button.button.PRESS, button.button.HOLD])
+
+    def test_wait_for_press(self):
+        self.assertFalse(self.button.wait_for_press(0.01))
+        self.gpio.set_input(PIN, self.gpio.LOW)
+        self.assertTrue(self.button.wait_for_press(0.01))
+
+    def test_wait_for_press_on_simulated_clock(self):
+        clock = simulator.virtual_clock()
+        self.gpio.setup(OTHER_PIN, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+        simulated = button.button(self.gpio, OTHER_PIN, clock=clock.monotonic, sleep=clock.sleep)
+        clock.call_at(5, self.gpio.set_input, OTHER_PIN, self.gpio.LOW)
+        self.assertFalse(simulated.wait_for_press(2))
+        self.assertEqual(clock.monotonic(), 2)
+        self.assertTrue(simulated.wait_for_press(10))
+        self.assertAlmostEqual(clock.monotonic(), 5, delta=button.SIMULATED_POLL_SECONDS)
+        simulated.close()
+
+if __name__ == "__main__":
+    unittest.main()
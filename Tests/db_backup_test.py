@@ -0,0 +1,164 @@
+import unittest
+import gzip
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import backup_catalog
+import db_backup
+import db_interface as db_interface_module
+from db_interface import db_interface
+
+class TestDbBackup(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_name = os.path.join(self.temp_dir.name, "prod.db")
+        self.backup_dir = os.path.join(self.temp_dir.name, "Backups")
+        self.db = db_interface(self.db_name)
+        for i in range(500):
+            self.db.add_user(1000 + i, 800000000 + i, "User %d" % i)
+
+    def tearDown(self):
+        self.db.close()
+        self.temp_dir.cleanup()
+
+    def users(self, path):
+        db = sqlite3.connect(path)
+        rows = db.execute("SELECT ramcard_uid, csu_id, fullname FROM users ORDER BY ramcard_uid").fetchall()
+        db.close()
+        return rows
+
+    def test_backup_is_a_consistent_copy(self):
+        path, created = db_backup.backup_db(self.db_name, self.backup_dir, pages_per_step=1, step_sleep=0)
+        self.assertTrue(created)
+        self.assertEqual(self.users(path), self.users(self.db_name))
+        # a single self-contained file, not a WAL database
+        db = sqlite3.connect(path)
+        self.assertEqual(db.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+        db.close()
+
+    def test_source_is_left_as_it_is(self):
+        plain_db = os.path.join(self.temp_dir.name, "plain.db")
+        db = sqlite3.connect(plain_db)
+        db.execute("CREATE TABLE users (ramcard_uid INTEGER, csu_id INTEGER, fullname TEXT)")
+        db.execute("INSERT INTO users VALUES (1, 2, 'Plain User')")
+        db.commit()
+        db.close()
+        path, created = db_backup.backup_db(plain_db, self.backup_dir, step_sleep=0)
+        self.assertEqual(self.users(path), [(1, 2, "Plain User")])
+        db = sqlite3.connect(plain_db)
+        self.assertEqual(db.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+        db.close()
+        self.assertFalse(os.path.exists(plain_db + "-wal"))
+
+    def test_unchanged_database_is_not_written_again(self):
+        path, created = db_backup.backup_db(self.db_name, self.backup_dir, step_sleep=0)
+        mtime = os.stat(path).st_mtime_ns
+        same_path, created = db_backup.backup_db(self.db_name, self.backup_dir, step_sleep=0)
+        self.assertFalse(created)
+        self.assertEqual(same_path, path)
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+
+        self.db.add_user(5, 5, "New User")
+        new_path, created = db_backup.backup_db(self.db_name, self.backup_dir, step_sleep=0)
+        self.assertTrue(created)
+        self.assertIn((5, 5, "New User"), self.users(new_path))
+
+    def test_compressed_backup(self):
+        path, created = db_backup.backup_db(self.db_name, self.backup_dir, compress=True, step_sleep=0)
+        self.assertTrue(path.endswith(".db.gz"))
+        restored = os.path.join(self.temp_dir.name, "restored.db")
+        with gzip.open(path) as f_in, open(restored, 'wb') as f_out:
+            f_out.write(f_in.read())
+        self.assertEqual(self.users(restored), self.users(self.db_name))
+        # the hash is of the database itself, so compressing does not defeat deduplication
+        self.assertFalse(db_backup.backup_db(self.db_name, self.backup_dir, compress=True, step_sleep=0)[1])
+
+    def test_writes_during_backup(self):
+        def writer():
+            with db_interface(self.db_name) as db:
+                for i in range(20):
+                    db.add_user(i, i, "Concurrent User %d" % i)
+                    time.sleep(0.001)
+        thread = threading.Thread(target=writer)
+        thread.start()
+        data, users = db_backup.snapshot(self.db_name, pages_per_step=1, step_sleep=0.001)
+        thread.join()
+        path = os.path.join(self.temp_dir.name, "snapshot.db")
+        with open(path, 'wb') as f:
+            f.write(data)
+        # a write in the middle restarts the copy, so the snapshot is some committed state
+        concurrent = [row for row in self.users(path) if row[2].startswith("Concurrent")]
+        self.assertEqual(concurrent, [(i, i, "Concurrent User %d" % i) for i in range(len(concurrent))])
+        self.assertEqual(len(self.users(path)), 500 + len(concurrent))
+
+    def test_backups_are_cataloged(self):
+        path, created = db_backup.backup_db(self.db_name, self.backup_dir, compress=True, step_sleep=0)
+        entry = backup_catalog.latest(self.backup_dir)
+        self.assertEqual(entry['file'], os.path.basename(path))
+        self.assertEqual(entry['users'], 500)
+        self.assertEqual(entry['size'], os.path.getsize(path))
+        self.assertEqual(entry['integrity'], backup_catalog.INTEGRITY_OK)
+
+class TestRestore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self.temp_dir.name, "Backups")
+        self.db_name = os.path.join(self.temp_dir.name, "prod.db")
+        source = os.path.join(self.temp_dir.name, "source.db")
+        # two backups, the newer one has one more user
+        with db_interface(source) as db:
+            db.add_user(1, 1, "Old User")
+            self.older, created = db_backup.backup_db(source, self.backup_dir, step_sleep=0)
+            db.add_user(2, 2, "New User")
+            self.newer = os.path.join(self.backup_dir, "newer.db.gz")
+            data, users = db_backup.snapshot(source, step_sleep=0)
+        backup_catalog.write_atomic(self.newer, gzip.compress(data))
+        backup_catalog.add_entry(self.backup_dir, {'file': "newer.db.gz", 'timestamp': 0, 'size': 0,
+                                                   'sha256': hashlib.sha256(data).hexdigest(), 'users': users,
+                                                   'integrity': backup_catalog.INTEGRITY_OK})
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def user_count(self):
+        db = sqlite3.connect(self.db_name)
+        count = db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        db.close()
+        return count
+
+    def test_newest_backup_is_restored(self):
+        entry = backup_catalog.restore_latest(self.db_name, self.backup_dir)
+        self.assertEqual(entry['file'], "newer.db.gz")
+        self.assertEqual(self.user_count(), 2)
+
+    def test_corrupt_backup_falls_back_to_older(self):
+        with open(self.newer, 'r+b') as f:
+            f.seek(30)
+            f.write(b"garbage")
+        entry = backup_catalog.restore_latest(self.db_name, self.backup_dir)
+        self.assertEqual(entry['file'], os.path.basename(self.older))
+        self.assertEqual(self.user_count(), 1)
+        self.assertEqual(backup_catalog.latest(self.backup_dir)['integrity'], backup_catalog.INTEGRITY_CORRUPT)
+
+    def test_nothing_to_restore(self):
+        os.remove(self.newer)
+        os.remove(self.older)
+        self.assertIsNone(backup_catalog.restore_latest(self.db_name, self.backup_dir))
+        self.assertFalse(os.path.exists(self.db_name))
+
+    def test_startup_restores_missing_tables(self):
+        saved = db_interface_module.BACKUPS_DIRECTORY
+        db_interface_module.BACKUPS_DIRECTORY = self.backup_dir
+        try:
+            with db_interface(self.db_name) as db:
+                self.assertEqual(db.get_row_from_uid(2).get_name(), "New User")
+        finally:
+            db_interface_module.BACKUPS_DIRECTORY = saved
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+# Benchmark db_interface against synthetic rosters
+#
+# For each roster size a fresh database is generated, then the operations on
+# the tap path and the maintenance path are timed:
+#  get_row_from_uid / check_uid   hits and misses, with the user cache bypassed
+#                                 (cold) and with it warm
+#  add_user / _add_entry          delete plus insert with a commit per call
+#  remove_expired_users / remove_expired_entries
+#
+# Results are written as JSON so runs before and after a schema, cache or
+# pragma change can be compared:
+#  python3 db_benchmark.py --sizes 1000 100000 --output before.json
+#  python3 db_benchmark.py --sizes 1000 100000 --output after.json
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db_interface
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+EXPIRED_FRACTION = 0.1
+ADMIN_FRACTION = 0.01
+UID_BASE = 10 ** 10
+
+# fill the users table with size users, EXPIRED_FRACTION of them expired
+def generate_roster(db_name, size, seed=0):
+    rng = random.Random(seed)
+    now = int(datetime.datetime.today().timestamp())
+    with db_interface.db_interface(db_name) as db:
+        rows = ((UID_BASE + i, 800000000 + i, "User %d" % i,
+                 1 if rng.random() < ADMIN_FRACTION else 0,
+                 now - 86400 if rng.random() < EXPIRED_FRACTION else now + 86400 * 180)
+                for i in range(size))
+        db._db_cursor.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?)", rows)
+        db._db.commit()
+
+# latency statistics in microseconds for a list of durations in nanoseconds
+def latency_stats(durations_ns):
+    ordered = sorted(durations_ns)
+    def percentile(p):
+        return ordered[max(0, -(-p * len(ordered) // 100) - 1)] / 1000
+    total_seconds = sum(ordered) / 1e9
+    return {
+        'count': len(ordered),
+        'mean_us': statistics.fmean(ordered) / 1000,
+        'p50_us': percentile(50),
+        'p95_us': percentile(95),
+        'p99_us': percentile(99),
+        'max_us': ordered[-1] / 1000,
+        'ops_per_second': len(ordered) / total_seconds if total_seconds else None,
+    }
+
+def time_calls(function, arguments, before_each=None):
+    durations = []
+    for args in arguments:
+        if before_each:
+            before_each()
+        start = time.perf_counter_ns()
+        function(*args)
+        durations.append(time.perf_counter_ns() - start)
+    return latency_stats(durations)
+
+def time_once(function):
+    start = time.perf_counter_ns()
+    function()
+    return latency_stats([time.perf_counter_ns() - start])
+
+def benchmark_size(db_dir, size, lookups, writes, seed=0):
+    db_name = os.path.join(db_dir, "benchmark_%d.db" % size)
+    if os.path.exists(db_name):
+        os.remove(db_name)
+
+    start = time.perf_counter()
+    generate_roster(db_name, size, seed)
+    results = {'roster_size': size, 'generate_seconds': time.perf_counter() - start,
+               'file_bytes': os.path.getsize(db_name)}
+
+    rng = random.Random(seed + 1)
+    hits = [(UID_BASE + rng.randrange(size),) for _ in range(lookups)]
+    misses = [(UID_BASE + size + rng.randrange(size),) for _ in range(lookups)]
+    new_users = [(UID_BASE + 2 * size + i, 900000000 + i, "New User %d" % i) for i in range(writes)]
+    updated_users = [(UID_BASE + rng.randrange(size), 700000000 + i, "Updated User %d" % i) for i in range(writes)]
+
+    with db_interface.db_interface(db_name) as db:
+        cold = db._invalidate_cache
+        results['get_row_from_uid_hit_cold'] = time_calls(db.get_row_from_uid, hits, before_each=cold)
+        results['get_row_from_uid_miss'] = time_calls(db.get_row_from_uid, misses, before_each=cold)
+        results['check_uid_hit_cold'] = time_calls(db.check_uid, hits, before_each=cold)
+        for args in hits:
+            db.get_row_from_uid(*args)
+        results['get_row_from_uid_hit_warm'] = time_calls(db.get_row_from_uid, hits)
+        results['check_uid_hit_warm'] = time_calls(db.check_uid, hits)
+        results['add_user_insert'] = time_calls(db.add_user, new_users)
+        results['add_user_update'] = time_calls(db.add_user, updated_users)
+        results['remove_expired_users'] = time_once(db.remove_expired_users)
+        results['cache'] = db.cache_stats()
+
+    # remove_expired_users has just archived the expired users, remove_expired_entries
+    # is timed on a freshly generated roster so it has the same backlog to remove
+    os.remove(db_name)
+    generate_roster(db_name, size, seed)
+    with db_interface.db_interface(db_name) as db:
+        results['remove_expired_entries'] = time_once(db.remove_expired_entries)
+
+    os.remove(db_name)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark db_interface with synthetic rosters")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="roster sizes to generate")
+    parser.add_argument('--lookups', type=int, default=2000, help="lookups timed per operation")
+    parser.add_argument('--writes', type=int, default=200, help="add_user calls timed per operation")
+    parser.add_argument('--db-dir', default=None, help="where to put the generated databases (default: a temporary directory)")
+    parser.add_argument('--output', default='db_benchmark.json', help="JSON results file")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'results': [],
+    }
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_dir = args.db_dir or temp_dir
+        for size in args.sizes:
+            print("Benchmarking %d users..." % size)
+            result = benchmark_size(db_dir, size, args.lookups, args.writes, args.seed)
+            report['results'].append(result)
+            for name, stats in result.items():
+                if isinstance(stats, dict) and 'p50_us' in stats:
+                    print("  %-28s p50 %9.1f us  p99 %9.1f us" % (name, stats['p50_us'], stats['p99_us']))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to %s" % args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# Benchmark read latency while another process writes to the database
+#
+# This is the situation of the station when Scripts/add_admin.py or a sync job
+# writes to prod.db while the controller looks up cards. For each connection
+# profile in db_interface.CONNECTION_PROFILES:
+#  - a roster is generated
+#  - a writer process adds users with one commit each, as fast as it can
+#  - the main process times uncached lookups (_get_row_from_uid) meanwhile
+#
+# Results are written as JSON:
+#  python3 db_concurrency_benchmark.py --profiles sqlite_default pi --output concurrency.json
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db_interface
+from db_benchmark import generate_roster, latency_stats, UID_BASE
+
+def writer(db_name, profile, ready, stop, commits):
+    with db_interface.db_interface(db_name, profile) as db:
+        ready.set()
+        i = 0
+        while not stop.is_set():
+            db.add_user(UID_BASE * 2 + i, 900000000 + i, "Writer User %d" % i)
+            i += 1
+        commits.value = i
+
+def benchmark_profile(db_dir, profile, size, lookups, seed=0):
+    db_name = os.path.join(db_dir, "concurrency_%s.db" % profile)
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(db_name + suffix):
+            os.remove(db_name + suffix)
+    generate_roster(db_name, size, seed)
+
+    rng = random.Random(seed + 1)
+    uids = [UID_BASE + rng.randrange(size) for _ in range(lookups)]
+    results = {'profile': profile, 'roster_size': size}
+
+    with db_interface.db_interface(db_name, profile) as db:
+        results['journal_mode'] = db._db.execute("PRAGMA journal_mode").fetchone()[0]
+
+        def time_lookups():
+            durations = []
+            for uid in uids:
+                start = time.perf_counter_ns()
+                db._get_row_from_uid(uid)
+                durations.append(time.perf_counter_ns() - start)
+            return latency_stats(durations)
+
+        results['read_idle'] = time_lookups()
+
+        ready = multiprocessing.Event()
+        stop = multiprocessing.Event()
+        commits = multiprocessing.Value('i', 0)
+        process = multiprocessing.Process(target=writer, args=(db_name, profile, ready, stop, commits))
+        process.start()
+        ready.wait()
+        start = time.perf_counter()
+        try:
+            results['read_with_writer'] = time_lookups()
+        finally:
+            stop.set()
+            process.join()
+        elapsed = time.perf_counter() - start
+        results['writer_commits'] = commits.value
+        results['writer_commits_per_second'] = commits.value / elapsed
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lookups under a concurrent writer")
+    parser.add_argument('--profiles', nargs='+', default=sorted(db_interface.CONNECTION_PROFILES), help="connection profiles to compare")
+    parser.add_argument('--size', type=int, default=10000, help="roster size")
+    parser.add_argument('--lookups', type=int, default=20000, help="lookups timed per run")
+    parser.add_argument('--db-dir', default=None, help="where to put the generated databases (default: a temporary directory)")
+    parser.add_argument('--output', default='db_concurrency_benchmark.json', help="JSON results file")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'results': [],
+    }
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_dir = args.db_dir or temp_dir
+        for profile in args.profiles:
+            print("Benchmarking profile %s..." % profile)
+            result = benchmark_profile(db_dir, profile, args.size, args.lookups, args.seed)
+            report['results'].append(result)
+            for name in ('read_idle', 'read_with_writer'):
+                stats = result[name]
+                print("  %-18s p50 %9.1f us  p99 %9.1f us  max %9.1f us" % (name, stats['p50_us'], stats['p99_us'], stats['max_us']))
+            print("  writer: %d commits, %.0f per second" % (result['writer_commits'], result['writer_commits_per_second']))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to %s" % args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import unittest
+import os
+import sqlite3
+import sys
+import tempfile
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Scripts')))
+import db_merge_candidate
+from db_interface import db_interface
+
+class TestMergeDatabases(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.temp_dir.name, "output.db")
+        with db_interface(self.output) as db:
+            db._db.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?)", [
+                (1, 100000001, "Soon Expired", 0, 1000),
+                (2, 100000002, "Recent User", 0, 5000),
+                (3, 100000003, "Same User", 0, 3000),
+            ])
+            db._db.commit()
+        # an older source with the schema of Tests/setup_test_merge_db.py (no csu_id column)
+        self.source = os.path.join(self.temp_dir.name, "source.db")
+        source = sqlite3.connect(self.source)
+        source.execute("CREATE TABLE users(ramcard_uid, fullname, is_admin, expiration_date, duplicate)")
+        source.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?)", [
+            ('1', "Renewed User", 0, 2000, False),
+            ('2', "Old Admin", 1, 4000, False),
+            ('not a uid', "Broken Row", 0, 9000, False),
+            ('4', "New User", 0, 7000, False),
+            ('4', "New User Again", 0, 8000, True),
+        ])
+        source.commit()
+        source.close()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def users(self):
+        db = sqlite3.connect(self.output)
+        rows = {row[0]: row for row in db.execute("SELECT * FROM users")}
+        db.close()
+        return rows
+
+    def test_newest_expiration_wins(self):
+        changes = []
+        summary = db_merge_candidate.merge_databases(self.source, self.output, chunk_size=2,
+                                                     on_change=lambda kind, old, new: changes.append((kind, new[0])))[self.source]
+        users = self.users()
+        # the source has no csu_id column, so the output's csu_id is kept
+        self.assertEqual(users[1], (1, 100000001, "Renewed User", 0, 2000))
+        self.assertEqual(users[2][2], "Recent User")
+        self.assertEqual(users[4][2:], ("New User Again", 0, 8000))
+        self.assertEqual((summary.read, summary.inserted, summary.updated, summary.kept, summary.rejected), (5, 1, 2, 1, 1))
+        self.assertEqual(changes, [('update', 1), ('insert', 4), ('update', 4)])
+
+    def test_merged_rows_are_logged(self):
+        db_merge_candidate.merge_databases(self.source, self.output)
+        with db_interface(self.output) as db:
+            log = db._db.execute("SELECT action, data, entry FROM users_log WHERE action IN ('ADD', 'UPDATE') ORDER BY seq").fetchall()
+        self.assertEqual([(action, uid) for action, uid, _ in log], [('UPDATE', 1), ('ADD', 4)])
+        self.assertEqual(log[0][2], '[1, 100000001, "Renewed User", 0, 2000]')
+
+    def test_merged_card_leaves_the_archive(self):
+        with db_interface(self.output) as db:
+            db._db.execute("INSERT INTO users_archive VALUES (4, 4, 'Archived User', 0, 100, 100)")
+            db._db.commit()
+        db_merge_candidate.merge_databases(self.source, self.output)
+        with db_interface(self.output) as db:
+            self.assertIsNone(db.get_archived_user(4))
+
+    def test_failed_chunk_is_not_reported(self):
+        changes = []
+        with db_interface(self.output) as db:
+            # the second chunk cannot be written, uid 4 is refused by the trigger
+            db._db.execute("CREATE TRIGGER refuse_uid_4 BEFORE INSERT ON users WHEN NEW.ramcard_uid = 4 BEGIN SELECT RAISE(ABORT, 'refused'); END")
+            db._db.commit()
+        with self.assertRaises(sqlite3.IntegrityError):
+            db_merge_candidate.merge_databases(self.source, self.output, chunk_size=3,
+                                               on_change=lambda kind, old, new: changes.append(new[0]))
+        self.assertEqual(changes, [1])
+
+    def test_admin_wins(self):
+        db_merge_candidate.merge_databases(self.source, self.output, policy='admin')
+        self.assertEqual(self.users()[2][2:4], ("Old Admin", 1))
+
+    def test_merging_again_changes_nothing(self):
+        db_merge_candidate.merge_databases(self.source, self.output)
+        before = self.users()
+        summary = db_merge_candidate.merge_databases([self.source], self.output)[self.source]
+        self.assertEqual(self.users(), before)
+        self.assertEqual(summary.inserted + summary.updated, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import os
+import sys
+import sqlite3
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db_migrations
+from db_interface import db_interface
+
+class TestDbMigrations(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_migrations.sqlite"
+        # database in the original schema, with TEXT uids and a duplicate card
+        db = sqlite3.connect(self.db_name)
+        db.execute("CREATE TABLE users(ramcard_uid TEXT, csu_id TEXT, fullname TEXT, is_admin INTEGER, expiration_date INTEGER)")
+        db.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?)", [
+            ("151493474601", "123123123", "Old Entry", 0, 100),
+            ("151493474601", "123123123", "New Entry", 0, 200),
+            ("86080826340", "", "No CSU ID", 1, 100),
+            ("not a uid", "111111111", "Bad Row", 0, 100),
+        ])
+        db.execute("CREATE TABLE users_log(timestamp, action, data)")
+        db.executemany("INSERT INTO users_log VALUES (?, ?, ?)", [(100, "ADD", 151493474601), (200, "DELETE", 151493474601)])
+        db.commit()
+        db.close()
+
+    def tearDown(self):
+        os.remove(self.db_name)
+
+    def test_migrate_legacy_database(self):
+        with db_interface(self.db_name) as db:
+            self.assertEqual(db_migrations.get_version(db._db), db_migrations.LATEST_VERSION)
+            row = db.get_row_from_uid(151493474601)
+            self.assertEqual(row.get_name(), "New Entry")
+            self.assertEqual(row.get_csu_id(), 123123123)
+            self.assertTrue(db.is_admin(86080826340))
+            count = db._db_cursor.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            self.assertEqual(count, 2)
+            types = db._db_cursor.execute("SELECT DISTINCT typeof(ramcard_uid) FROM users").fetchall()
+            self.assertEqual(types, [("integer",)])
+
+    def test_lookup_uses_index(self):
+        with db_interface(self.db_name) as db:
+            plan = db._db_cursor.execute("EXPLAIN QUERY PLAN SELECT * FROM users WHERE ramcard_uid = ?", [1]).fetchall()
+            self.assertIn("users_ramcard_uid", plan[0][3])
+
+    def test_unique_uid(self):
+        with db_interface(self.db_name) as db:
+            with self.assertRaises(sqlite3.IntegrityError):
+                db._db_cursor.execute("INSERT INTO users VALUES (151493474601, 1, 'Duplicate', 0, 0)")
+
+    def test_users_log_gets_sequence_numbers(self):
+        with db_interface(self.db_name) as db:
+            db.add_user(1, 100000001, "New User")
+            rows = db._db_cursor.execute("SELECT timestamp, action, data, seq FROM users_log ORDER BY seq").fetchall()
+            self.assertEqual(rows[:2], [(100, "ADD", 151493474601, 1), (200, "DELETE", 151493474601, 2)])
+            # one baseline row per user after the legacy rows, replication starts there
+            self.assertEqual([row[1:] for row in rows[2:]],
+                             [("BASELINE", 86080826340, 3), ("BASELINE", 151493474601, 4), ("ADD", 1, 5)])
+            self.assertEqual(db.baseline_seq(), 2)
+            self.assertEqual(len(db.replica_id()), 16)
+
+    def test_migrate_is_idempotent(self):
+        with db_interface(self.db_name) as db:
+            self.assertEqual(db_migrations.migrate(db._db), db_migrations.LATEST_VERSION)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import unittest
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db_sync
+from db_interface import db_interface
+
+class TestDbSync(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.station_a = db_interface(os.path.join(self.temp_dir.name, "a.db"))
+        self.station_b = db_interface(os.path.join(self.temp_dir.name, "b.db"))
+        self.hub = db_interface(os.path.join(self.temp_dir.name, "hub.db"))
+
+    def tearDown(self):
+        for db in (self.station_a, self.station_b, self.hub):
+            db.close()
+        self.temp_dir.cleanup()
+
+    def pull(self, db, peer, batch_size=db_sync.BATCH_SIZE):
+        return db_sync.pull(db, peer.current_db, batch_size)
+
+    def log(self, db):
+        return db._db.execute("SELECT seq, action, data FROM users_log ORDER BY seq").fetchall()
+
+    def test_changes_are_logged_in_sequence(self):
+        self.station_a.add_user(1, 100000001, "First User")
+        self.station_a.add_user(1, 100000001, "Renamed User")
+        self.station_a.delete_entry(1)
+        self.station_a.delete_entry(1)
+        self.assertEqual(self.log(self.station_a), [(1, "ADD", 1), (2, "UPDATE", 1), (3, "DELETE", 1)])
+
+    def test_pull_applies_changes(self):
+        self.station_a.add_user(1, 100000001, "First User")
+        self.station_a.add_admin(2, 100000002, "Admin")
+        self.station_a.add_user(3, 100000003, "Leaving User")
+        self.station_a.delete_entry(3)
+        report = self.pull(self.station_b, self.station_a)
+        self.assertEqual((report.read, report.applied), (4, 4))
+        self.assertEqual(self.station_b.get_row_from_uid(1), self.station_a.get_row_from_uid(1))
+        self.assertTrue(self.station_b.is_admin(2))
+        self.assertIsNone(self.station_b.get_row_from_uid(3))
+
+        # nothing new, nothing read
+        report = self.pull(self.station_b, self.station_a)
+        self.assertEqual((report.read, report.applied, report.batches), (0, 0, 0))
+
+    def test_archive_is_replicated(self):
+        self.station_a.add_user(1, 100000001, "Expiring User")
+        self.pull(self.station_b, self.station_a)
+        self.station_a.archive_expired_users(now=2 ** 40)
+        self.pull(self.station_b, self.station_a)
+        self.assertIsNone(self.station_b.get_row_from_uid(1))
+        self.assertEqual(self.station_b.get_archived_user(1).get_name(), "Expiring User")
+
+    def test_changes_travel_through_a_hub_once(self):
+        self.station_a.add_user(1, 100000001, "User A")
+        self.station_b.add_user(2, 100000002, "User B")
+        for station in (self.station_a, self.station_b):
+            self.pull(self.hub, station)
+        for station in (self.station_a, self.station_b):
+            self.assertEqual(self.pull(station, self.hub).applied, 1)
+        self.assertEqual(self.station_a.get_name(2), "User B")
+        self.assertEqual(self.station_b.get_name(1), "User A")
+
+        # the hub already has both changes, whichever station they come back from
+        for station in (self.station_a, self.station_b):
+            self.assertEqual(self.pull(self.hub, station).applied, 0)
+        self.assertEqual(self.hub._db.execute("SELECT COUNT(*) FROM users_log").fetchone()[0], 2)
+
+    def test_pull_in_batches(self):
+        self.station_a.import_users({'uid': uid, 'csu_id': uid, 'name': "User %d" % uid} for uid in range(1, 1201))
+        report = self.pull(self.station_b, self.station_a, batch_size=500)
+        self.assertEqual((report.read, report.applied, report.batches), (1200, 1200, 3))
+        self.assertEqual(len(list(self.station_b.iter_users())), 1200)
+
+        # a later sync only reads what changed since
+        self.station_a.add_user(5, 5, "Renamed User")
+        report = self.pull(self.station_b, self.station_a, batch_size=500)
+        self.assertEqual((report.read, report.applied, report.last_seq), (1, 1, 1201))
+        self.assertEqual(self.station_b.get_name(5), "Renamed User")
+
+    def test_migrated_roster_is_replicated(self):
+        # a station database from before the change log, with a legacy log row
+        legacy_name = os.path.join(self.temp_dir.name, "legacy.db")
+        legacy = sqlite3.connect(legacy_name)
+        legacy.execute("CREATE TABLE users(ramcard_uid, csu_id, fullname, is_admin, expiration_date)")
+        legacy.execute("INSERT INTO users VALUES (5, 100000005, 'Legacy User', 0, 2000000000)")
+        legacy.execute("CREATE TABLE users_log(timestamp, action, data)")
+        legacy.execute("INSERT INTO users_log VALUES (100, 'ADD', 5)")
+        legacy.commit()
+        legacy.close()
+        with db_interface(legacy_name) as migrated:
+            report = self.pull(self.station_b, migrated)
+            self.assertEqual((report.read, report.applied), (1, 1))
+            self.assertEqual(self.station_b.get_row_from_uid(5), migrated.get_row_from_uid(5))
+
+    def test_concurrent_updates_converge(self):
+        self.station_a.add_user(1, 100000001, "First User")
+        for db, peer in ((self.hub, self.station_a), (self.station_b, self.hub)):
+            self.pull(db, peer)
+        self.station_a.add_user(1, 100000001, "From A")
+        self.station_b.add_user(1, 100000001, "From B")
+        for db, peer in ((self.hub, self.station_a), (self.hub, self.station_b), (self.station_a, self.hub), (self.station_b, self.hub)):
+            self.pull(db, peer)
+        names = [db.get_name(1) for db in (self.station_a, self.station_b, self.hub)]
+        self.assertEqual(len(set(names)), 1, names)
+
+    def test_older_archive_does_not_remove_a_renewed_card(self):
+        self.station_a.add_user(1, 100000001, "Expiring User")
+        self.pull(self.station_b, self.station_a)
+        # expired on A, and archived there before B renews the card
+        self.station_a._db.execute("UPDATE users SET expiration_date = 1000")
+        self.station_a._db.commit()
+        self.assertEqual(self.station_a.archive_expired_users(now=int(time.time()) - 10), 1)
+        self.station_b.add_user(1, 100000001, "Renewed User")
+        self.assertEqual(self.pull(self.station_b, self.station_a).applied, 0)
+        self.assertEqual(self.station_b.get_name(1), "Renewed User")
+        self.pull(self.station_a, self.station_b)
+        self.assertEqual(self.station_a.get_name(1), "Renewed User")
+
+    def test_copied_database_is_refused(self):
+        self.station_b._db.execute("UPDATE replica SET id = ?", [self.station_a.replica_id()])
+        self.station_b._db.commit()
+        with self.assertRaises(Exception):
+            self.pull(self.station_b, self.station_a)
+        db_sync.new_replica_id(self.station_b)
+        self.pull(self.station_b, self.station_a)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,11 @@
 import unittest
 import os
 import sys
+import sqlite3
+import pickle
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from db_interface import db_interface, user_entry, calculate_expiration_date_timestamp
+import db_interface as db_interface_module
+from db_interface import db_interface, user_entry, calculate_expiration_date_timestamp, NEGATIVE_CACHE_SECONDS
 
 class TestDbInterface(unittest.TestCase):
     def setUp(self):
@@ -48,5 +51,177 @@ class TestDbInterface(unittest.TestCase):
         self.db.add_user(self.uid, self.csu_id, self.name)
         self.assertFalse(self.db.is_expired(self.uid))
 
+    def test_cache_hit(self):
+        self.db.add_user(self.uid, self.csu_id, self.name)
+        self.db.get_row_from_uid(self.uid)
+        self.db.get_row_from_uid(self.uid)
+        self.assertEqual(self.db.cache_misses, 1)
+        self.assertEqual(self.db.cache_hits, 1)
+
+    def test_cache_invalidated_by_other_connection(self):
+        self.db.add_user(self.uid, self.csu_id, self.name)
+        self.db.get_row_from_uid(self.uid)
+        other = sqlite3.connect(self.db_name)
+        other.execute("UPDATE users SET fullname = ? WHERE ramcard_uid = ?", ["Renamed User", self.uid])
+        other.commit()
+        other.close()
+        self.assertEqual(self.db.get_row_from_uid(self.uid).get_name(), "Renamed User")
+        self.assertEqual(self.db.cache_invalidations, 1)
+
+    def test_cache_kept_across_other_writes(self):
+        self.db.add_user(self.uid, self.csu_id, self.name)
+        self.db.get_row_from_uid(self.uid)
+        other = sqlite3.connect(self.db_name)
+        other.execute("INSERT INTO laser_log VALUES (1, 'LASER_OFF', '{}')")
+        other.commit()
+        other.close()
+        self.db.get_row_from_uid(self.uid)
+        self.assertEqual((self.db.cache_hits, self.db.cache_invalidations), (1, 0))
+
+    def test_archive_gives_up_on_busy_timeout(self):
+        self.db._db.execute("INSERT INTO users VALUES (1, 1, 'Expired User', 0, 1000)")
+        self.db._db.commit()
+        writer = sqlite3.connect(self.db_name)
+        writer.execute("BEGIN IMMEDIATE")
+        with self.assertRaises(sqlite3.OperationalError) as raised:
+            self.db.archive_expired_users(busy_timeout=10)
+        writer.rollback()
+        writer.close()
+        self.assertTrue(db_interface_module.is_busy(raised.exception))
+        self.assertEqual(self.db._db.execute("PRAGMA busy_timeout").fetchone()[0], 5000)
+        self.assertEqual(self.db.archive_expired_users(busy_timeout=10), 1)
+
+    def test_negative_cache(self):
+        now = [0]
+        with db_interface(self.db_name, clock=lambda: now[0]) as db:
+            self.assertIsNone(db.get_row_from_uid(self.uid))
+            self.assertTrue(db.is_known_unknown(self.uid))
+            self.assertIsNone(db.get_row_from_uid(self.uid))
+            self.assertEqual((db.cache_misses, db.negative_cache_hits), (1, 1))
+
+            now[0] = NEGATIVE_CACHE_SECONDS
+            self.assertFalse(db.is_known_unknown(self.uid))
+            self.assertIsNone(db.get_row_from_uid(self.uid))
+            self.assertEqual((db.cache_misses, db.negative_cache_expirations), (2, 1))
+
+            # enrolling the card, here or from another connection, drops it
+            self.db.add_user(self.uid, self.csu_id, self.name)
+            self.assertFalse(db.is_known_unknown(self.uid))
+            self.assertEqual(db.get_row_from_uid(self.uid).get_name(), self.name)
+
+    def test_pi_profile(self):
+        self.assertEqual(self.db._db.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEqual(self.db._db.execute("PRAGMA synchronous").fetchone()[0], 1) # NORMAL
+        self.assertEqual(self.db._db.execute("PRAGMA busy_timeout").fetchone()[0], 5000)
+
+    def test_reads_while_another_connection_writes(self):
+        self.db.add_user(self.uid, self.csu_id, self.name)
+        other = sqlite3.connect(self.db_name)
+        other.execute("BEGIN EXCLUSIVE")
+        other.execute("DELETE FROM users")
+        try:
+            # WAL readers see the last commit instead of waiting for the writer
+            self.assertEqual(self.db._get_row_from_uid(self.uid).get_name(), self.name)
+        finally:
+            other.rollback()
+            other.close()
+
+    def test_unknown_profile(self):
+        with self.assertRaises(Exception):
+            db_interface("test_db_profile.sqlite", "no such profile")
+        self.assertFalse(os.path.exists("test_db_profile.sqlite"))
+
+    def test_import_users(self):
+        self.db.add_user(self.uid, self.csu_id, self.name)
+        report = self.db.import_users([
+            {'uid': str(self.uid), 'csu_id': '111111111', 'name': '  Renamed   User ', 'admin': 'yes'},
+            {'uid': '0x10', 'csu_id': 222222222, 'name': 'Hex User', 'expiration': '2000-01-01'},
+            {'uid': 'not a number', 'csu_id': 333333333, 'name': 'Bad Uid'},
+            {'uid': 17, 'csu_id': 444444444, 'name': ''},
+            {'uid': 18, 'csu_id': 555555555, 'name': 'First'},
+            {'uid': 18, 'csu_id': 555555555, 'name': 'Second'},
+        ])
+        self.assertEqual((report['records'], report['inserted'], report['updated'], report['rejected'], report['duplicates']),
+                         (6, 2, 1, 2, 1))
+        self.assertEqual([number for number, reason in report['errors']], [3, 4])
+        updated = self.db.get_row_from_uid(self.uid)
+        self.assertEqual((updated.get_name(), updated.get_csu_id(), updated.is_admin()), ("Renamed User", 111111111, True))
+        self.assertTrue(self.db.get_row_from_uid(16).is_expired())
+        self.assertEqual(self.db.get_row_from_uid(18).get_name(), "Second")
+
+    def test_failed_import_changes_nothing(self):
+        def records():
+            yield {'uid': 1, 'csu_id': 1, 'name': 'One'}
+            raise IOError("roster file went away")
+        with self.assertRaises(IOError):
+            self.db.import_users(records())
+        self.assertIsNone(self.db.get_row_from_uid(1))
+
+    def test_user_entry_is_a_typed_tuple(self):
+        self.db.add_admin(self.uid, self.csu_id, self.name)
+        user = self.db.get_row_from_uid(self.uid)
+        self.assertIsInstance(user, user_entry)
+        self.assertEqual(tuple(user), (self.uid, self.csu_id, self.name, True, user.expiration_date))
+        self.assertEqual((user.ramcard_uid, user.csu_id, user.fullname, user.admin), (self.uid, self.csu_id, self.name, True))
+        self.assertEqual(user, user_entry(self.uid, self.csu_id, self.name, 1, user.expiration_date))
+        self.assertEqual(pickle.loads(pickle.dumps(user)), user)
+        with self.assertRaises(AttributeError):
+            user.extra = 1
+
+    def test_iter_users(self):
+        for uid in (3, 1, 2):
+            self.db.add_user(uid, uid, "User %d" % uid)
+        users = self.db.iter_users()
+        self.assertEqual(next(users).get_uid(), 1)
+        self.assertEqual([user.get_uid() for user in users], [2, 3])
+
+    def test_get_rows_from_uids(self):
+        for uid in range(1, 1201):
+            self.db.add_user(uid, uid, "User %d" % uid)
+        wanted = list(range(0, 1300, 2))
+        found = sorted(user.get_uid() for user in self.db.get_rows_from_uids(wanted))
+        self.assertEqual(found, list(range(2, 1201, 2)))
+
+    def add_expired(self, uid, is_admin=0, expiration_date=1000):
+        self.db._db.execute("INSERT INTO users VALUES (?, ?, ?, ?, ?)", [uid, uid, "Expired %d" % uid, is_admin, expiration_date])
+        self.db._db.commit()
+
+    def test_archive_expired_users_in_batches(self):
+        for uid in range(1, 6):
+            self.add_expired(uid)
+        self.add_expired(6, is_admin=1)
+        self.db.add_user(self.uid, self.csu_id, self.name)
+        self.assertEqual(self.db.archive_expired_users(batch_size=3), 3)
+        self.assertEqual(self.db.archive_expired_users(batch_size=3), 2)
+        self.assertEqual(self.db.archive_expired_users(batch_size=3), 0)
+        remaining = sorted(user.get_uid() for user in self.db.iter_users())
+        self.assertEqual(remaining, [6, self.uid])
+        self.assertEqual(self.db.get_archived_user(1).get_name(), "Expired 1")
+
+    def test_reinstate_user(self):
+        self.add_expired(1)
+        self.db.get_row_from_uid(1)
+        self.db.remove_expired_users()
+        self.assertIsNone(self.db.get_row_from_uid(1))
+        user = self.db.reinstate_user(1)
+        self.assertEqual(user.get_name(), "Expired 1")
+        self.assertFalse(user.is_expired())
+        self.assertIsNone(self.db.get_archived_user(1))
+        self.assertIsNone(self.db.reinstate_user(2))
+
+    def test_enrolling_clears_the_archive(self):
+        self.add_expired(1)
+        self.db.remove_expired_entries()
+        self.db.add_user(1, 1, "Enrolled Again")
+        self.assertIsNone(self.db.get_archived_user(1))
+
+    def test_importing_clears_the_archive(self):
+        self.add_expired(1)
+        self.add_expired(2)
+        self.db.remove_expired_entries()
+        self.db.import_users([{'uid': 1, 'csu_id': 1, 'name': 'Imported Again'}])
+        self.assertIsNone(self.db.get_archived_user(1))
+        self.assertEqual(self.db.get_archived_user(2).get_name(), "Expired 2")
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
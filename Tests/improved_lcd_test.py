@@ -0,0 +1,85 @@
+import unittest
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import improved_lcd
+from improved_lcd import BLANK_ROW, CLEAR_THRESHOLD, LCD_COLUMNS, MAX_MERGE_GAP, changed_runs
+
+class null_bus:
+    def write_byte(self, addr, value):
+        pass
+
+    def write_i2c_block_data(self, addr, cmd, values):
+        pass
+
+# records what display_frame sends instead of encoding it
+class recording_lcd(improved_lcd.lcd):
+    def __init__(self):
+        super().__init__(bus=null_bus(), sleep=lambda seconds: None)
+        self.clears = 0
+        self.writes = []
+
+    def lcd_clear(self):
+        self.clears += 1
+
+    def lcd_display_string_pos(self, string, line, pos):
+        self.writes.append((string, line, pos))
+
+class TestChangedRuns(unittest.TestCase):
+    def test_unknown_row_is_written_in_full(self):
+        self.assertEqual(changed_runs(None, "x" * LCD_COLUMNS), [(0, LCD_COLUMNS)])
+
+    def test_identical_rows(self):
+        self.assertEqual(changed_runs("abc", "abc"), [])
+
+    def test_gap_at_merge_limit_is_merged(self):
+        old = "a" * 10
+        new = "b" + "a" * MAX_MERGE_GAP + "b" + "a" * (9 - MAX_MERGE_GAP)
+        self.assertEqual(changed_runs(old, new), [(0, MAX_MERGE_GAP + 2)])
+
+    def test_gap_over_merge_limit_is_split(self):
+        old = "a" * 10
+        new = "b" + "a" * (MAX_MERGE_GAP + 1) + "b" + "a" * (8 - MAX_MERGE_GAP)
+        self.assertEqual(changed_runs(old, new), [(0, 1), (MAX_MERGE_GAP + 2, MAX_MERGE_GAP + 3)])
+
+    def test_adjacent_changes_are_one_run(self):
+        self.assertEqual(changed_runs("aaaa", "abba"), [(1, 3)])
+
+class TestFramebuffer(unittest.TestCase):
+    def setUp(self):
+        self.lcd = recording_lcd()
+
+    # a panel showing that many non-blank cells, filled row by row
+    def show_cells(self, cells):
+        text = ("x" * cells).ljust(LCD_COLUMNS * improved_lcd.LCD_ROWS)
+        self.lcd.framebuffer = [text[i:i + LCD_COLUMNS] for i in range(0, len(text), LCD_COLUMNS)]
+
+    def test_blanking_over_threshold_clears(self):
+        self.show_cells(CLEAR_THRESHOLD + 1)
+        self.lcd.display_frame([BLANK_ROW] * improved_lcd.LCD_ROWS)
+        self.assertEqual(self.lcd.clears, 1)
+        self.assertEqual(self.lcd.writes, [])
+
+    def test_blanking_at_threshold_writes_cells(self):
+        self.show_cells(CLEAR_THRESHOLD)
+        self.lcd.display_frame([BLANK_ROW] * improved_lcd.LCD_ROWS)
+        self.assertEqual(self.lcd.clears, 0)
+        self.assertEqual(sum(len(string) for string, _, _ in self.lcd.writes), CLEAR_THRESHOLD)
+
+    def test_full_frame_is_not_cleared_first(self):
+        # every cell changes, but redrawing after a clear would rewrite them all anyway
+        frame = ["x" * LCD_COLUMNS] * improved_lcd.LCD_ROWS
+        self.lcd.display_frame(frame)
+        self.assertEqual(self.lcd.clears, 0)
+        self.assertEqual(self.lcd.framebuffer, frame)
+
+    def test_clear_redraws_non_blank_cells(self):
+        self.show_cells(CLEAR_THRESHOLD + 20)
+        frame = [BLANK_ROW, "Scan RamCard".center(LCD_COLUMNS), BLANK_ROW, BLANK_ROW]
+        self.lcd.display_frame(frame)
+        self.assertEqual(self.lcd.clears, 1)
+        self.assertEqual(self.lcd.writes, [("Scan RamCard", 2, 4)])
+        self.assertEqual(self.lcd.framebuffer, frame)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import RPi_I2C_driver
+import improved_lcd
+
+# records every transaction instead of talking to the expander
+class counting_bus:
+    def __init__(self):
+        self.transactions = 0
+        self.bytes = []
+
+    def write_byte(self, addr, value):
+        self.transactions += 1
+        self.bytes.append(value)
+
+    def write_i2c_block_data(self, addr, cmd, values):
+        if len(values) > RPi_I2C_driver.I2C_BLOCK_SIZE:
+            raise IOError("block too long")
+        self.transactions += 1
+        self.bytes.append(cmd)
+        self.bytes.extend(values)
+
+class TestLcdDriver(unittest.TestCase):
+    def setUp(self):
+        self.bus = counting_bus()
+        self.lcd = improved_lcd.lcd(bus=self.bus)
+        self.bus.transactions = 0
+        self.bus.bytes = []
+
+    def test_encode_byte_matches_nibble_writes(self):
+        bl = RPi_I2C_driver.LCD_BACKLIGHT
+        en = RPi_I2C_driver.En
+        rs = RPi_I2C_driver.Rs
+        self.assertEqual(RPi_I2C_driver.encode_byte(0x41, rs),
+                         [0x41 | bl, 0x45 | bl, 0x41 | bl, 0x11 | bl, 0x15 | bl, 0x11 | bl])
+
+    def test_row_is_batched(self):
+        self.lcd.lcd_display_string("x" * 20, 1)
+        # address + 20 characters, 6 expander bytes each, in 33 byte blocks
+        self.assertEqual(len(self.bus.bytes), 21 * 6)
+        self.assertEqual(self.bus.transactions, 4)
+
+    def test_unchanged_row_not_written(self):
+        self.lcd.display_string("Scan RamCard", 2)
+        self.bus.transactions = 0
+        self.lcd.display_string("Scan RamCard", 2)
+        self.assertEqual(self.bus.transactions, 0)
+
+    def test_only_changed_cells_written(self):
+        self.lcd.display_string("19 sec to return", 3)
+        self.bus.bytes = []
+        self.lcd.display_string("18 sec to return", 3)
+        # one address and one character
+        self.assertEqual(len(self.bus.bytes), 2 * 6)
+
+    def test_clear_blank_panel_is_noop(self):
+        self.lcd.clear()
+        self.assertEqual(self.bus.transactions, 0)
+
+if __name__ == "__main__":
+    unittest.main()
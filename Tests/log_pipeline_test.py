@@ -0,0 +1,77 @@
+import unittest
+import gzip
+import logging
+import os
+import queue
+import sys
+import tempfile
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import log_pipeline
+
+class TestDroppingQueueHandler(unittest.TestCase):
+    def setUp(self):
+        self.queue = queue.Queue(maxsize=2)
+        self.handler = log_pipeline.dropping_queue_handler(self.queue)
+        self.logger = logging.getLogger("log_pipeline_test")
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        for i in range(5):
+            self.logger.warning("record %d", i)
+        self.assertEqual(self.handler.dropped, 3)
+        self.assertEqual([self.queue.get_nowait().getMessage() for _ in range(2)], ["record 0", "record 1"])
+
+    def test_drops_are_reported_once_there_is_room(self):
+        for i in range(4):
+            self.logger.warning("record %d", i)
+        self.queue.get_nowait()
+        self.queue.get_nowait()
+        self.logger.warning("after")
+        report = self.queue.get_nowait()
+        self.assertEqual(report.levelno, logging.WARNING)
+        self.assertIn("2 log records were dropped", report.getMessage())
+        self.assertEqual(self.queue.get_nowait().getMessage(), "after")
+
+    def test_formatting_is_left_to_the_writer(self):
+        self.logger.warning("value %d", 42)
+        record = self.queue.get_nowait()
+        self.assertEqual(record.msg, "value %d")
+        self.assertEqual(record.args, (42,))
+
+class TestSetupLogging(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = logging.getLogger()
+        self.saved_handlers = list(self.root.handlers)
+        self.saved_level = self.root.level
+
+    def tearDown(self):
+        for handler in list(self.root.handlers):
+            if handler not in self.saved_handlers:
+                self.root.removeHandler(handler)
+        self.root.setLevel(self.saved_level)
+        self.temp_dir.cleanup()
+
+    def test_records_are_written_and_rotated_files_compressed(self):
+        log_file = os.path.join(self.temp_dir.name, "Logs", "test.log")
+        listener = log_pipeline.setup_logging(log_file, max_bytes=200, backup_count=2)
+        for i in range(20):
+            logging.info("line %d of the rotation test", i)
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+        with open(log_file) as f:
+            self.assertIn("line 19 of the rotation test", f.read())
+        rotated = log_file + ".1.gz"
+        self.assertTrue(os.path.exists(rotated))
+        with gzip.open(rotated, 'rt') as f:
+            self.assertIn("of the rotation test", f.read())
+        self.assertFalse(os.path.exists(log_file + ".3.gz"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import unittest
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import simulator
+import laser_access_control
+import multi_station
+import session_log
+from laser_access_control import LASER_RELAY_PIN_NUMBER, DONE_BUTTON_PIN_NUMBER, LASER_ON_GRACE_PERIOD_SECONDS, LASER_OFF_POLLING_RATE_SECONDS
+
+SMALL_LASER_RELAY_PIN = 11
+SMALL_LASER_LCD_ADDRESS = 0x26
+
+class TestMultiStation(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_multi_station.sqlite"
+        self.hal = simulator.simulated_hal()
+        self.clock = self.hal.clock_source
+        configs = multi_station.station_configs({'stations': [
+            {'name': "big laser"},
+            {'name': "small laser", 'relay_pin': SMALL_LASER_RELAY_PIN, 'done_button_pin': 13, 'led_pins': [36, 37, 38],
+             'reader': {'bus': 0, 'device': 1}, 'lcd_address': SMALL_LASER_LCD_ADDRESS},
+        ]})
+        self.controller = multi_station.multi_station(configs, self.hal, self.db_name)
+        self.big, self.small = self.controller.stations
+        self.big_reader = self.hal.readers[(0, 0)]
+        self.small_reader = self.hal.readers[(0, 1)]
+        self.card = simulator.sim_card(0x01020304, 123456789)
+        self.other_card = simulator.sim_card(0x05060708, 234567890)
+        self.controller.shared.db.add_user(self.card.uid_number(), 123456789, "Test User")
+        self.controller.shared.db.add_user(self.other_card.uid_number(), 234567890, "Other User")
+
+    def tearDown(self):
+        self.controller.shared.sessions.close()
+        self.controller.shared.db.close()
+        os.remove(self.db_name)
+
+    def run_until(self, until):
+        self.clock.call_at(until, self.controller.scheduler.stop)
+        self.controller.main()
+
+    def relay_changes(self, pin):
+        return [level for changed, level in self.hal.GPIO.output_history if changed == pin]
+
+    def check_relay(self, pin, level):
+        self.assertEqual(self.hal.GPIO.input(pin), level)
+
+    def test_stations_are_independent(self):
+        self.clock.call_at(1, self.small_reader.present, self.card)
+        self.run_until(5)
+        self.assertEqual(self.relay_changes(LASER_RELAY_PIN_NUMBER), [])
+        self.assertEqual(self.relay_changes(SMALL_LASER_RELAY_PIN), [1])
+        self.assertEqual(self.hal.lcd_bus.screen()[1].strip(), "Scan RamCard")
+        self.assertEqual(self.hal.lcd_bus.screen(SMALL_LASER_LCD_ADDRESS)[2].strip(), "AUTHORIZED")
+
+    def test_slow_read_does_not_delay_time_up(self):
+        # every read on the big laser's reader takes most of a reader transaction budget
+        self.big_reader.COMMAND_LATENCY_SECONDS = dict(self.big_reader.COMMAND_LATENCY_SECONDS, auth=0.03)
+        self.clock.call_at(1, self.small_reader.present, self.card)
+        self.clock.call_at(5, self.small_reader.remove)
+        self.clock.call_at(10, self.align_big_laser_poll)
+        self.run_until(5 + LASER_ON_GRACE_PERIOD_SECONDS + 2)
+        self.assertEqual(self.relay_changes(SMALL_LASER_RELAY_PIN), [1, 0])
+        # the big laser read the card once the small laser was off
+        self.assertEqual(self.relay_changes(LASER_RELAY_PIN_NUMBER), [1])
+
+    # a card shows up on the big laser, and its reader is polled, just before the small laser's time is up
+    def align_big_laser_poll(self):
+        deadline = self.small.card_missing_deadline
+        self.assertIsNotNone(deadline)
+        self.clock.call_at(deadline - 0.02, self.big_reader.present, self.other_card)
+        self.big.set_reader_polling_rate(LASER_OFF_POLLING_RATE_SECONDS, delay=deadline - 0.01 - self.clock.monotonic())
+        self.clock.call_at(deadline + 0.005, self.check_relay, SMALL_LASER_RELAY_PIN, 0)
+
+    def test_done_button_cuts_relay_during_slow_read(self):
+        # the main loop spends most of its time waiting on the big laser's reader
+        self.big_reader.COMMAND_LATENCY_SECONDS = dict(self.big_reader.COMMAND_LATENCY_SECONDS, request_no_card=0.5)
+        command = self.big_reader._command
+        self.big_reading = False
+        def slow_command(name):
+            self.big_reading = True
+            command(name)
+            self.big_reading = False
+        self.big_reader._command = slow_command
+        self.clock.call_at(1, self.small_reader.present, self.card)
+        self.clock.call_at(5, self.press_small_done_button)
+        self.clock.call_at(5.5, self.hal.GPIO.set_input, 13, 1)
+        self.run_until(8)
+        self.assertEqual(self.relay_changes(SMALL_LASER_RELAY_PIN), [1, 0])
+        self.assertNotEqual(self.small.state, self.small.LASER_ON_STATE)
+        self.assertEqual(self.relay_changes(LASER_RELAY_PIN_NUMBER), [])
+
+    def press_small_done_button(self):
+        self.assertTrue(self.big_reading)
+        self.check_relay(SMALL_LASER_RELAY_PIN, 1)
+        self.hal.GPIO.set_input(13, 0)
+        # cut by the interrupt, before the main loop is back from the big laser's reader
+        self.assertTrue(self.big_reading)
+        self.check_relay(SMALL_LASER_RELAY_PIN, 0)
+        self.assertEqual(self.small.relay_level, self.hal.GPIO.LOW)
+
+    def test_sessions_name_their_station(self):
+        self.clock.call_at(1, self.big_reader.present, self.card)
+        self.clock.call_at(1, self.small_reader.present, self.other_card)
+        self.run_until(5)
+        self.controller.cleanup()
+        sessions = session_log.read_sessions(self.db_name)
+        self.assertEqual(sorted((s['station'], s['name']) for s in sessions), [("big laser", "Test User"), ("small laser", "Other User")])
+
+    def test_other_station_works_during_add_user_mode(self):
+        admin_card = simulator.sim_card(0x0A0B0C0D, 345678901)
+        new_card = simulator.sim_card(0x11121314, 456789012)
+        self.controller.shared.db.add_admin(admin_card.uid_number(), 345678901, "Admin")
+        # the admin taps the big laser's reader with DONE held
+        self.clock.call_at(0.9, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 0)
+        self.clock.call_at(1, self.big_reader.present, admin_card)
+        self.clock.call_at(2, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 1)
+        self.clock.call_at(3, self.big_reader.remove)
+        self.clock.call_at(5, self.small_reader.present, self.card)
+        self.clock.call_at(6, self.big_reader.present, new_card)
+        self.clock.call_at(8, self.hal.keyboard.write, "New User")
+        self.run_until(10)
+        self.assertEqual(self.relay_changes(SMALL_LASER_RELAY_PIN), [1])
+        self.assertEqual(self.small.state, self.small.LASER_ON_STATE)
+        self.assertEqual(self.big.state, self.big.ADD_USER_STATE)
+        self.assertEqual(self.controller.shared.db.get_row_from_uid(new_card.uid_number()).get_name(), "New User")
+        self.assertEqual(self.hal.lcd_bus.screen()[0].strip(), "Added user")
+
+    def test_shared_wiring_is_refused(self):
+        configs = multi_station.station_configs({'stations': [{'name': "a"}, {'name': "b", 'relay_pin': 11}]})
+        with self.assertRaises(Exception):
+            multi_station.check_wiring(configs)
+
+if __name__ == '__main__':
+    unittest.main()
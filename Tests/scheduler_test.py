@@ -0,0 +1,91 @@
+import unittest
+import os
+import sys
+import threading
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import scheduler
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.calls = []
+        self.sched = scheduler.scheduler(clock=lambda: self.now, wait=self.advance)
+
+    # instead of sleeping, jump straight to the next deadline
+    def advance(self, timeout):
+        if timeout is None or self.now >= 10:
+            self.sched.stop()
+            return
+        self.now += timeout
+
+    def test_call_later_order(self):
+        self.sched.call_later(2, self.calls.append, "b")
+        self.sched.call_later(1, self.calls.append, "a")
+        self.sched.run()
+        self.assertEqual(self.calls, ["a", "b"])
+
+    def test_call_every(self):
+        self.sched.call_every(2.5, lambda: self.calls.append(self.now))
+        self.sched.run()
+        self.assertEqual(self.calls, [2.5, 5.0, 7.5, 10.0])
+
+    def test_due_tasks_run_by_priority(self):
+        self.sched.call_at(1, self.calls.append, "normal")
+        self.sched.call_at(1, self.calls.append, "safety", priority=scheduler.PRIORITY_SAFETY)
+        self.sched.run()
+        self.assertEqual(self.calls, ["safety", "normal"])
+
+    def test_budget_holds_task_back(self):
+        def slow_read():
+            self.calls.append(("read", self.now))
+            self.now += 0.5
+        def relay_off():
+            self.calls.append(("relay off", self.now))
+        self.sched.call_every(1, slow_read, budget=0.5)
+        self.sched.call_at(3.2, relay_off, priority=scheduler.PRIORITY_SAFETY)
+        self.sched.run()
+        # the read due at 3 would still be running at 3.2, it waits for the relay
+        self.assertEqual(self.calls[:4], [("read", 1), ("read", 2), ("relay off", 3.2), ("read", 3.2)])
+        # and the reads stay on their grid afterwards
+        self.assertEqual(self.calls[4], ("read", 4))
+
+    def test_call_every_skips_missed_ticks(self):
+        def slow():
+            self.calls.append(self.now)
+            self.now += 2.5
+        self.sched.call_every(1, slow)
+        self.sched.run()
+        # ticks at 2 and 3 are missed, the late tick runs once and the grid resumes
+        self.assertEqual(self.calls, [1, 3.5, 6, 8.5])
+
+    def test_cancel(self):
+        cancelled = self.sched.call_later(1, self.calls.append, "a")
+        cancelled.cancel()
+        self.sched.run()
+        self.assertEqual(self.calls, [])
+
+    def test_idle_blocks_until_deadline(self):
+        waits = []
+        sched = scheduler.scheduler(clock=lambda: self.now, wait=lambda timeout: (waits.append(timeout), sched.stop()))
+        sched.call_later(5, self.calls.append, "a")
+        sched.run()
+        self.assertEqual(waits, [5])
+
+    def test_call_soon_threadsafe_wakes_loop(self):
+        sched = scheduler.scheduler()
+        sched.call_later(60, self.calls.append, "late")
+        thread = threading.Timer(0.05, sched.call_soon_threadsafe, [sched.stop])
+        thread.start()
+        sched.run()
+        thread.join()
+        self.assertEqual(self.calls, [])
+
+    def test_call_soon_from_signal_runs_on_next_wakeup(self):
+        self.sched.call_soon_from_signal(self.calls.append, "signal")
+        self.assertFalse(self.sched._wakeup.is_set())
+        self.sched.call_later(1, self.calls.append, "a")
+        self.sched.run()
+        self.assertEqual(self.calls, ["signal", "a"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+import os
+import sqlite3
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db_interface
+import session_log
+
+class TestLaserSession(unittest.TestCase):
+    def test_card_missing_intervals(self):
+        session = session_log.laser_session(1, 123456789, "Test User", 100)
+        session.card_missing(110)
+        session.card_missing(111)
+        session.card_returned(115)
+        session.card_returned(116)
+        session.card_missing(120)
+        session.finish(140, session_log.END_TIME_UP)
+        data = session.to_dict()
+        self.assertEqual(data['card_missing'], [[110, 115], [120, 140]])
+        self.assertEqual((data['start'], data['end'], data['end_reason']), (100, 140, "TIME UP"))
+
+class TestSessionRecorder(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_session_log.sqlite"
+        db_interface.db_interface(self.db_name).close()
+        # long enough that nothing is written unless flush() is called
+        self.recorder = session_log.session_recorder(self.db_name, flush_interval=60)
+
+    def tearDown(self):
+        self.recorder.close()
+        os.remove(self.db_name)
+
+    def session(self, uid):
+        session = session_log.laser_session(uid, 123456789, "Test User", 100)
+        session.finish(200, session_log.END_DONE)
+        return session
+
+    def laser_log_count(self):
+        db = sqlite3.connect(self.db_name)
+        count = db.execute("SELECT COUNT(*) FROM laser_log").fetchone()[0]
+        db.close()
+        return count
+
+    def test_sessions_are_batched(self):
+        for uid in range(3):
+            self.recorder.record(self.session(uid))
+        self.assertEqual(self.laser_log_count(), 0)
+        self.recorder.flush()
+        self.assertEqual([s['uid'] for s in session_log.read_sessions(self.db_name)], [0, 1, 2])
+        self.assertEqual(self.recorder.recorded, 3)
+
+    def test_end_completes_the_start_record(self):
+        session = session_log.laser_session(0, 123456789, "Test User", 100)
+        self.recorder.record(session)
+        self.recorder.flush()
+        self.assertEqual([(s['start'], s['end']) for s in session_log.read_sessions(self.db_name)], [(100, None)])
+        session.finish(200, session_log.END_DONE)
+        self.recorder.record(session)
+        self.recorder.flush()
+        self.assertEqual([(s['start'], s['end']) for s in session_log.read_sessions(self.db_name)], [(100, 200)])
+        self.assertEqual(self.laser_log_count(), 1)
+
+    def test_start_and_end_in_one_batch_are_one_row(self):
+        session = session_log.laser_session(0, 123456789, "Test User", 100)
+        self.recorder.record(session)
+        session.finish(200, session_log.END_DONE)
+        self.recorder.record(session)
+        self.recorder.flush()
+        self.assertEqual([s['end_reason'] for s in session_log.read_sessions(self.db_name)], [session_log.END_DONE])
+
+    def test_full_batch_is_written(self):
+        self.recorder.max_batch_size = 2
+        self.recorder.record(self.session(0))
+        self.recorder.record(self.session(1))
+        # written without waiting for the flush interval
+        deadline = time.monotonic() + 5
+        while self.laser_log_count() < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.laser_log_count(), 2)
+
+    def test_close_writes_the_rest(self):
+        self.recorder.record(self.session(0))
+        self.recorder.close()
+        self.assertEqual(self.laser_log_count(), 1)
+
+    def test_unwritable_sessions_are_capped_and_counted(self):
+        self.recorder.close()
+        db = sqlite3.connect(self.db_name)
+        db.execute("DROP TABLE laser_log")
+        db.close()
+        self.recorder = session_log.session_recorder(self.db_name, flush_interval=60, max_batch_size=2, max_retained=3)
+        for uid in range(5):
+            self.recorder.record(self.session(uid))
+        self.recorder.flush()
+        # one failed write for the full batch, then one for the flush, not one per session
+        self.assertEqual(self.recorder.write_errors, 2)
+        self.assertEqual(self.recorder.dropped, 2)
+        self.recorder.close()
+        self.assertEqual(self.recorder.dropped, 5)
+        db = sqlite3.connect(self.db_name)
+        db.execute("CREATE TABLE laser_log (timestamp INTEGER, action TEXT, data TEXT)")
+        db.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,284 @@
+import unittest
+import os
+import sys
+import sqlite3
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import simulator
+import laser_access_control
+import session_log
+from laser_access_control import LASER_RELAY_PIN_NUMBER, DONE_BUTTON_PIN_NUMBER, LASER_ON_GRACE_PERIOD_SECONDS
+
+class TestSimulatedStation(unittest.TestCase):
+    def setUp(self):
+        self.db_name = "test_simulator.sqlite"
+        self.hal = simulator.simulated_hal()
+        self.clock = self.hal.clock_source
+        self.controller = laser_access_control.laser_access_control(self.hal, self.db_name)
+        self.card = simulator.sim_card(0x01020304, 123456789)
+        self.controller.db.add_user(self.card.uid_number(), 123456789, "Test User")
+        self.unknown_card = simulator.sim_card(0x0A0B0C0D, 987654321)
+
+    def tearDown(self):
+        self.controller.sessions.close()
+        self.controller.db.close()
+        os.remove(self.db_name)
+
+    def relay_changes(self):
+        return [level for pin, level in self.hal.GPIO.output_history if pin == LASER_RELAY_PIN_NUMBER]
+
+    def test_idle_screen(self):
+        simulator.run(self.controller, until=5)
+        self.assertEqual(self.hal.lcd_bus.screen()[1].strip(), "Scan RamCard")
+        self.assertEqual(self.relay_changes(), [])
+
+    def test_authorized_tap_turns_laser_on(self):
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        simulator.run(self.controller, until=10)
+        self.assertEqual(self.relay_changes(), [1])
+        screen = self.hal.lcd_bus.screen()
+        self.assertEqual(screen[1].strip(), "Test User")
+        self.assertEqual(screen[2].strip(), "AUTHORIZED")
+
+    def test_removed_card_turns_laser_off_after_grace_period(self):
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        self.clock.call_at(5, self.hal.reader.remove)
+        self.clock.call_at(5 + LASER_ON_GRACE_PERIOD_SECONDS - 1, self.check_relay, 1)
+        self.clock.call_at(5 + LASER_ON_GRACE_PERIOD_SECONDS + 1, self.check_relay, 0)
+        simulator.run(self.controller, until=60)
+        self.assertEqual(self.relay_changes(), [1, 0])
+
+    def check_relay(self, level):
+        self.assertEqual(self.hal.GPIO.input(LASER_RELAY_PIN_NUMBER), level)
+
+    def test_done_button_turns_laser_off(self):
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        self.clock.call_at(3, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 0)
+        self.clock.call_at(3.001, self.check_relay, 0)
+        simulator.run(self.controller, until=4)
+        self.assertEqual(self.relay_changes(), [1, 0])
+
+    def recorded_sessions(self):
+        self.controller.sessions.flush()
+        return session_log.read_sessions(self.db_name)
+
+    def test_session_is_recorded(self):
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        self.clock.call_at(5, self.hal.reader.remove)
+        self.clock.call_at(10, self.hal.reader.present, self.card)
+        self.clock.call_at(20, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 0)
+        simulator.run(self.controller, until=21)
+        sessions = self.recorded_sessions()
+        self.assertEqual(len(sessions), 1)
+        session = sessions[0]
+        self.assertEqual((session['uid'], session['csu_id'], session['name']), (self.card.uid_number(), 123456789, "Test User"))
+        self.assertEqual(session['end_reason'], session_log.END_DONE)
+        # the wall clock at virtual time 0
+        started = self.hal.wall_clock() - self.clock.monotonic()
+        self.assertAlmostEqual(session['start'] - started, 1, delta=0.6)
+        self.assertAlmostEqual(session['end'] - started, 20, delta=0.6)
+        self.assertEqual(len(session['card_missing']), 1)
+        missing_from, missing_to = session['card_missing'][0]
+        self.assertAlmostEqual(missing_from - started, 5, delta=0.5)
+        self.assertAlmostEqual(missing_to - started, 10, delta=0.5)
+
+    def test_session_start_is_logged_while_laser_is_on(self):
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        simulator.run(self.controller, until=5)
+        sessions = self.recorded_sessions()
+        self.assertEqual([(s['name'], s['end']) for s in sessions], [("Test User", None)])
+
+    def test_time_up_session(self):
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        self.clock.call_at(5, self.hal.reader.remove)
+        simulator.run(self.controller, until=60)
+        sessions = self.recorded_sessions()
+        self.assertEqual([s['end_reason'] for s in sessions], [session_log.END_TIME_UP])
+
+    def test_expired_users_are_archived_when_idle(self):
+        self.controller.db._db.execute("INSERT INTO users VALUES (1, 1, 'Expired User', 0, 1000)")
+        self.controller.db._db.commit()
+        # the laser is in use when the first sweep is due
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        self.clock.call_at(laser_access_control.EXPIRY_SWEEP_INTERVAL_SECONDS + 1, self.check_archived, False)
+        self.clock.call_at(laser_access_control.EXPIRY_SWEEP_INTERVAL_SECONDS + 2, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 0)
+        self.clock.call_at(laser_access_control.EXPIRY_SWEEP_INTERVAL_SECONDS + 3, self.hal.reader.remove)
+        simulator.run(self.controller, until=2 * laser_access_control.EXPIRY_SWEEP_INTERVAL_SECONDS + 1)
+        self.check_archived(True)
+
+    def check_archived(self, archived):
+        self.assertEqual(self.controller.db.get_archived_user(1) is not None, archived)
+
+    def test_expiry_sweep_retries_soon_when_database_is_busy(self):
+        self.controller.db._db.execute("INSERT INTO users VALUES (1, 1, 'Expired User', 0, 1000)")
+        self.controller.db._db.commit()
+        writer = sqlite3.connect(self.db_name)
+        writer.execute("BEGIN IMMEDIATE")
+        sweep = laser_access_control.EXPIRY_SWEEP_INTERVAL_SECONDS
+        self.clock.call_at(sweep + 1, self.check_archived, False)
+        self.clock.call_at(sweep + 2, writer.commit)
+        simulator.run(self.controller, until=sweep + laser_access_control.EXPIRY_SWEEP_RETRY_SECONDS + 1)
+        writer.close()
+        self.check_archived(True)
+
+    def test_unknown_card(self):
+        self.clock.call_at(1, self.hal.reader.present, self.unknown_card)
+        simulator.run(self.controller, until=2)
+        self.assertEqual(self.relay_changes(), [])
+        self.assertEqual(self.hal.lcd_bus.screen()[2].strip(), "Not Recognized")
+
+    def test_unknown_card_is_read_once(self):
+        self.clock.call_at(1, self.hal.reader.present, self.unknown_card)
+        simulator.run(self.controller, until=20)
+        self.assertEqual(self.hal.lcd_bus.screen()[2].strip(), "Not Recognized")
+        self.assertEqual(self.hal.reader.command_counts['auth'], 1)
+        stats = self.controller.cache_stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertGreater(stats['negative_hits'], 0)
+
+    def test_enrolled_card_is_no_longer_unknown(self):
+        self.clock.call_at(1, self.hal.reader.present, self.unknown_card)
+        self.clock.call_at(2, self.hal.reader.remove)
+        self.clock.call_at(3, self.controller.db.add_user, self.unknown_card.uid_number(), 987654321, "New User")
+        self.clock.call_at(4, self.hal.reader.present, self.unknown_card)
+        simulator.run(self.controller, until=6)
+        self.assertEqual(self.relay_changes(), [1])
+
+    def test_foreign_card_is_not_authenticated_on_every_poll(self):
+        # the serial path authenticates before it looks the card up, the failed read
+        # looks it up and the card is then known not to be enrolled
+        self.controller.pipelined = False
+        foreign_card = simulator.sim_card(0x11223344, 0, key=[0xFF] * 6)
+        self.clock.call_at(1, self.hal.reader.present, foreign_card)
+        simulator.run(self.controller, until=20)
+        self.assertEqual(self.hal.reader.command_counts['auth'], 1)
+        self.assertEqual(self.hal.lcd_bus.screen()[2].strip(), "Not Recognized")
+
+    def test_unknown_card_failing_twice_is_remembered(self):
+        foreign_card = simulator.sim_card(0x11223344, 0, key=[0xFF] * 6)
+        uid = bytes(foreign_card.uid_with_bcc)
+        self.assertFalse(self.controller.authenticate_card(list(uid)))
+        self.assertFalse(self.controller.authenticate_card(list(uid)))
+        self.assertFalse(self.controller.authenticate_card(list(uid)))
+        self.assertEqual(self.controller.cache_stats()['auth_failure_hits'], 1)
+
+    def test_pipelined_foreign_card_is_not_recognized(self):
+        foreign_card = simulator.sim_card(0x11223344, 0, key=[0xFF] * 6)
+        self.clock.call_at(1, self.hal.reader.present, foreign_card)
+        simulator.run(self.controller, until=20)
+        self.assertEqual(self.hal.lcd_bus.screen()[2].strip(), "Not Recognized")
+        self.assertEqual(self.hal.reader.command_counts['auth'], 1)
+
+    # fail the next few authentications, as for a card pulled away during the read
+    def fail_authentications(self, failures):
+        auth = self.hal.reader.MFRC522_Auth
+        self.auth_failures_left = failures
+        def failing_auth(*args):
+            if self.auth_failures_left:
+                self.auth_failures_left -= 1
+                return self.hal.reader.MI_ERR
+            return auth(*args)
+        self.hal.reader.MFRC522_Auth = failing_auth
+
+    def test_enrolled_card_is_retried_after_failed_reads(self):
+        for pipelined in (True, False):
+            with self.subTest(pipelined=pipelined):
+                self.controller.pipelined = pipelined
+                self.fail_authentications(3)
+                self.clock.call_at(self.clock.monotonic() + 1, self.hal.reader.present, self.card)
+                simulator.run(self.controller, until=self.clock.monotonic() + 5)
+                self.assertEqual(self.relay_changes(), [1])
+                self.assertEqual(self.controller.cache_stats()['auth_failure_hits'], 0)
+                self.controller.stop_laser(session_log.END_DONE)
+                self.controller.enter_idle()
+                self.hal.reader.remove()
+                self.controller.end_card_session()
+                self.hal.GPIO.output_history.clear()
+
+    # the relay level at every block read
+    def trace_block_reads(self):
+        relay_at_read = []
+        read = self.hal.reader.MFRC522_Read
+        def traced_read(block_addr):
+            relay_at_read.append(self.hal.GPIO.input(LASER_RELAY_PIN_NUMBER))
+            return read(block_addr)
+        self.hal.reader.MFRC522_Read = traced_read
+        return relay_at_read
+
+    def test_pipelined_tap_switches_relay_before_block_read(self):
+        relay_at_read = self.trace_block_reads()
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        simulator.run(self.controller, until=5)
+        self.assertEqual(relay_at_read, [1])
+        self.assertEqual(self.controller.session.csu_id, 123456789)
+
+    def test_serial_tap_reads_block_before_relay(self):
+        self.controller.pipelined = False
+        relay_at_read = self.trace_block_reads()
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        simulator.run(self.controller, until=5)
+        self.assertEqual(relay_at_read, [0])
+        self.assertEqual(self.relay_changes(), [1])
+
+    def test_sector_is_read_once_per_presence(self):
+        # DONE is pressed but the card stays on the reader, so it is tapped again after the message
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        self.clock.call_at(3, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 0)
+        self.clock.call_at(3.5, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 1)
+        simulator.run(self.controller, until=12)
+        self.assertEqual(self.relay_changes(), [1, 0, 1])
+        self.assertEqual(self.hal.reader.command_counts['auth'], 1)
+        self.assertEqual(self.controller.cache_stats()['card_session_hits'], 1)
+
+    def test_card_session_ends_when_card_leaves(self):
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        self.clock.call_at(3, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 0)
+        self.clock.call_at(3.5, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 1)
+        self.clock.call_at(4, self.hal.reader.remove)
+        self.clock.call_at(10, self.hal.reader.present, self.card)
+        simulator.run(self.controller, until=12)
+        self.assertEqual(self.relay_changes(), [1, 0, 1])
+        self.assertEqual(self.hal.reader.command_counts['auth'], 2)
+
+    def test_presence_check_skips_sector_read(self):
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        simulator.run(self.controller, until=30)
+        self.assertEqual(self.hal.reader.command_counts['auth'], 1)
+
+    def test_presence_check_sends_one_request_per_tick(self):
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        counts = {}
+        self.clock.call_at(10.1, lambda: counts.update(self.hal.reader.command_counts))
+        simulator.run(self.controller, until=20.1)
+        ticks = 10 / laser_access_control.LASER_ON_POLLING_RATE_SECONDS
+        self.assertEqual(self.relay_changes(), [1])
+        self.assertEqual(self.hal.reader.command_counts['request'] - counts['request'], ticks)
+        self.assertEqual(self.hal.reader.command_counts['halt'] - counts['halt'], ticks)
+
+    def test_done_leaves_add_user_mode(self):
+        admin_card = simulator.sim_card(0x0A0B0C0D, 345678901)
+        self.controller.db.add_admin(admin_card.uid_number(), 345678901, "Admin")
+        self.clock.call_at(0.9, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 0)
+        self.clock.call_at(1, self.hal.reader.present, admin_card)
+        self.clock.call_at(2, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 1)
+        self.clock.call_at(3, self.hal.reader.remove)
+        self.clock.call_at(6, self.check_state, laser_access_control.laser_access_control.ADD_USER_STATE)
+        self.clock.call_at(6, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 0)
+        self.clock.call_at(6.5, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 1)
+        simulator.run(self.controller, until=10)
+        self.check_state(laser_access_control.laser_access_control.IDLE_STATE)
+        self.assertEqual(self.hal.lcd_bus.screen()[1].strip(), "Scan RamCard")
+
+    def check_state(self, state):
+        self.assertEqual(self.controller.state, state)
+
+    def test_tap_is_traced(self):
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        simulator.run(self.controller, until=5)
+        summary = self.controller.tracer.summary()
+        for stage in ("reader.request", "reader.auth", "db.lookup", "lcd.write", "led", "relay", "tap.scan_to_relay", "recheck"):
+            self.assertIn(stage, summary)
+        self.assertEqual(summary["tap.scan_to_relay"]["count"], 1)
+        self.assertGreater(summary["tap.scan_to_relay"]["p50"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+# Benchmark the tap path, serial against pipelined
+#
+# A station is built on the simulator with a wall clock, so every reader
+# command takes its sim_mfrc522 latency for real while the database lookup,
+# the LCD and the GPIO run as they do on the station. Each tap presents an
+# enrolled card and runs one idle poll, which turns the laser on; the laser is
+# then turned off and the card removed, so the next tap reads the card again.
+#
+#  serial     authenticate, read the block, look the user up, switch the relay
+#  pipelined  look the user up on the lookup thread while the card is
+#             authenticated, switch the relay, then read the block
+#             (see laser_access_control.pipelined_tap)
+#
+# Taps are timed with the user lookup cache bypassed (cold) and warm, and the
+# results written as JSON in the format of db_benchmark.py:
+#  python3 tap_benchmark.py --roster-size 100000 --output taps.json
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import laser_access_control
+import session_log
+import simulator
+from db_benchmark import generate_roster, latency_stats
+
+CARD_UID = 0x01020304
+CARD_CSU_ID = 123456789
+TAP_STAGES = ("tap.scan_to_decision", "tap.scan_to_relay", "db.lookup", "reader.auth", "reader.read")
+
+# the clock interface of simulator.virtual_clock, on real time
+class wall_clock:
+
+    monotonic = staticmethod(time.monotonic)
+    monotonic_ns = staticmethod(time.monotonic_ns)
+    sleep = staticmethod(time.sleep)
+    wait = None
+
+def tap(controller, reader, card):
+    reader.present(card)
+    controller.poll_reader_idle()
+    if controller.state != controller.LASER_ON_STATE:
+        raise Exception("The benchmark card was not authorized")
+    controller.stop_laser(session_log.END_DONE)
+    controller.enter_idle()
+    reader.remove()
+    controller.end_card_session()
+
+def benchmark_taps(db_name, pipelined, taps, cold):
+    # the clock is time.monotonic, started makes the station's wall clock time.time
+    station_hal = simulator.simulated_hal(wall_clock(), started=time.time() - time.monotonic())
+    controller = laser_access_control.laser_access_control(station_hal, db_name)
+    controller.pipelined = pipelined
+    card = simulator.sim_card(CARD_UID, CARD_CSU_ID)
+    try:
+        for _ in range(taps):
+            if cold:
+                controller.db._invalidate_cache()
+            tap(controller, station_hal.reader, card)
+        durations = {stage: [] for stage in TAP_STAGES}
+        for span in controller.tracer.spans:
+            if span.stage in durations:
+                durations[span.stage].append(span.duration_ns)
+        return {stage: latency_stats(samples) for stage, samples in durations.items() if samples}
+    finally:
+        controller.scheduler.stop()
+        controller.close_station()
+        controller.shared.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark serial and pipelined taps on the simulator")
+    parser.add_argument('--roster-size', type=int, default=100000, help="users in the generated database")
+    parser.add_argument('--taps', type=int, default=200, help="taps timed per case")
+    parser.add_argument('--db-dir', default=None, help="where to put the generated database (default: a temporary directory)")
+    parser.add_argument('--output', default='tap_benchmark.json', help="JSON results file")
+    args = parser.parse_args()
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'roster_size': args.roster_size,
+        'reader_latency_seconds': simulator.sim_mfrc522.COMMAND_LATENCY_SECONDS,
+        'results': {},
+    }
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_name = os.path.join(args.db_dir or temp_dir, "tap_benchmark.db")
+        if os.path.exists(db_name):
+            os.remove(db_name)
+        print("Generating %d users..." % args.roster_size)
+        generate_roster(db_name, args.roster_size)
+        with laser_access_control.db_interface.db_interface(db_name) as db:
+            db.add_user(simulator.sim_card(CARD_UID, CARD_CSU_ID).uid_number(), CARD_CSU_ID, "Benchmark User")
+
+        for cache in ("cold", "warm"):
+            for path, pipelined in (("serial", False), ("pipelined", True)):
+                name = "%s_%s" % (path, cache)
+                print("Benchmarking %s taps..." % name)
+                result = benchmark_taps(db_name, pipelined, args.taps, cache == "cold")
+                report['results'][name] = result
+                for stage, stats in result.items():
+                    print("  %-22s p50 %9.1f us  p99 %9.1f us" % (stage, stats['p50_us'], stats['p99_us']))
+        os.remove(db_name)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to %s" % args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import unittest
+import json
+import os
+import sys
+import tempfile
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import simulator
+import laser_access_control
+import trace_replay
+from laser_access_control import DONE_BUTTON_PIN_NUMBER, LASER_ON_GRACE_PERIOD_SECONDS
+
+# the wall clock time the traces are recorded at, long before the tests run
+RECORDED_AT = 1700000000
+
+class TestTraceReplay(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_name = os.path.join(self.temp_dir.name, "station.db")
+        self.trace_path = os.path.join(self.temp_dir.name, "station.trace")
+        self.hal = simulator.simulated_hal(started=RECORDED_AT)
+        self.clock = self.hal.clock_source
+        self.recorder = trace_replay.trace_recorder(self.trace_path, self.hal.clock, self.hal.wall_clock)
+        self.controller = laser_access_control.laser_access_control(self.recorder.wrap(self.hal), self.db_name)
+        self.card = simulator.sim_card(0x01020304, 123456789)
+        self.controller.db.add_user(self.card.uid_number(), 123456789, "Test User")
+
+    def tearDown(self):
+        self.recorder.close()
+        self.temp_dir.cleanup()
+
+    def record(self, until):
+        simulator.run(self.controller, until=until)
+        self.controller.cleanup()
+        self.recorder.close()
+
+    def test_recorded_day_replays_the_same(self):
+        foreign_card = simulator.sim_card(0x11223344, 0, key=[0xFF] * 6)
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        self.clock.call_at(30, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 0)
+        self.clock.call_at(30.5, self.hal.GPIO.set_input, DONE_BUTTON_PIN_NUMBER, 1)
+        self.clock.call_at(32, self.hal.reader.remove)
+        self.clock.call_at(40, self.hal.reader.present, foreign_card)
+        self.clock.call_at(45, self.hal.reader.remove)
+        self.clock.call_at(50, self.hal.reader.present, self.card)
+        self.clock.call_at(60, self.hal.reader.remove)
+        self.record(until=120)
+
+        header, events = trace_replay.read_trace(self.trace_path)
+        self.assertEqual(header['trace'], trace_replay.TRACE_VERSION)
+        self.assertEqual([event.kind for event in events if event.kind in ("card", "remove", "button")],
+                         ["card", "button", "button", "remove", "card", "remove", "card", "remove"])
+
+        report = trace_replay.replay(self.trace_path, self.db_name).to_dict()
+        relay = report['relay']
+        self.assertEqual([level for _, level in relay['recorded']], [1, 0, 1, 0])
+        self.assertEqual([level for _, level in relay['replayed']], [1, 0, 1, 0])
+        self.assertLess(relay['drift_seconds'], 0.01)
+        self.assertAlmostEqual(relay['replayed_on_seconds'], 29 + 10 + LASER_ON_GRACE_PERIOD_SECONDS, delta=1)
+        self.assertEqual(report['latency_ms']['tap.scan_to_relay']['count'], 2)
+        self.assertGreater(report['lcd']['i2c_transactions'], 0)
+
+    def test_cards_keep_what_was_read(self):
+        foreign_card = simulator.sim_card(0x11223344, 0, key=[0xFF] * 6)
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        self.clock.call_at(5, self.hal.reader.present, foreign_card)
+        self.record(until=10)
+        _, events = trace_replay.read_trace(self.trace_path)
+        cards = trace_replay.trace_cards(events)
+        self.assertEqual(cards[bytes(self.card.uid_with_bcc).hex()].block4, self.card.block4)
+        self.assertEqual(cards[bytes(foreign_card.uid_with_bcc).hex()].key, [0xFF] * 6)
+
+    def test_users_expire_as_they_did_when_recorded(self):
+        # valid while the trace was recorded, expired long before the replay
+        self.controller.db._db.execute("UPDATE users SET expiration_date = ?", [RECORDED_AT + 30])
+        self.controller.db._db.commit()
+        self.clock.call_at(1, self.hal.reader.present, self.card)
+        self.clock.call_at(5, self.hal.reader.remove)
+        self.record(until=60)
+        report = trace_replay.replay(self.trace_path, self.db_name).to_dict()
+        self.assertEqual([level for _, level in report['relay']['recorded']], [1, 0])
+        self.assertEqual([level for _, level in report['relay']['replayed']], [1, 0])
+
+    def test_restart_does_not_overwrite_the_trace(self):
+        self.record(until=1)
+        restarted = trace_replay.trace_recorder(self.trace_path, self.hal.clock, self.hal.wall_clock)
+        restarted.close()
+        self.assertEqual(self.recorder.path, self.trace_path)
+        self.assertEqual(restarted.path, os.path.join(self.temp_dir.name, "station.1.trace"))
+        header, _ = trace_replay.read_trace(self.trace_path)
+        self.assertEqual(header['started'], RECORDED_AT)
+
+    def test_truncated_trace_is_read(self):
+        with open(self.trace_path, 'w') as f:
+            f.write(json.dumps({'trace': trace_replay.TRACE_VERSION, 'started': 0}) + '\n')
+            f.write('[1000,"card","0102030404"]\n[2000,"rem')
+        _, events = trace_replay.read_trace(self.trace_path)
+        self.assertEqual(events, [trace_replay.trace_event(1.0, "card", ["0102030404"])])
+
+if __name__ == "__main__":
+    unittest.main()
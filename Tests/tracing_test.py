@@ -0,0 +1,39 @@
+import unittest
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import tracing
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.tracer = tracing.tracer(clock_ns=lambda: self.now, capacity=10, samples_per_stage=100)
+
+    def test_span(self):
+        with self.tracer.span("stage"):
+            self.now += 500
+        self.assertEqual(list(self.tracer.spans), [tracing.span_record("stage", 0, 500)])
+
+    def test_percentiles(self):
+        for duration in range(1, 101):
+            self.tracer.record("stage", 0, duration)
+        stats = self.tracer.summary()["stage"]
+        self.assertEqual((stats['p50'], stats['p95'], stats['p99'], stats['max']), (50, 95, 99, 100))
+        self.assertEqual(stats['count'], 100)
+
+    def test_ring_buffer_is_bounded(self):
+        for i in range(25):
+            self.tracer.record("stage", i, 1)
+        self.assertEqual(len(self.tracer.spans), 10)
+        self.assertEqual(self.tracer.spans[0].start_ns, 15)
+        self.assertEqual(self.tracer.summary()["stage"]["count"], 25)
+
+    def test_wrap(self):
+        def slow(x):
+            self.now += 7
+            return x * 2
+        self.assertEqual(self.tracer.wrap("slow", slow)(3), 6)
+        self.assertEqual(self.tracer.summary()["slow"]["max"], 7)
+
+if __name__ == "__main__":
+    unittest.main()
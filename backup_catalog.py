@@ -0,0 +1,138 @@
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import zlib
+
+# Catalog of the database backups in a backup directory
+#
+# db_backup.py records every snapshot it writes in MANIFEST_NAME, oldest first:
+#  {'file': 'prod-2023-11-06.db.gz', 'timestamp': 1699257600, 'size': 12345,
+#   'sha256': '...', 'users': 250, 'integrity': 'ok'}
+#    file       name of the backup in the backup directory
+#    timestamp  when the snapshot was taken (seconds since the epoch)
+#    size       size of the backup file in bytes
+#    sha256     hash of the uncompressed database
+#    users      rows in the users table
+#    integrity  INTEGRITY_OK when written, INTEGRITY_CORRUPT once a restore found it damaged
+#
+# restore_latest() uses the catalog to pick the newest verified snapshot without
+# listing or stat'ing the directory, checks it again, and moves on to older
+# entries when it is damaged.
+
+MANIFEST_NAME = 'catalog.json'
+COMPRESSED_SUFFIX = '.gz'
+INTEGRITY_OK = 'ok'
+INTEGRITY_CORRUPT = 'corrupt'
+
+def manifest_path(backup_dir):
+  return os.path.join(backup_dir, MANIFEST_NAME)
+
+# write a file so that readers see either the old or the new contents, never part of it
+def write_atomic(path, data):
+  partial = path + '.partial'
+  with open(partial, 'wb') as f:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(partial, path)
+
+# the entries of the catalog, oldest first, or None if the directory has no catalog
+def load(backup_dir):
+  try:
+    with open(manifest_path(backup_dir)) as f:
+      return json.load(f)['backups']
+  except FileNotFoundError:
+    return None
+  except (ValueError, KeyError) as e:
+    print("Backup catalog %s is unreadable: %s" % (manifest_path(backup_dir), e))
+    return None
+
+def save(backup_dir, entries):
+  data = json.dumps({'backups': entries}, indent=2).encode()
+  write_atomic(manifest_path(backup_dir), data)
+
+# add an entry, replacing the one for the same file if there is one
+def add_entry(backup_dir, entry):
+  entries = [e for e in (load(backup_dir) or []) if e['file'] != entry['file']]
+  entries.append(entry)
+  save(backup_dir, entries)
+
+def latest(backup_dir):
+  entries = load(backup_dir)
+  return entries[-1] if entries else None
+
+def read_backup(path):
+  if path.endswith(COMPRESSED_SUFFIX):
+    with gzip.open(path, 'rb') as f:
+      return f.read()
+  with open(path, 'rb') as f:
+    return f.read()
+
+# Older backup directories have no catalog, their .db files are tried newest first
+def _uncataloged_entries(backup_dir):
+  if not os.path.isdir(backup_dir):
+    return []
+  files = [f for f in os.listdir(backup_dir) if f.endswith('.db')]
+  files.sort(key=lambda f: os.path.getctime(os.path.join(backup_dir, f)))
+  return [{'file': f} for f in files]
+
+def _check_restored(path):
+  db = sqlite3.connect(path)
+  try:
+    if db.execute("PRAGMA quick_check").fetchall() != [('ok',)]:
+      return False
+    return db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'").fetchone() is not None
+  except sqlite3.DatabaseError:
+    return False
+  finally:
+    db.close()
+
+# Restore one backup over db_path, returns True if it was verified and restored
+def _restore(entry, db_path, backup_dir):
+  try:
+    data = read_backup(os.path.join(backup_dir, entry['file']))
+  except (OSError, EOFError, zlib.error) as e:
+    print("Backup %s cannot be read: %s" % (entry['file'], e))
+    return False
+  if 'sha256' in entry and hashlib.sha256(data).hexdigest() != entry['sha256']:
+    print("Backup %s does not match its checksum" % entry['file'])
+    return False
+
+  restoring = db_path + '.restore'
+  write_atomic(restoring, data)
+  if not _check_restored(restoring):
+    os.remove(restoring)
+    print("Backup %s failed its integrity check" % entry['file'])
+    return False
+
+  # a WAL or journal left from the lost database must not be applied to the restored one
+  for suffix in ('-wal', '-shm', '-journal'):
+    if os.path.exists(db_path + suffix):
+      os.remove(db_path + suffix)
+  os.replace(restoring, db_path)
+  return True
+
+# Replace db_path with the newest backup that passes verification
+# Entries that fail are marked corrupt in the catalog and skipped from then on
+# Returns the restored entry, or None if there was nothing usable to restore
+# The database must not be open while this runs
+def restore_latest(db_path, backup_dir):
+  entries = load(backup_dir)
+  cataloged = entries is not None
+  if not cataloged:
+    entries = _uncataloged_entries(backup_dir)
+
+  for entry in reversed(entries):
+    if entry.get('integrity', INTEGRITY_OK) != INTEGRITY_OK:
+      continue
+    if _restore(entry, db_path, backup_dir):
+      return entry
+    if cataloged:
+      entry['integrity'] = INTEGRITY_CORRUPT
+      try:
+        save(backup_dir, entries)
+      except OSError as e:
+        print("Could not update the backup catalog: %s" % e)
+  return None
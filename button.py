@@ -0,0 +1,174 @@
+import collections
+import threading
+import time
+
+# Edge triggered, debounced push button
+#
+# Instead of polling the pin, the button registers a GPIO edge callback and
+# turns edges into a queue of timestamped events:
+#  PRESS       the button went down
+#  HOLD        the button has been down for hold_seconds (sent while still held)
+#  RELEASE     the button came back up, duration is how long it was down
+#  LONG_PRESS  sent after RELEASE when the press lasted long_press_seconds or more
+#
+# Debouncing: the first edge after a quiet period is acted on right away, so a
+# press is reported within the GPIO callback latency. Edges in the following
+# debounce_seconds are contact bounce; they are ignored and the pin is read
+# again once it has settled, so the reported state always ends up matching it.
+#
+# Listeners are called from the GPIO callback thread. The controller uses them
+# to hand the events over to its scheduler.
+
+DEBOUNCE_SECONDS = 0.02
+HOLD_SECONDS = 1
+LONG_PRESS_SECONDS = 3
+MAX_QUEUED_EVENTS = 32
+# how often wait_for_press checks the button when it waits on a simulated clock
+SIMULATED_POLL_SECONDS = 0.01
+
+button_event = collections.namedtuple('button_event', ['kind', 'timestamp', 'duration'])
+
+class button:
+
+  PRESS = "PRESS"
+  HOLD = "HOLD"
+  RELEASE = "RELEASE"
+  LONG_PRESS = "LONG PRESS"
+
+  # gpio is the RPi.GPIO module (or fake_gpio.fake_gpio()), the pin must already be set up as an input
+  # active_low is True for a button wired between the pin and ground with a pull-up
+  # sleep blocks for a number of seconds on clock, it is only given when clock is
+  # simulated (edges then arrive while it sleeps, see wait_for_press)
+  def __init__(self, gpio, pin, active_low=True, debounce_seconds=DEBOUNCE_SECONDS,
+               hold_seconds=HOLD_SECONDS, long_press_seconds=LONG_PRESS_SECONDS, clock=time.monotonic, sleep=None):
+    self.gpio = gpio
+    self.pin = pin
+    self.active_low = active_low
+    self.debounce_seconds = debounce_seconds
+    self.hold_seconds = hold_seconds
+    self.long_press_seconds = long_press_seconds
+    self.clock = clock
+    self.sleep = sleep
+
+    self.events = collections.deque(maxlen=MAX_QUEUED_EVENTS)
+    self.press_count = 0
+    self._condition = threading.Condition()
+    self._listeners = []
+    self._settle_timer = None
+    self._hold_timer = None
+    self._last_change = float('-inf')
+    self._pressed = self._read()
+    self._pressed_at = self.clock() if self._pressed else None
+
+    gpio.add_event_detect(pin, gpio.BOTH, callback=self._edge)
+
+  def _read(self):
+    level = self.gpio.input(self.pin)
+    if self.active_low:
+      return level == self.gpio.LOW
+    return level == self.gpio.HIGH
+
+  # listener() is called with no arguments after new events are queued
+  def add_listener(self, listener):
+    self._listeners.append(listener)
+
+  def _notify(self):
+    for listener in self._listeners:
+      listener()
+
+  def _edge(self, channel):
+    now = self.clock()
+    with self._condition:
+      if now - self._last_change < self.debounce_seconds:
+        # contact bounce, check the pin again once it has settled
+        if self._settle_timer is None:
+          delay = self.debounce_seconds - (now - self._last_change)
+          self._settle_timer = threading.Timer(delay, self._settle)
+          self._settle_timer.daemon = True
+          self._settle_timer.start()
+        return
+      changed = self._update(self._read(), now)
+    if changed:
+      self._notify()
+
+  def _settle(self):
+    with self._condition:
+      self._settle_timer = None
+      changed = self._update(self._read(), self.clock())
+    if changed:
+      self._notify()
+
+  # record a debounced state change, the caller holds the condition lock
+  def _update(self, pressed, now):
+    if pressed == self._pressed:
+      return False
+    self._pressed = pressed
+    self._last_change = now
+
+    if pressed:
+      self._pressed_at = now
+      self.press_count += 1
+      self.events.append(button_event(self.PRESS, now, 0))
+      self._hold_timer = threading.Timer(self.hold_seconds, self._hold, [self.press_count])
+      self._hold_timer.daemon = True
+      self._hold_timer.start()
+    else:
+      duration = now - self._pressed_at
+      self.events.append(button_event(self.RELEASE, now, duration))
+      if duration >= self.long_press_seconds:
+        self.events.append(button_event(self.LONG_PRESS, now, duration))
+      if self._hold_timer:
+        self._hold_timer.cancel()
+        self._hold_timer = None
+
+    self._condition.notify_all()
+    return True
+
+  def _hold(self, press_number):
+    with self._condition:
+      if not self._pressed or press_number != self.press_count:
+        return
+      now = self.clock()
+      self.events.append(button_event(self.HOLD, now, now - self._pressed_at))
+    self._notify()
+
+  def is_pressed(self):
+    return self._pressed
+
+  # remove and return all queued events, oldest first
+  def get_events(self):
+    with self._condition:
+      events = list(self.events)
+      self.events.clear()
+    return events
+
+  # Block until the button is pressed, returns False if timeout seconds pass first.
+  # Returns True right away if the button is already held down.
+  def wait_for_press(self, timeout):
+    if self.sleep:
+      return self._poll_for_press(timeout)
+    deadline = time.monotonic() + timeout
+    with self._condition:
+      presses = self.press_count
+      while not self._pressed and self.press_count == presses:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          return False
+        self._condition.wait(remaining)
+    return True
+
+  def _poll_for_press(self, timeout):
+    deadline = self.clock() + timeout
+    presses = self.press_count
+    while not self._pressed and self.press_count == presses:
+      remaining = deadline - self.clock()
+      if remaining <= 0:
+        return False
+      self.sleep(min(remaining, SIMULATED_POLL_SECONDS))
+    return True
+
+  def close(self):
+    self.gpio.remove_event_detect(self.pin)
+    for timer in (self._settle_timer, self._hold_timer):
+      if timer:
+        timer.cancel()
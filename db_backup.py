@@ -1,19 +1,134 @@
-import shutil
-import os
+import argparse
 import datetime
+import gzip
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from urllib.request import pathname2url
+import backup_catalog
+import db_interface
 
-# This function will backup the database file to the backup directory
-# Backups are named with the current date
-# Example: backup_db('prod.db', '/home/pi/senior_design_FA23/Backups')
+# Online backups of the database
+#
+# The snapshot is taken with the SQLite backup API, PAGES_PER_STEP pages at a
+# time with a STEP_SLEEP_SECONDS pause in between, so the controller keeps
+# reading and writing prod.db while the backup runs and a write in the middle
+# of it can never produce a torn copy (the backup restarts instead).
+#
+# The snapshot is built in memory and checked with PRAGMA quick_check before
+# anything is written. Every backup is recorded in the directory's catalog
+# (see backup_catalog.py) with its SHA-256; when the database has not changed
+# since the last snapshot, nothing is written at all.
+#
+# Backups are named with the current date, with .gz added when compressed:
+#  backup_db('prod.db', '/home/pi/senior_design_FA23/Backups')
+#  -> /home/pi/senior_design_FA23/Backups/prod-2023-11-06.db
+#
 # Run periodically using cron
-# Example: 0 3 * * 1 /usr/bin/python3 /home/pi/senior_design_FA23/laser-access-control/db_backup.py
+# Example: 0 3 * * 1 /usr/bin/python3 /home/pi/senior_design_FA23/laser-access-control/db_backup.py --compress
 # This will run the backup every Monday at 3:00 am
 # Edit the crontab file with the command crontab -e
 
-def backup_db(db_file, backup_dir):
-    date_str = datetime.datetime.now().strftime('%Y-%m-%d')
-    base_name, ext = os.path.splitext(db_file)
-    backup_file = f"{backup_dir}/{base_name}-{date_str}{ext}"
-    shutil.copy(db_file, backup_file)
+PAGES_PER_STEP = 32
+STEP_SLEEP_SECONDS = 0.05
+
+# Copy the database into memory a few pages at a time
+# Returns the file contents and the number of rows in the users table
+def snapshot(db_file, pages_per_step=PAGES_PER_STEP, step_sleep=STEP_SLEEP_SECONDS):
+    if not os.path.exists(db_file):
+        raise Exception("Database %s does not exist" % db_file)
+
+    # the pause goes in the progress callback, which runs between steps while
+    # the backup holds no lock on the source
+    def pause(status, remaining, total):
+        if remaining and step_sleep:
+            time.sleep(step_sleep)
+
+    # opened read-only and as it is, without the station's connection profile,
+    # so taking a backup never changes the journal mode or pragmas of the source
+    source = sqlite3.connect("file:%s?mode=ro" % pathname2url(os.path.abspath(db_file)), uri=True)
+    # Connection.serialize() needs Python 3.11, older versions go through a temporary file
+    if hasattr(sqlite3.Connection, 'serialize'):
+        temp_dir = None
+        destination = sqlite3.connect(':memory:')
+    else:
+        temp_dir = tempfile.TemporaryDirectory()
+        destination = sqlite3.connect(os.path.join(temp_dir.name, 'snapshot.db'))
+    try:
+        source.backup(destination, pages=pages_per_step, progress=pause, sleep=step_sleep)
+        result = destination.execute("PRAGMA quick_check").fetchall()
+        if result != [('ok',)]:
+            raise Exception("Snapshot of %s failed quick_check: %s" % (db_file, result))
+        users = destination.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        if temp_dir is None:
+            data = bytearray(destination.serialize())
+        else:
+            destination.close()
+            with open(os.path.join(temp_dir.name, 'snapshot.db'), 'rb') as f:
+                data = bytearray(f.read())
+    finally:
+        source.close()
+        destination.close()
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    # The pages are copied as they are, so the header still marks the file as WAL
+    # (bytes 18 and 19 of the header, 2 for WAL and 1 for a rollback journal).
+    # Mark the snapshot as a plain rollback journal file so it is one self-contained file.
+    data[18] = 1
+    data[19] = 1
+    return bytes(data), users
+
+# Back up db_file into backup_dir
+# Returns (path of the backup, True if a new file was written); when the database
+# is unchanged since the last backup the path of that backup is returned instead
+def backup_db(db_file, backup_dir, compress=False, pages_per_step=PAGES_PER_STEP, step_sleep=STEP_SLEEP_SECONDS):
+    data, users = snapshot(db_file, pages_per_step, step_sleep)
+    digest = hashlib.sha256(data).hexdigest()
+
+    os.makedirs(backup_dir, exist_ok=True)
+    previous = backup_catalog.latest(backup_dir)
+    if previous and previous['sha256'] == digest and previous['integrity'] == backup_catalog.INTEGRITY_OK \
+            and os.path.exists(os.path.join(backup_dir, previous['file'])):
+        return os.path.join(backup_dir, previous['file']), False
+
+    now = datetime.datetime.now()
+    date_str = now.strftime('%Y-%m-%d')
+    base_name, ext = os.path.splitext(os.path.basename(db_file))
+    backup_file = os.path.join(backup_dir, f"{base_name}-{date_str}{ext}")
+    if compress:
+        backup_file += backup_catalog.COMPRESSED_SUFFIX
+        # mtime=0 keeps the compressed file the same for the same snapshot
+        data = gzip.compress(data, mtime=0)
+
+    backup_catalog.write_atomic(backup_file, data)
+    backup_catalog.add_entry(backup_dir, {
+        'file': os.path.basename(backup_file),
+        'timestamp': int(now.timestamp()),
+        'size': len(data),
+        'sha256': digest,
+        'users': users,
+        'integrity': backup_catalog.INTEGRITY_OK,
+    })
+    return backup_file, True
+
+def main():
+    parser = argparse.ArgumentParser(description="Back up the access control database")
+    parser.add_argument('db_file', nargs='?', default='prod.db')
+    parser.add_argument('backup_dir', nargs='?', default=db_interface.BACKUPS_DIRECTORY)
+    parser.add_argument('--compress', action='store_true', help="gzip the snapshot")
+    parser.add_argument('--pages-per-step', type=int, default=PAGES_PER_STEP, help="pages copied per backup step")
+    parser.add_argument('--step-sleep', type=float, default=STEP_SLEEP_SECONDS, help="seconds to pause between steps")
+    args = parser.parse_args()
+
+    path, created = backup_db(args.db_file, args.backup_dir, args.compress, args.pages_per_step, args.step_sleep)
+    if created:
+        print("Backed up %s to %s" % (args.db_file, path))
+    else:
+        print("%s is unchanged since %s, nothing written" % (args.db_file, path))
 
-backup_db('prod.db', '/home/pi/senior_design_FA23/Backups')
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,38 +1,135 @@
 import sqlite3
 import datetime
-import os
-import shutil
+import json
+import operator
+import time
+import backup_catalog
+import db_migrations
 
-# TODO extend dict instead of just having a dict?
-# could be useful when sqlite requires a dict or dict subclass
+# backups made by db_backup.py, used to recover a database that has lost its tables
+BACKUPS_DIRECTORY = '/home/pi/senior_design_FA23/Backups'
+
+# ========================== CONNECTION PROFILES ==========================
+# PRAGMAs applied to every connection, in order, by connect()
+#  pi              for the station's SD card: WAL so the controller keeps reading
+#                  while a script writes, synchronous=NORMAL so a commit only fsyncs
+#                  at checkpoints (a power cut can lose the last commits, never
+#                  corrupt the file), and a page cache plus mmap sized for a Pi
+#  sqlite_default  SQLite's own settings (rollback journal, synchronous=FULL),
+#                  kept for benchmarks and for comparing against older behaviour
+CONNECTION_PROFILES = {
+  'pi': [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),     # milliseconds to wait for a lock instead of failing
+    ('cache_size', -4096),      # KiB of page cache
+    ('mmap_size', 33554432),    # 32 MiB, leaves room in a 32-bit address space
+    ('temp_store', 'MEMORY'),
+  ],
+  'sqlite_default': [
+    ('busy_timeout', 5000),
+  ],
+}
+DEFAULT_CONNECTION_PROFILE = 'pi'
+
+# ========================== QUERIES ==========================
+SELECT_USER_BY_UID = "SELECT ramcard_uid, csu_id, fullname, is_admin, expiration_date FROM users WHERE ramcard_uid = ?"
+DELETE_USER_BY_UID = "DELETE FROM users WHERE ramcard_uid = ?"
+INSERT_USER = "INSERT INTO users VALUES (?, ?, ?, ?, ?)"
+SELECT_ALL_USERS = "SELECT ramcard_uid, csu_id, fullname, is_admin, expiration_date FROM users ORDER BY ramcard_uid"
+SELECT_USERS_BY_UIDS = "SELECT ramcard_uid, csu_id, fullname, is_admin, expiration_date FROM users WHERE ramcard_uid IN (%s)"
+# SQLite limits the number of parameters of a statement
+MAX_UIDS_PER_QUERY = 500
+# expired users moved to users_archive per transaction
+ARCHIVE_BATCH_SIZE = 50
+INSERT_LOG = "INSERT INTO users_log(timestamp, action, data, entry) VALUES (?, ?, ?, ?)"
+# the version of the latest replicated change of a card, see apply_changes()
+SELECT_CHANGE_VERSION = """
+  SELECT action != 'BASELINE', timestamp, IFNULL(origin, ?), IFNULL(origin_seq, seq) FROM users_log
+  WHERE data = ? AND seq > ? AND action IN (%s)
+  ORDER BY 1 DESC, 2 DESC, 3 DESC, 4 DESC LIMIT 1"""
+# the timestamp of the latest replicated change of a card, see log_change()
+SELECT_LATEST_CHANGE = "SELECT MAX(timestamp) FROM users_log WHERE data = ? AND action IN (%s)"
+
+# seconds a uid that is not in the database is remembered as unknown, see get_row_from_uid()
+NEGATIVE_CACHE_SECONDS = 60
+# unknown uids remembered at most, a card reader cannot produce more than a few per second
+MAX_NEGATIVE_CACHE_ENTRIES = 256
+
+# Open a connection with the PRAGMAs of a connection profile applied
+# check_same_thread=False lets another thread use the connection, the caller
+# makes sure that only one thread uses it at a time
+def connect(db_name, profile=DEFAULT_CONNECTION_PROFILE, check_same_thread=True):
+  if profile not in CONNECTION_PROFILES:
+    raise Exception("Unknown connection profile %s" % profile)
+  # sqlite3 keeps the last 128 prepared statements of a connection, the queries
+  # of this module are constant strings, so each of them is only compiled once
+  db = sqlite3.connect(db_name, check_same_thread=check_same_thread)
+  for pragma, value in CONNECTION_PROFILES[profile]:
+    db.execute("PRAGMA %s = %s" % (pragma, value))
+  return db
+
+# True for the error SQLite raises when another connection held the write lock for
+# longer than the busy timeout (SQLITE_BUSY)
+def is_busy(error):
+  return isinstance(error, sqlite3.OperationalError) and str(error) == "database is locked"
 
 # ========================== TABLES ==========================
 # users(ramcard_uid, csu_id, fullname, is_admin, expiration_date)
+#   UNIQUE index on ramcard_uid, indexes on csu_id and expiration_date
+# users_archive(ramcard_uid, csu_id, fullname, is_admin, expiration_date, archived_at)
+#   expired users moved out of users by archive_expired_users(), UNIQUE index on ramcard_uid
+# users_log(timestamp, action, data, seq, origin, origin_seq, entry)
+#   every change to users, numbered by seq, see log_change() and db_sync.py
+# laser_log(timestamp, action, data)
+#   laser sessions, written by session_log.session_recorder
+# see db_migrations.py for how the schema is created and upgraded
 
-class user_entry:
+# A users row as an immutable tuple (ramcard_uid, csu_id, fullname, admin, expiration_date)
+# Rows are built straight from the cursor by user_entry.row_factory, without a dict
+# per row. The columns are INTEGER since schema version 2 so the ids need no
+# conversion, and the admin flag is turned into a bool once when the row is read.
+class user_entry(tuple):
+  
+  __slots__ = ()
+  
+  def __new__(cls, uid: int, csu_id: int, name: str, is_admin: int, expiration_date: int):
+    return tuple.__new__(cls, (uid, csu_id, name, is_admin == 1, expiration_date))
+  
+  # for cursor.row_factory
+  @staticmethod
+  def row_factory(cursor, row):
+    return tuple.__new__(user_entry, (row[0], row[1], row[2], row[3] == 1, row[4]))
+  
+  def __getnewargs__(self):
+    return (self[0], self[1], self[2], 1 if self[3] else 0, self[4])
+  
+  def __repr__(self):
+    return "user_entry(ramcard_uid=%r, csu_id=%r, fullname=%r, admin=%r, expiration_date=%r)" % tuple(self)
   
-  def __init__(self, uid: int, csu_id: int, name: str, is_admin: int, expiration_date: int):
-    self.data = {'ramcard_uid': uid, 'csu_id': csu_id, 'fullname': name, 'is_admin': is_admin, 'expiration_date': expiration_date}
+  ramcard_uid = property(operator.itemgetter(0))
+  csu_id = property(operator.itemgetter(1))
+  fullname = property(operator.itemgetter(2))
+  admin = property(operator.itemgetter(3))
+  expiration_date = property(operator.itemgetter(4))
   
   def get_uid(self):
-    return int(self.data['ramcard_uid'])
+    return self[0]
   
   def get_csu_id(self):
-    return int(self.data['csu_id'])
+    return self[1]
   
   def get_name(self):
-    return self.data['fullname']
+    return self[2]
   
   def is_admin(self):
-    if self.data['is_admin'] == 1:
-      return True
-    return False
+    return self[3]
   
-  def is_expired(self):
-    now = int(datetime.datetime.today().timestamp())
-    expiration = self.data['expiration_date']
-    if now > expiration: return True
-    return False
+  # now is seconds since the epoch, the current time when None
+  def is_expired(self, now=None):
+    if now is None:
+      now = int(datetime.datetime.today().timestamp())
+    return now > self[4]
 
 class db_interface:
 
@@ -40,12 +137,37 @@ class db_interface:
   USER_UPDATE_ACTION = "UPDATE"
   USER_DELETE_ACTION = "DELETE"
   USER_REMOVEEXPIRED_ACTION = "REMOVE EXPIRED"
+  USER_ARCHIVE_ACTION = "ARCHIVE"
   USER_DUPLICATE = "DUPLICATE"
+  # an ADD written for every user by the migration to schema version 5
+  USER_BASELINE_ACTION = "BASELINE"
+  # the changes another station applies when it syncs, the others only describe this one
+  REPLICATED_ACTIONS = (USER_ADD_ACTION, USER_UPDATE_ACTION, USER_DELETE_ACTION, USER_ARCHIVE_ACTION, USER_BASELINE_ACTION)
   
-  def __init__(self, db_name: str):
+  # clock is the monotonic clock the negative cache expires on
+  # wall_clock is the time in seconds since the epoch that users expire on
+  # check_same_thread is passed to connect()
+  def __init__(self, db_name: str, profile=DEFAULT_CONNECTION_PROFILE, clock=time.monotonic, check_same_thread=True,
+               wall_clock=time.time):
     self._db = None
+    self.profile = profile
+    self.check_same_thread = check_same_thread
+    self.clock = clock
+    self.wall_clock = wall_clock
     self._db_cursor = None
     self.current_db = None
+    # read-through cache of ramcard_uid -> user_entry, see get_row_from_uid()
+    self._user_cache = {}
+    # negative cache of ramcard_uid -> when it stops being known as unknown
+    self._unknown_uids = {}
+    # PRAGMA data_version and users_version when the cache was last known to be valid
+    self._data_version = None
+    self._cache_users_version = None
+    self.cache_hits = 0
+    self.cache_misses = 0
+    self.cache_invalidations = 0
+    self.negative_cache_hits = 0
+    self.negative_cache_expirations = 0
     self.connect_to_db(db_name)
 
   def __enter__(self):
@@ -55,84 +177,213 @@ class db_interface:
     self.close()
 
   def connect_to_db(self, db_name: str):
-    self._db = sqlite3.connect(db_name)
+    self._db = connect(db_name, self.profile, self.check_same_thread)
     if not self._db:
       raise Exception("Could not connect to database %s" % db_name)
     self.initializeDatabase(db_name)
     self._db_cursor = self._db.cursor()
+    # returns user_entry records instead of plain tuples
+    self._user_cursor = self._db.cursor()
+    self._user_cursor.row_factory = user_entry.row_factory
     self.current_db = db_name
+    self._invalidate_cache()
 
   def close(self):
     if self._db:
       self._db.close()
 
+  ##### CACHE #####
+
+  # Changes made through this connection drop the cache where they are committed.
+  # Commits from other connections (e.g. Scripts/add_admin.py or the session
+  # recorder's writer) change PRAGMA data_version, and only then is users_version
+  # read, a counter that triggers bump on every change to the users tables (see
+  # db_migrations.py). So a laser_log flush costs one extra query on the next
+  # lookup and leaves the cache alone, only a change to users drops it.
+  def _users_version(self):
+    return self._db.execute("SELECT version FROM users_version").fetchone()[0]
+
+  def _validate_cache(self):
+    data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+    if data_version == self._data_version:
+      return
+    self._data_version = data_version
+    if self._users_version() != self._cache_users_version:
+      self._invalidate_cache()
+
+  def _invalidate_cache(self):
+    if self._user_cache or self._unknown_uids:
+      self.cache_invalidations += 1
+    self._user_cache.clear()
+    self._unknown_uids.clear()
+    self._data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+    self._cache_users_version = self._users_version()
+
+  def cache_stats(self):
+    return {'hits': self.cache_hits, 'misses': self.cache_misses,
+            'invalidations': self.cache_invalidations, 'size': len(self._user_cache),
+            'negative_hits': self.negative_cache_hits, 'negative_expirations': self.negative_cache_expirations,
+            'negative_size': len(self._unknown_uids)}
+
+  def _cached_unknown(self, ramcard_uid):
+    expires = self._unknown_uids.get(ramcard_uid)
+    if expires is None:
+      return False
+    if expires <= self.clock():
+      del self._unknown_uids[ramcard_uid]
+      self.negative_cache_expirations += 1
+      return False
+    return True
+
+  def _remember_unknown(self, ramcard_uid):
+    if len(self._unknown_uids) >= MAX_NEGATIVE_CACHE_ENTRIES:
+      self._unknown_uids.clear()
+    self._unknown_uids[ramcard_uid] = self.clock() + NEGATIVE_CACHE_SECONDS
+
+  # True if the uid was looked up recently and is not in the database, without a query
+  # (lets the controller skip reading a card whose lookup is known to fail)
+  def is_known_unknown(self, ramcard_uid: int):
+    self._validate_cache()
+    return self._cached_unknown(ramcard_uid)
+
   # Create database tables if they do not exist
-  # If tables don't exist, first check for backup files
-  # If backup files exist, use the most recent one
-  # If no backup files exist, create the tables
+  # If the users table doesn't exist, first restore the newest verified backup
+  # listed in the backup catalog (falling back to older ones, see backup_catalog.py)
+  # Then bring the schema up to date (this also creates the tables for a new database)
   def initializeDatabase(self, db_path):
     # Create a cursor for the database connection
     cursor = self._db.cursor()
-    # Define the tables and their creation queries. Specified datatyping
-    tables = {
-      'users': 'CREATE TABLE users(ramcard_uid TEXT, csu_id TEXT, fullname TEXT, is_admin INTEGER, expiration_date INTEGER)',
-    }
-    # Get the absolute path to the directory of this script
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    # Construct the path to the Backups directory
-    backups_dir = os.path.abspath(os.path.join(script_dir, '/home/pi/senior_design_FA23/Backups'))
 
     # Check if the first table exists
-    cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='users';")
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users';")
     if not cursor.fetchone():
       print("Table users does not exist.")
 
-      # If the table does not exist, check for backup database files
-      backup_files = [os.path.join(backups_dir, f) for f in os.listdir(backups_dir) if f.endswith('.db')]
-      if backup_files:
-        # If there are backup files, use the most recent one
-        latest_file = max(backup_files, key=os.path.getctime)
-        print(f"Replacing current database with the most recent backup: {os.path.basename(latest_file)}")
-        shutil.copy(latest_file, db_path)
-        # Reconnect to the new database file
-        self._db = sqlite3.connect(db_path)
+      restored = None
+      if db_path != ':memory:':
+        # The restore replaces the database file, so it cannot be open meanwhile
+        cursor.close()
+        self._db.close()
+        restored = backup_catalog.restore_latest(db_path, BACKUPS_DIRECTORY)
+        # Reconnect to the (possibly new) database file
+        self._db = connect(db_path, self.profile, self.check_same_thread)
         cursor = self._db.cursor()
-
-        # Check if the tables exist in the backup
-        for table in tables:
-          cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table}';")
-          if not cursor.fetchone():
-            print(f"Table {table} does not exist in the backup.")
-          else:
-            print(f"Table {table} exists in the backup.")
+      if restored:
+        print(f"Replaced current database with the most recent verified backup: {restored['file']}")
       else:
-        # If there are no backup files, create the tables
         print("No backup found. Creating tables now...")
-        for table, creation_query in tables.items():
-          cursor.execute(creation_query)
-          print(f"Table {table} created.")
     else:
       print("Table users exists.")
 
-    # Commit any changes and close the cursor
-    self._db.commit()
     cursor.close()
+    db_migrations.migrate(self._db)
+
+  ##### CHANGE LOG #####
+  
+  # Record a change in users_log, in the transaction of the change itself
+  # data is the ramcard_uid (or a count for REMOVE EXPIRED), entry the users row after the change
+  # Timestamps are in seconds, so a change that follows another change of the card
+  # within the same second is logged a second later: it must be the newer version
+  # on every station (see apply_changes()).
+  def log_change(self, cursor, action, data, entry=None):
+    timestamp = int(datetime.datetime.today().timestamp())
+    if action in self.REPLICATED_ACTIONS:
+      latest = cursor.execute(SELECT_LATEST_CHANGE % ", ".join("?" * len(self.REPLICATED_ACTIONS)),
+                              [data] + list(self.REPLICATED_ACTIONS)).fetchone()[0]
+      if latest is not None and latest >= timestamp:
+        timestamp = latest + 1
+    cursor.execute(INSERT_LOG, [timestamp, action, data, json.dumps(list(entry)) if entry is not None else None])
+  
+  # the random id of this database, changes made here carry it on other stations
+  def replica_id(self):
+    return self._db.execute("SELECT id FROM replica").fetchone()[0]
+  
+  # the seq of the last change pulled from a peer, 0 if it was never pulled from
+  def last_pulled_seq(self, peer):
+    row = self._db.execute("SELECT last_seq FROM sync_peers WHERE peer = ?", [peer]).fetchone()
+    return row[0] if row else 0
+  
+  # the seq of the last change logged before the replication baseline, see db_migrations.py
+  def baseline_seq(self):
+    return self._db.execute("SELECT baseline_seq FROM replica").fetchone()[0]
+  
+  # Apply changes pulled from a peer, in order, and move the position for that peer to
+  # last_seq, all in one transaction: a sync that is interrupted is simply repeated.
+  # changes are (origin, origin_seq, timestamp, action, data, entry) tuples; a change
+  # made here, or already applied through another peer, is skipped.
+  # Every change has a version, (timestamp, origin, origin_seq) with BASELINE rows
+  # below any other change, and a change older than the latest change of its card
+  # is logged but not applied, so stations end up with the same rows whatever
+  # order the changes reach them in.
+  # Returns how many changes were applied
+  def apply_changes(self, peer, last_seq, changes):
+    own_id = self.replica_id()
+    baseline_seq = self.baseline_seq()
+    select_version = SELECT_CHANGE_VERSION % ", ".join("?" * len(self.REPLICATED_ACTIONS))
+    applied = 0
+    cursor = self._db.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+      for origin, origin_seq, timestamp, action, data, entry in changes:
+        if origin == own_id:
+          continue
+        current = cursor.execute(select_version, [own_id, data, baseline_seq] + list(self.REPLICATED_ACTIONS)).fetchone()
+        # logged with its origin so that stations pulling from here get it too
+        cursor.execute("INSERT OR IGNORE INTO users_log(timestamp, action, data, origin, origin_seq, entry) VALUES (?, ?, ?, ?, ?, ?)",
+                       [timestamp, action, data, origin, origin_seq, entry])
+        if cursor.rowcount == 0:
+          continue
+        if current is not None and (action != self.USER_BASELINE_ACTION, timestamp, origin, origin_seq) < tuple(current):
+          continue
+        self._apply_change(cursor, action, data, entry, timestamp)
+        applied += 1
+      cursor.execute("INSERT INTO sync_peers(peer, last_seq) VALUES (?, ?) ON CONFLICT(peer) DO UPDATE SET last_seq = excluded.last_seq",
+                     [peer, last_seq])
+      self._db.commit()
+    except:
+      self._db.rollback()
+      raise
+    finally:
+      cursor.close()
+    if applied:
+      self._invalidate_cache()
+    return applied
+  
+  def _apply_change(self, cursor, action, ramcard_uid, entry, timestamp):
+    if action in (self.USER_ADD_ACTION, self.USER_UPDATE_ACTION, self.USER_BASELINE_ACTION):
+      cursor.execute("INSERT OR REPLACE INTO users(ramcard_uid, csu_id, fullname, is_admin, expiration_date) VALUES (?, ?, ?, ?, ?)", json.loads(entry))
+      cursor.execute("DELETE FROM users_archive WHERE ramcard_uid = ?", [ramcard_uid])
+    elif action == self.USER_DELETE_ACTION:
+      cursor.execute(DELETE_USER_BY_UID, [ramcard_uid])
+    elif action == self.USER_ARCHIVE_ACTION:
+      cursor.execute("INSERT OR REPLACE INTO users_archive SELECT ramcard_uid, csu_id, fullname, is_admin, expiration_date, ? FROM users WHERE ramcard_uid = ?", [timestamp, ramcard_uid])
+      cursor.execute(DELETE_USER_BY_UID, [ramcard_uid])
+  
+  ##### CHANGES #####
   
   def delete_entry(self, ramcard_uid: int):
     # Delete the user from the users table
-    self._db_cursor.execute("DELETE FROM users WHERE ramcard_uid = ?", [ramcard_uid])
+    res = self._db_cursor.execute(DELETE_USER_BY_UID, [ramcard_uid])
+    if res.rowcount > 0:
+      self.log_change(self._db_cursor, self.USER_DELETE_ACTION, ramcard_uid)
     self._db.commit()
+    self._invalidate_cache()
 
   def _add_entry(self, ramcard_uid: int, csu_id: int, fullname: str, is_admin: int):
     action = self.USER_ADD_ACTION
     
     # Delete existing entry if it exists
-    res = self._db_cursor.execute("DELETE FROM users WHERE ramcard_uid = ?", [ramcard_uid])
+    res = self._db_cursor.execute(DELETE_USER_BY_UID, [ramcard_uid])
     # If the entry existed, then we are updating it
     if res.rowcount > 0:
       action = self.USER_UPDATE_ACTION
-    self._db_cursor.execute("INSERT INTO users VALUES (?, ?, ?, ?, ?)", [ramcard_uid, csu_id, fullname, is_admin, calculate_expiration_date_timestamp()])
+    entry = [ramcard_uid, csu_id, fullname, is_admin, calculate_expiration_date_timestamp()]
+    self._db_cursor.execute(INSERT_USER, entry)
+    # an enrolled card has no use for its archived row any more
+    self._db_cursor.execute("DELETE FROM users_archive WHERE ramcard_uid = ?", [ramcard_uid])
+    self.log_change(self._db_cursor, action, ramcard_uid, entry)
     self._db.commit()
+    self._invalidate_cache()
 
   def add_user(self, ramcard_uid: int, csu_id: int, fullname: str):
     self._add_entry(ramcard_uid, csu_id, fullname, 0)
@@ -140,21 +391,58 @@ class db_interface:
   def add_admin(self, ramcard_uid: int, csu_id: int, fullname: str):
     self._add_entry(ramcard_uid, csu_id, fullname, 1)
 
+  # Lookups are served from the in-memory cache while the database files are unchanged,
+  # so a repeated tap of the same card never reaches SQLite. Unknown uids are cached
+  # too, for NEGATIVE_CACHE_SECONDS, so a card that is not enrolled costs one query
+  # however often it is tapped; enrolling it changes the database, which drops them.
   def get_row_from_uid(self, ramcard_uid: int):
-    # Fetch the user from the users table
-    res = self._db_cursor.execute("SELECT * FROM users WHERE ramcard_uid = ?", [ramcard_uid])
-    # Fetch the first row from result set
-    row = res.fetchone()
-    # If the row is empty, set was empty, 
-    if not row:
+    self._validate_cache()
+    entry = self._user_cache.get(ramcard_uid)
+    if entry is not None:
+      self.cache_hits += 1
+      return entry
+    if self._cached_unknown(ramcard_uid):
+      self.negative_cache_hits += 1
       return None
-    # Fetch again to see if there are duplicates
-    duplicate = res.fetchone()
-    if duplicate:
-      self._db.commit()
-    # Return the first user entry even if there is duplicates
-    # TODO duplicate handling (shouldnt happen)
-    return user_entry(row[0], row[1], row[2], row[3], row[4])
+    self.cache_misses += 1
+    entry = self._get_row_from_uid(ramcard_uid)
+    if entry is not None:
+      self._user_cache[ramcard_uid] = entry
+    elif isinstance(ramcard_uid, int):
+      self._remember_unknown(ramcard_uid)
+    return entry
+
+  def _get_row_from_uid(self, ramcard_uid: int):
+    # uids are stored as INTEGER, anything else could only match through type conversion
+    if not isinstance(ramcard_uid, int) or isinstance(ramcard_uid, bool):
+      return None
+    # Fetch the user from the users table, ramcard_uid is unique so this is a single index seek
+    # None if there is no such user
+    return self._user_cursor.execute(SELECT_USER_BY_UID, [ramcard_uid]).fetchone()
+  
+  # Every user as a user_entry, ordered by ramcard_uid
+  # Rows are read from SQLite as the iteration goes, so a scan never holds the whole roster
+  def iter_users(self):
+    cursor = self._db.cursor()
+    cursor.row_factory = user_entry.row_factory
+    try:
+      yield from cursor.execute(SELECT_ALL_USERS)
+    finally:
+      cursor.close()
+  
+  # The users with any of the given uids, as user_entry records in no particular
+  # order; unknown uids are skipped. The uids are looked up MAX_UIDS_PER_QUERY at a
+  # time, as the records are consumed.
+  def get_rows_from_uids(self, ramcard_uids):
+    uids = [uid for uid in ramcard_uids if isinstance(uid, int) and not isinstance(uid, bool)]
+    cursor = self._db.cursor()
+    cursor.row_factory = user_entry.row_factory
+    try:
+      for start in range(0, len(uids), MAX_UIDS_PER_QUERY):
+        part = uids[start:start + MAX_UIDS_PER_QUERY]
+        yield from cursor.execute(SELECT_USERS_BY_UIDS % ", ".join("?" * len(part)), part)
+    finally:
+      cursor.close()
   
   def check_uid(self, ramcard_uid: int):
     data = self.get_row_from_uid(ramcard_uid)
@@ -165,20 +453,163 @@ class db_interface:
     if not row:
       return False
     # If the user is an admin or their account is not expired, return True
-    if row.is_admin() or not row.is_expired():
+    if row.is_admin() or not row.is_expired(int(self.wall_clock())):
       return True
     # False if not admin or expired (not authorized)
     return False
   
+  ##### EXPIRY #####
+  
+  # Move up to batch_size expired users into users_archive, returns how many were moved
+  # Admins are left alone unless include_admins is set. The rows are found through
+  # the expiration_date index, oldest first, and moved in one short transaction, so
+  # calling this repeatedly never holds the database for long.
+  # busy_timeout (milliseconds) replaces the profile's wait for another writer's lock
+  # for this call, when it runs out the sqlite3.OperationalError is raised (see is_busy)
+  def archive_expired_users(self, batch_size=ARCHIVE_BATCH_SIZE, include_admins=False, now=None, busy_timeout=None):
+    if now is None:
+      now = int(self.wall_clock())
+    admin_filter = "" if include_admins else " AND is_admin != 1"
+    cursor = self._db.cursor()
+    if busy_timeout is not None:
+      profile_busy_timeout = cursor.execute("PRAGMA busy_timeout").fetchone()[0]
+      cursor.execute("PRAGMA busy_timeout = %d" % busy_timeout)
+      try:
+        cursor.execute("BEGIN IMMEDIATE")
+      finally:
+        cursor.execute("PRAGMA busy_timeout = %d" % profile_busy_timeout)
+    else:
+      cursor.execute("BEGIN IMMEDIATE")
+    try:
+      uids = [row[0] for row in cursor.execute(
+        "SELECT ramcard_uid FROM users WHERE expiration_date < ?%s ORDER BY expiration_date LIMIT ?" % admin_filter, [now, batch_size])]
+      if uids:
+        placeholders = ", ".join("?" * len(uids))
+        cursor.execute("INSERT OR REPLACE INTO users_archive SELECT ramcard_uid, csu_id, fullname, is_admin, expiration_date, ? FROM users WHERE ramcard_uid IN (%s)" % placeholders, [now] + uids)
+        cursor.execute("DELETE FROM users WHERE ramcard_uid IN (%s)" % placeholders, uids)
+        # one ARCHIVE per card for other stations, and one REMOVE EXPIRED with the count
+        cursor.executemany(INSERT_LOG, [(now, self.USER_ARCHIVE_ACTION, uid, None) for uid in uids])
+        self.log_change(cursor, self.USER_REMOVEEXPIRED_ACTION, len(uids))
+      self._db.commit()
+    except:
+      self._db.rollback()
+      raise
+    finally:
+      cursor.close()
+    if uids:
+      self._invalidate_cache()
+    return len(uids)
+  
   # only remove expired users, leave expired admins
+  # (they are archived, see archive_expired_users())
   def remove_expired_users(self):
-    res = self._db_cursor.execute("DELETE FROM users WHERE is_admin != 1 AND expiration_date < ?", [int(datetime.datetime.today().timestamp())])
-    self._db.commit()
+    while self.archive_expired_users():
+      pass
   
   # remove all expired entries, admins included
   def remove_expired_entries(self):
-    res = self._db_cursor.execute("DELETE FROM users WHERE expiration_date < ?", [int(datetime.datetime.today().timestamp())])
-    self._db.commit()
+    while self.archive_expired_users(include_admins=True):
+      pass
+  
+  # The archived row of a card, as a user_entry, or None if it was never archived
+  def get_archived_user(self, ramcard_uid: int):
+    cursor = self._db.cursor()
+    cursor.row_factory = user_entry.row_factory
+    try:
+      return cursor.execute("SELECT ramcard_uid, csu_id, fullname, is_admin, expiration_date FROM users_archive WHERE ramcard_uid = ?", [ramcard_uid]).fetchone()
+    finally:
+      cursor.close()
+  
+  # Move an archived user back into users with a new expiration date
+  # Returns the reinstated user_entry, or None if the card is not in the archive
+  def reinstate_user(self, ramcard_uid: int, expiration_date=None):
+    if expiration_date is None:
+      expiration_date = calculate_expiration_date_timestamp()
+    cursor = self._db.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+      cursor.execute("""
+        INSERT OR REPLACE INTO users(ramcard_uid, csu_id, fullname, is_admin, expiration_date)
+        SELECT ramcard_uid, csu_id, fullname, is_admin, ? FROM users_archive WHERE ramcard_uid = ?""", [expiration_date, ramcard_uid])
+      reinstated = cursor.rowcount
+      if reinstated:
+        entry = cursor.execute(SELECT_USER_BY_UID, [ramcard_uid]).fetchone()
+        self.log_change(cursor, self.USER_UPDATE_ACTION, ramcard_uid, entry)
+      cursor.execute("DELETE FROM users_archive WHERE ramcard_uid = ?", [ramcard_uid])
+      self._db.commit()
+    except:
+      self._db.rollback()
+      raise
+    finally:
+      cursor.close()
+    if not reinstated:
+      return None
+    self._invalidate_cache()
+    return self.get_row_from_uid(ramcard_uid)
+  
+  ##### BULK IMPORT #####
+  
+  # Add or update many users in one transaction
+  # records is any iterable of dicts with the keys normalize_user_record() accepts;
+  # it is consumed as a stream, so a 100k row file never has to be held in memory.
+  # Valid records go into a temporary staging table with executemany (the last
+  # record wins when a uid appears more than once), then all of them are upserted
+  # into users with a single statement.
+  # Returns {'records', 'inserted', 'updated', 'rejected', 'duplicates', 'errors'}
+  # where errors lists the first MAX_REPORTED_IMPORT_ERRORS (record number, reason) pairs
+  def import_users(self, records):
+    report = {'records': 0, 'inserted': 0, 'updated': 0, 'rejected': 0, 'duplicates': 0, 'errors': []}
+    
+    def valid_rows():
+      for number, record in enumerate(records, 1):
+        report['records'] = number
+        try:
+          yield normalize_user_record(record)
+        except ValueError as e:
+          report['rejected'] += 1
+          if len(report['errors']) < MAX_REPORTED_IMPORT_ERRORS:
+            report['errors'].append((number, str(e)))
+    
+    cursor = self._db.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+      cursor.execute("CREATE TEMP TABLE IF NOT EXISTS import_staging(ramcard_uid INTEGER PRIMARY KEY, csu_id INTEGER, fullname TEXT, is_admin INTEGER, expiration_date INTEGER)")
+      cursor.execute("DELETE FROM import_staging")
+      cursor.executemany("INSERT OR REPLACE INTO import_staging VALUES (?, ?, ?, ?, ?)", valid_rows())
+      staged = cursor.execute("SELECT COUNT(*) FROM import_staging").fetchone()[0]
+      report['updated'] = cursor.execute("SELECT COUNT(*) FROM import_staging JOIN users USING (ramcard_uid)").fetchone()[0]
+      report['inserted'] = staged - report['updated']
+      report['duplicates'] = report['records'] - report['rejected'] - staged
+      # logged as log_change() would, a second after the latest change of the card at the earliest
+      cursor.execute("""
+        INSERT INTO users_log(timestamp, action, data, entry)
+        SELECT MAX(?, IFNULL((SELECT MAX(timestamp) + 1 FROM users_log WHERE data = s.ramcard_uid AND action IN (%s)), 0)),
+               CASE WHEN users.ramcard_uid IS NULL THEN ? ELSE ? END, s.ramcard_uid,
+               json_array(s.ramcard_uid, s.csu_id, s.fullname, s.is_admin, s.expiration_date)
+        FROM import_staging AS s LEFT JOIN users USING (ramcard_uid)
+        ORDER BY s.ramcard_uid""" % ", ".join("?" * len(self.REPLICATED_ACTIONS)),
+        [int(datetime.datetime.today().timestamp())] + list(self.REPLICATED_ACTIONS) + [self.USER_ADD_ACTION, self.USER_UPDATE_ACTION])
+      # the WHERE true is needed by the parser to tell ON CONFLICT apart from a join constraint
+      cursor.execute("""
+        INSERT INTO users(ramcard_uid, csu_id, fullname, is_admin, expiration_date)
+        SELECT ramcard_uid, csu_id, fullname, is_admin, expiration_date FROM import_staging WHERE true
+        ON CONFLICT(ramcard_uid) DO UPDATE SET
+          csu_id = excluded.csu_id,
+          fullname = excluded.fullname,
+          is_admin = excluded.is_admin,
+          expiration_date = excluded.expiration_date""")
+      # an imported card is active again, as in _add_entry
+      cursor.execute("DELETE FROM users_archive WHERE ramcard_uid IN (SELECT ramcard_uid FROM import_staging)")
+      cursor.execute("DELETE FROM import_staging")
+      self._db.commit()
+    except:
+      self._db.rollback()
+      raise
+    finally:
+      cursor.close()
+      self._invalidate_cache()
+    
+    return report
   
   def close(self):
     self._db.close()
@@ -205,7 +636,7 @@ class db_interface:
   
   def is_expired(self, uid: int):
     data = self.get_row_from_uid(uid)
-    return data.is_expired()
+    return data.is_expired(int(self.wall_clock()))
 
 # TODO change this to be something like
 #  - end of the current semester
@@ -216,6 +647,83 @@ def calculate_expiration_date_timestamp():
   six_months = datetime.timedelta(days = 180)
   return int((now + six_months).timestamp())
 
+# ========================== IMPORT RECORDS ==========================
+# Keys accepted by normalize_user_record(), the first one of each list that is present is used
+IMPORT_FIELDS = {
+  'ramcard_uid': ['ramcard_uid', 'uid'],
+  'csu_id': ['csu_id', 'id'],
+  'fullname': ['fullname', 'name'],
+  'is_admin': ['is_admin', 'admin'],
+  'expiration_date': ['expiration_date', 'expiration'],
+}
+TRUE_STRINGS = {'1', 'true', 'yes', 'y', 'admin'}
+FALSE_STRINGS = {'', '0', 'false', 'no', 'n', 'user'}
+MAX_REPORTED_IMPORT_ERRORS = 100
+
+def _import_field(record, field):
+  for key in IMPORT_FIELDS[field]:
+    value = record.get(key)
+    if value is not None:
+      return value.strip() if isinstance(value, str) else value
+  return None
+
+def _parse_int(value, field):
+  if isinstance(value, bool):
+    raise ValueError("%s must be a number, got %r" % (field, value))
+  if isinstance(value, int):
+    return value
+  if isinstance(value, str) and value:
+    try:
+      # uids are printed in hex on the device, so 0x... is accepted
+      return int(value, 0) if value.lower().startswith('0x') else int(value)
+    except ValueError:
+      pass
+  raise ValueError("%s must be a number, got %r" % (field, value))
+
+# Validate one import record and return it as a users row
+# (ramcard_uid, csu_id, fullname, is_admin, expiration_date), raises ValueError if it is invalid
+#  expiration_date  seconds since the epoch or an ISO date (YYYY-MM-DD),
+#                   calculate_expiration_date_timestamp() when missing
+def normalize_user_record(record):
+  uid = _import_field(record, 'ramcard_uid')
+  if uid is None or uid == '':
+    raise ValueError("missing ramcard_uid")
+  uid = _parse_int(uid, 'ramcard_uid')
+  if uid <= 0:
+    raise ValueError("ramcard_uid must be positive, got %d" % uid)
+  
+  csu_id = _parse_int(_import_field(record, 'csu_id'), 'csu_id')
+  if not 0 <= csu_id < 10 ** 9:
+    raise ValueError("csu_id must have at most 9 digits, got %d" % csu_id)
+  
+  name = _import_field(record, 'fullname')
+  if not isinstance(name, str) or not name:
+    raise ValueError("missing fullname")
+  name = ' '.join(name.split())
+  
+  admin = _import_field(record, 'is_admin')
+  if admin is None or isinstance(admin, bool):
+    is_admin = 1 if admin else 0
+  elif isinstance(admin, int) and admin in (0, 1):
+    is_admin = admin
+  elif isinstance(admin, str) and admin.lower() in TRUE_STRINGS | FALSE_STRINGS:
+    is_admin = 1 if admin.lower() in TRUE_STRINGS else 0
+  else:
+    raise ValueError("is_admin must be true or false, got %r" % admin)
+  
+  expiration = _import_field(record, 'expiration_date')
+  if expiration is None or expiration == '':
+    expiration_date = calculate_expiration_date_timestamp()
+  elif isinstance(expiration, str) and '-' in expiration:
+    try:
+      expiration_date = int(datetime.datetime.fromisoformat(expiration).timestamp())
+    except ValueError:
+      raise ValueError("expiration_date is not a date, got %r" % expiration)
+  else:
+    expiration_date = _parse_int(expiration, 'expiration_date')
+  
+  return (uid, csu_id, name, is_admin, expiration_date)
+
 def print_users_table(db_name):
   db = sqlite3.connect(db_name)
   res = db.cursor().execute("SELECT * FROM users")
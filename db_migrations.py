@@ -0,0 +1,183 @@
+import sqlite3
+
+# Versioned schema migrations for the access control database
+#
+# The schema version of a database file is stored in PRAGMA user_version.
+# MIGRATIONS[i] upgrades a database from version i to version i + 1, so a
+# freshly created file runs every migration and an existing prod.db only runs
+# the ones it has not seen yet. Each migration runs in its own transaction
+# together with the user_version bump, so a failed migration leaves the file
+# at the previous version.
+#
+# Never edit a migration that has shipped, append a new one instead.
+
+# ========================== MIGRATIONS ==========================
+
+# version 1: base tables
+#  users(ramcard_uid, csu_id, fullname, is_admin, expiration_date)
+#  users_log(timestamp, action, data)
+#  laser_log(timestamp, action, data)
+def _create_tables(cursor):
+  cursor.execute("CREATE TABLE IF NOT EXISTS users(ramcard_uid INTEGER, csu_id INTEGER, fullname TEXT, is_admin INTEGER, expiration_date INTEGER)")
+  cursor.execute("CREATE TABLE IF NOT EXISTS users_log(timestamp INTEGER, action TEXT, data INTEGER)")
+  cursor.execute("CREATE TABLE IF NOT EXISTS laser_log(timestamp INTEGER, action TEXT, data TEXT)")
+
+# version 2: typed users table with one row per card
+#  Older databases store ramcard_uid and csu_id as TEXT (or untyped), which makes
+#  every lookup a full scan and lets the same card be enrolled more than once.
+#  The table is rebuilt with INTEGER columns and duplicates are merged, keeping
+#  admins over users, then the latest expiration date, then the oldest row.
+#  Rows whose uid is not a number cannot be matched by the reader and are dropped.
+def _typed_users(cursor):
+  cursor.execute("""
+    CREATE TABLE users_migrated(
+      ramcard_uid INTEGER NOT NULL,
+      csu_id INTEGER,
+      fullname TEXT,
+      is_admin INTEGER NOT NULL DEFAULT 0,
+      expiration_date INTEGER NOT NULL DEFAULT 0
+    )""")
+  cursor.execute("""
+    INSERT INTO users_migrated
+    SELECT ramcard_uid, csu_id, fullname, is_admin, expiration_date FROM (
+      SELECT
+        CAST(ramcard_uid AS INTEGER) AS ramcard_uid,
+        CASE WHEN csu_id IS NULL OR TRIM(csu_id) = '' THEN NULL ELSE CAST(csu_id AS INTEGER) END AS csu_id,
+        fullname,
+        CASE WHEN is_admin = 1 THEN 1 ELSE 0 END AS is_admin,
+        CAST(IFNULL(expiration_date, 0) AS INTEGER) AS expiration_date,
+        ROW_NUMBER() OVER (
+          PARTITION BY CAST(ramcard_uid AS INTEGER)
+          ORDER BY is_admin = 1 DESC, CAST(IFNULL(expiration_date, 0) AS INTEGER) DESC, rowid
+        ) AS rank
+      FROM users
+      WHERE CAST(CAST(ramcard_uid AS INTEGER) AS TEXT) = CAST(ramcard_uid AS TEXT)
+    )
+    WHERE rank = 1
+    ORDER BY ramcard_uid""")
+  kept = cursor.rowcount
+  total = cursor.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+  if total != kept:
+    print(f"Merged or dropped {total - kept} duplicate or invalid user rows.")
+  cursor.execute("DROP TABLE users")
+  cursor.execute("ALTER TABLE users_migrated RENAME TO users")
+  cursor.execute("CREATE UNIQUE INDEX users_ramcard_uid ON users(ramcard_uid)")
+  cursor.execute("CREATE INDEX users_csu_id ON users(csu_id)")
+  cursor.execute("CREATE INDEX users_expiration_date ON users(expiration_date)")
+
+# version 3: archive for expired users
+#  Expired users are moved here by the expiry sweeper instead of being deleted,
+#  so a returning user can be reinstated without enrolling their card again.
+#  Only the most recent archived row is kept per card.
+def _users_archive(cursor):
+  cursor.execute("""
+    CREATE TABLE users_archive(
+      ramcard_uid INTEGER NOT NULL,
+      csu_id INTEGER,
+      fullname TEXT,
+      is_admin INTEGER NOT NULL DEFAULT 0,
+      expiration_date INTEGER NOT NULL DEFAULT 0,
+      archived_at INTEGER NOT NULL
+    )""")
+  cursor.execute("CREATE UNIQUE INDEX users_archive_ramcard_uid ON users_archive(ramcard_uid)")
+  cursor.execute("CREATE INDEX users_archive_csu_id ON users_archive(csu_id)")
+
+# version 4: users_log as a change log that other stations can replicate
+#  users_log is rebuilt with a sequence number and what a peer needs to apply the change:
+#   seq         AUTOINCREMENT, so a number is never used twice even after rows are deleted
+#   origin      replica id of the station the change was made on, NULL when made here
+#   origin_seq  seq of the change on that station, NULL when made here
+#   entry       the users row after the change as a JSON array, NULL when there is none
+#  timestamp, action and data stay the first three columns, existing rows keep their order.
+#  replica holds the random id of this database and sync_peers the last seq pulled
+#  from each peer, see db_sync.py.
+def _replicated_users_log(cursor):
+  cursor.execute("""
+    CREATE TABLE users_log_migrated(
+      timestamp INTEGER,
+      action TEXT,
+      data INTEGER,
+      seq INTEGER PRIMARY KEY AUTOINCREMENT,
+      origin TEXT,
+      origin_seq INTEGER,
+      entry TEXT
+    )""")
+  cursor.execute("INSERT INTO users_log_migrated(timestamp, action, data) SELECT timestamp, action, data FROM users_log ORDER BY rowid")
+  cursor.execute("DROP TABLE users_log")
+  cursor.execute("ALTER TABLE users_log_migrated RENAME TO users_log")
+  # a change from another station is applied once, however many peers it arrives through
+  cursor.execute("CREATE UNIQUE INDEX users_log_origin ON users_log(origin, origin_seq)")
+  cursor.execute("CREATE TABLE replica(id TEXT NOT NULL)")
+  cursor.execute("INSERT INTO replica VALUES (lower(hex(randomblob(8))))")
+  cursor.execute("CREATE TABLE sync_peers(peer TEXT PRIMARY KEY, last_seq INTEGER NOT NULL)")
+
+# version 5: a replication baseline
+#  The rows logged before this version are not replicated: the ones from before
+#  version 4 have no entry to apply, and the users that existed before the change
+#  log have no row at all. Instead every user gets one BASELINE row, an ADD with
+#  the current row as its entry that loses to any real change of the card on
+#  another station, and replica.baseline_seq marks where replication starts.
+#  users_log is indexed on data, the card, to find the latest change of a card
+#  when a pulled change is applied (see db_interface.apply_changes()).
+def _replication_baseline(cursor):
+  cursor.execute("ALTER TABLE replica ADD COLUMN baseline_seq INTEGER NOT NULL DEFAULT 0")
+  cursor.execute("UPDATE replica SET baseline_seq = (SELECT IFNULL(MAX(seq), 0) FROM users_log)")
+  cursor.execute("""
+    INSERT INTO users_log(timestamp, action, data, entry)
+    SELECT CAST(strftime('%s', 'now') AS INTEGER), 'BASELINE', ramcard_uid,
+           json_array(ramcard_uid, csu_id, fullname, is_admin, expiration_date)
+    FROM users ORDER BY ramcard_uid""")
+  cursor.execute("CREATE INDEX users_log_data ON users_log(data)")
+
+# version 6: a change counter for the users tables
+#  users_version holds a single number that triggers bump on every insert, update
+#  and delete in users and users_archive. The lookup cache compares it (see
+#  db_interface._validate_cache()), so commits that only touch the other tables,
+#  like the laser_log, do not drop the cache.
+def _users_version(cursor):
+  cursor.execute("CREATE TABLE users_version(version INTEGER NOT NULL)")
+  cursor.execute("INSERT INTO users_version VALUES (0)")
+  for table in ("users", "users_archive"):
+    for event in ("INSERT", "UPDATE", "DELETE"):
+      cursor.execute(f"""
+        CREATE TRIGGER {table}_{event.lower()}_version AFTER {event} ON {table}
+        BEGIN UPDATE users_version SET version = version + 1; END""")
+
+MIGRATIONS = [
+  _create_tables,
+  _typed_users,
+  _users_archive,
+  _replicated_users_log,
+  _replication_baseline,
+  _users_version,
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+def get_version(db: sqlite3.Connection):
+  return db.execute("PRAGMA user_version").fetchone()[0]
+
+# Bring the database up to LATEST_VERSION, returns the version it started at
+def migrate(db: sqlite3.Connection):
+  start_version = get_version(db)
+  if start_version > LATEST_VERSION:
+    raise Exception("Database schema version %d is newer than this program supports (%d)" % (start_version, LATEST_VERSION))
+
+  for version in range(start_version, LATEST_VERSION):
+    if db.in_transaction:
+      db.commit()
+    cursor = db.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+      MIGRATIONS[version](cursor)
+      # PRAGMA does not accept bound parameters, version is always an int here
+      cursor.execute("PRAGMA user_version = %d" % (version + 1))
+      db.commit()
+    except Exception:
+      db.rollback()
+      raise
+    finally:
+      cursor.close()
+    print(f"Database migrated to schema version {version + 1}.")
+
+  return start_version
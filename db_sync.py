@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+import argparse
+import sqlite3
+import sys
+import db_interface
+import db_migrations
+
+# Replication of the users table between stations
+#
+# Every change to users is recorded in users_log with a sequence number (see
+# db_migrations.py, version 4). A station pulls the changes a peer made after
+# the last one it pulled from that peer and applies them in batches, so a sync
+# reads and writes in proportion to the number of changes, not the roster:
+#
+#  station A ---pull---> hub <---pull--- station B
+#  station A <--pull---- hub ----pull--> station B
+#
+# Changes carry the replica id of the station they were made on and their seq
+# there. A change is applied once, however many peers it arrives through, and
+# changes a station made itself are skipped when they come back from a peer.
+# When two stations change the same card between syncs, the change with the
+# latest timestamp wins on every station, the replica id breaking ties (see
+# db_interface.apply_changes()). REMOVE EXPIRED rows only describe the local
+# sweep, each station archives the same expired users itself (the ARCHIVE rows
+# are still replicated, so an archive made with remove_expired_entries() reaches
+# the others too, unless the card was changed after it was archived).
+#
+# Replication starts at the baseline written when a database is migrated to
+# schema version 5: one BASELINE row per user, so a roster that predates the
+# change log reaches the other stations too. Rows logged before it are not read.
+#
+# The peer is read through SQLite, read only, so it can be a file on a mounted
+# share or a copy of the hub's database; only the pages holding new log rows are read.
+#
+# Every database gets a random replica id when it is created. A database copied
+# to another station (e.g. by cloning the SD card) must be given a new one first:
+#  python3 db_sync.py prod.db --new-replica-id
+#
+# Run periodically using cron, e.g. every 10 minutes:
+#  */10 * * * * /usr/bin/python3 /home/pi/senior_design_FA23/laser-cutter-rfid/db_sync.py prod.db /mnt/hub/prod.db
+
+# log rows read from the peer and applied per transaction
+BATCH_SIZE = 500
+
+SELECT_CHANGES = """
+  SELECT seq, origin, origin_seq, timestamp, action, data, entry FROM users_log
+  WHERE seq > ? ORDER BY seq LIMIT ?"""
+
+class sync_report:
+
+  def __init__(self, peer):
+    self.peer = peer
+    self.read = 0
+    self.applied = 0
+    self.batches = 0
+    self.last_seq = 0
+
+  def __str__(self):
+    return ("%d log rows read from %s in %d batches, %d changes applied, up to seq %d" %
+            (self.read, self.peer, self.batches, self.applied, self.last_seq))
+
+def open_peer(peer_path):
+  peer = sqlite3.connect("file:%s?mode=ro" % peer_path, uri=True)
+  version = db_migrations.get_version(peer)
+  if version < 5:
+    peer.close()
+    raise Exception("%s has schema version %d, open it once with this version to upgrade it" % (peer_path, version))
+  return peer
+
+# Batches of changes a peer made after since, as (last seq read, changes) pairs
+# Changes made on the peer itself get the peer's replica id as their origin. Reading
+# starts at the peer's baseline at the earliest, the rows before it have no entry.
+def read_changes(peer, peer_id, since, batch_size=BATCH_SIZE):
+  since = max(since, peer.execute("SELECT baseline_seq FROM replica").fetchone()[0])
+  while True:
+    rows = peer.execute(SELECT_CHANGES, [since, batch_size]).fetchall()
+    if not rows:
+      return
+    since = rows[-1][0]
+    yield since, [(origin or peer_id, origin_seq or seq, timestamp, action, data, entry)
+                  for seq, origin, origin_seq, timestamp, action, data, entry in rows
+                  if action in db_interface.db_interface.REPLICATED_ACTIONS]
+    if len(rows) < batch_size:
+      return
+
+# Pull the changes of the database at peer_path into db (a db_interface)
+def pull(db, peer_path, batch_size=BATCH_SIZE):
+  peer = open_peer(peer_path)
+  try:
+    peer_id = peer.execute("SELECT id FROM replica").fetchone()[0]
+    if peer_id == db.replica_id():
+      raise Exception("%s has the replica id of this database, give one of them a new id" % peer_path)
+    report = sync_report(peer_id)
+    report.last_seq = db.last_pulled_seq(peer_id)
+    for last_seq, changes in read_changes(peer, peer_id, report.last_seq, batch_size):
+      report.read += len(changes)
+      report.applied += db.apply_changes(peer_id, last_seq, changes)
+      report.batches += 1
+      report.last_seq = last_seq
+  finally:
+    peer.close()
+  return report
+
+def new_replica_id(db):
+  with db._db:
+    db._db.execute("UPDATE replica SET id = lower(hex(randomblob(8)))")
+  return db.replica_id()
+
+def main():
+  parser = argparse.ArgumentParser(description="Pull the user changes of other stations into a database")
+  parser.add_argument('db_file', help="database to update")
+  parser.add_argument('peers', nargs='*', help="databases to pull from, in order")
+  parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="log rows applied per transaction")
+  parser.add_argument('--new-replica-id', action='store_true', help="give the database a new replica id first")
+  args = parser.parse_args()
+
+  with db_interface.db_interface(args.db_file) as db:
+    if args.new_replica_id:
+      print("New replica id %s" % new_replica_id(db))
+    for peer_path in args.peers:
+      print("%s: %s" % (peer_path, pull(db, peer_path, args.batch_size)))
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
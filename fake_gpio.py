@@ -0,0 +1,121 @@
+# In-memory stand-in for the parts of RPi.GPIO this project uses
+#
+# Pins keep their mode, level, pull and PWM duty cycle, and edge detection
+# callbacks fire (in the calling thread) when a test drives an input with
+# set_input(), so the button and relay logic can run without a Pi.
+#
+# Example:
+#  GPIO = fake_gpio.fake_gpio()
+#  GPIO.setup(10, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+#  GPIO.set_input(10, GPIO.LOW) # press a button wired to ground
+
+class fake_pwm:
+
+  def __init__(self, gpio, pin, frequency):
+    self.gpio = gpio
+    self.pin = pin
+    self.frequency = frequency
+    self.duty_cycle = 0
+    self.running = False
+
+  def start(self, duty_cycle):
+    self.running = True
+    self.ChangeDutyCycle(duty_cycle)
+
+  def ChangeDutyCycle(self, duty_cycle):
+    self.duty_cycle = duty_cycle
+    self.gpio.pwm_changes += 1
+
+  def ChangeFrequency(self, frequency):
+    self.frequency = frequency
+
+  def stop(self):
+    self.running = False
+
+class fake_gpio:
+
+  BOARD = 10
+  BCM = 11
+  OUT = 0
+  IN = 1
+  LOW = 0
+  HIGH = 1
+  PUD_OFF = 20
+  PUD_DOWN = 21
+  PUD_UP = 22
+  RISING = 31
+  FALLING = 32
+  BOTH = 33
+
+  def __init__(self):
+    self.mode = None
+    self.modes = {}
+    self.levels = {}
+    self.pwms = {}
+    self.callbacks = {}
+    self.pwm_changes = 0
+    # every output change as (pin, level), for checking relay behavior
+    self.output_history = []
+
+  def setmode(self, mode):
+    self.mode = mode
+
+  def setwarnings(self, flag):
+    pass
+
+  def setup(self, pin, mode, pull_up_down=None, initial=None):
+    self.modes[pin] = mode
+    if mode == self.OUT:
+      self.levels[pin] = initial if initial is not None else self.LOW
+    else:
+      self.levels[pin] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+
+  def input(self, pin):
+    return self.levels[pin]
+
+  def output(self, pin, level):
+    if self.modes.get(pin) != self.OUT:
+      raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+    level = self.HIGH if level else self.LOW
+    self.levels[pin] = level
+    self.output_history.append((pin, level))
+
+  def PWM(self, pin, frequency):
+    pwm = fake_pwm(self, pin, frequency)
+    self.pwms[pin] = pwm
+    return pwm
+
+  def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+    if pin in self.callbacks:
+      raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+    self.callbacks[pin] = (edge, [callback] if callback else [])
+
+  def add_event_callback(self, pin, callback):
+    self.callbacks[pin][1].append(callback)
+
+  def remove_event_detect(self, pin):
+    self.callbacks.pop(pin, None)
+
+  def cleanup(self, pin=None):
+    pins = [pin] if pin is not None else list(self.modes)
+    for p in pins:
+      self.modes.pop(p, None)
+      self.callbacks.pop(p, None)
+
+  # ----- simulation helpers -----
+
+  # drive an input pin, firing edge callbacks like the real library would
+  def set_input(self, pin, level):
+    level = self.HIGH if level else self.LOW
+    old_level = self.levels.get(pin)
+    self.levels[pin] = level
+    if old_level == level or pin not in self.callbacks:
+      return
+    edge, callbacks = self.callbacks[pin]
+    rising = level == self.HIGH
+    if edge == self.BOTH or (edge == self.RISING and rising) or (edge == self.FALLING and not rising):
+      for callback in list(callbacks):
+        callback(pin)
+
+  def duty_cycle(self, pin):
+    return self.pwms[pin].duty_cycle
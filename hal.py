@@ -0,0 +1,63 @@
+import os
+import time
+
+# Hardware abstraction layer
+#
+# The controller never imports hardware libraries itself, it is handed a hal
+# with everything it talks to:
+#  GPIO            the RPi.GPIO module (or anything with the same interface)
+#  reader_factory  creates an MFRC522 reader, with the SPI bus and device (chip select)
+#                  as keyword arguments when a station configures them
+#  lcd_bus         SMBus object for the LCD, None to open the real bus
+#  keyboard        the keyboard module (on_press / on_release_key)
+#  clock           monotonic time in seconds
+#  clock_ns        the same clock in integer nanoseconds, for tracing
+#  wall_clock      seconds since the epoch, for the timestamps stored in the database
+#  sleep           blocks for a number of seconds on that clock
+#  wait            how the scheduler blocks until its next deadline, None for real time
+#
+# real_hal() loads the libraries that only exist on the Pi, simulator.simulated_hal()
+# builds one where all of them are simulated. load() picks one based on the
+# LASER_HAL environment variable ("real" or "sim"), defaulting to real.
+
+HAL_ENVIRONMENT_VARIABLE = "LASER_HAL"
+
+class hal:
+
+  def __init__(self, GPIO, reader_factory, keyboard, lcd_bus=None, clock=time.monotonic, sleep=time.sleep, wait=None,
+               clock_ns=time.monotonic_ns, wall_clock=time.time):
+    self.GPIO = GPIO
+    self.reader_factory = reader_factory
+    self.keyboard = keyboard
+    self.lcd_bus = lcd_bus
+    self.clock = clock
+    self.clock_ns = clock_ns
+    self.wall_clock = wall_clock
+    self.sleep = sleep
+    self.wait = wait
+
+def real_hal():
+  import RPi.GPIO as GPIO
+  from mfrc522 import MFRC522 # https://pypi.org/project/mfrc522/
+  import keyboard # https://pypi.org/project/keyboard/
+  return hal(GPIO, halting_reader(MFRC522), keyboard)
+
+# The mfrc522 library has no HLTA command, this adds MFRC522_Halt to its reader.
+# The card never answers a HLTA, so the transceive ends on the reader's timeout.
+def halting_reader(reader_class):
+  class reader(reader_class):
+    def MFRC522_Halt(self):
+      buf = [self.PICC_HALT, 0]
+      buf += self.CalulateCRC(buf)
+      self.MFRC522_ToCard(self.PCD_TRANSCEIVE, buf)
+  return reader
+
+def load(name=None):
+  if name is None:
+    name = os.environ.get(HAL_ENVIRONMENT_VARIABLE, "real")
+  if name == "real":
+    return real_hal()
+  if name == "sim":
+    import simulator
+    return simulator.simulated_hal()
+  raise ValueError("Unknown hal %s, expected 'real' or 'sim'" % name)
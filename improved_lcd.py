@@ -1,47 +1,112 @@
 import RPi_I2C_driver as lcd_driver # https://gist.github.com/DenisFromHR/cc863375a6e19dce359d
 import time
 
+LCD_ROWS = 4
+LCD_COLUMNS = 20
+BLANK_ROW = ' ' * LCD_COLUMNS
+
+# Writing a run of characters costs one DDRAM address command plus one write per
+# character. Two changed runs separated by at most this many unchanged cells are
+# cheaper to send as a single run than as two addressed runs.
+MAX_MERGE_GAP = 1
+
+# Changed-cell count above which a hardware clear followed by redrawing the
+# non-blank cells is cheaper than blanking cells one by one
+CLEAR_THRESHOLD = 40
+
 class lcd(lcd_driver.lcd):
-  
+
   NOT_RECOGNIZED = "Not Recognized"
   NOT_AUTHORIZED = "Not Authorized"
   AUTHORIZED =     "AUTHORIZED"
-  
-  def __init__(self):
-    super().__init__() # call original class constructor, then do custom setup
+
+  def __init__(self, *args, **kwargs):
+    # shadow copy of what is currently on the glass, one string per row
+    # None means unknown, which forces the next write of that row
+    self.framebuffer = [None] * LCD_ROWS
+    super().__init__(*args, **kwargs) # call original class constructor, then do custom setup
     self.setup()
-  
+
   def setup(self):
-    self.clear()
+    # the constructor clears the panel, so the framebuffer starts out blank
+    self.framebuffer = [BLANK_ROW] * LCD_ROWS
     self.backlight(1)
-  
+
+  # forget what is on the panel, the next frame is written in full
+  def invalidate(self):
+    self.framebuffer = [None] * LCD_ROWS
+
   def clear(self):
+    if all(row == BLANK_ROW for row in self.framebuffer):
+      return
     self.lcd_clear()
-  
-  def display_string(self, string, row, display_last_20=True, align_left=False, clear=False):
-    if(clear): self.clear()
+    self.framebuffer = [BLANK_ROW] * LCD_ROWS
+
+  def format_string(self, string, display_last_20=True, align_left=False):
     formatted_str = string
-    if len(string) < 20:
-      padding = (' ' * (20 - len(string)))
+    if len(string) < LCD_COLUMNS:
+      padding = (' ' * (LCD_COLUMNS - len(string)))
       if align_left:
         formatted_str = string + padding
       else:  # Center the string if align_left is False
         half_padding_len = len(padding) // 2
         formatted_str = padding[:half_padding_len] + string + padding[half_padding_len:]
-    elif len(string) > 20 and display_last_20:
-        formatted_str = string[-20:]
-    self.lcd_display_string(formatted_str, row)
-  
+    elif len(string) > LCD_COLUMNS:
+      formatted_str = string[-LCD_COLUMNS:] if display_last_20 else string[:LCD_COLUMNS]
+    return formatted_str
+
+  def display_string(self, string, row, display_last_20=True, align_left=False, clear=False):
+    frame = list(self.framebuffer) if not clear else [BLANK_ROW] * LCD_ROWS
+    frame[row - 1] = self.format_string(string, display_last_20, align_left)
+    self.display_frame(frame)
+
   def display_strings(self, string_with_newlines, display_last_20=True, align_left=False, clear=True):
     list_of_strings = string_with_newlines.split('\n')
     self.display_list_of_strings(list_of_strings, display_last_20, align_left)
-  
+
   def display_list_of_strings(self, strings, display_last_20=True, align_left=False):
-    if len(strings) > 4:
+    if len(strings) > LCD_ROWS:
       raise ValueError("Expected <= 4 strings, but got " + str(len(strings)))
-    
+
+    # rows after the last string are blanked, like the clear this used to do
+    frame = [BLANK_ROW] * LCD_ROWS
     for i, string in enumerate(strings):
-      if i == 0:
-        self.display_string(string, i+1, display_last_20, align_left, clear=True)
+      frame[i] = self.format_string(string, display_last_20, align_left)
+    self.display_frame(frame)
+
+  # Bring the panel to frame (a list of 4 strings of 20 characters),
+  # only writing the cells that differ from what is already displayed
+  def display_frame(self, frame):
+    changed_cells = 0
+    for old, new in zip(self.framebuffer, frame):
+      if old is None:
+        changed_cells += LCD_COLUMNS
       else:
-        self.display_string(string, i+1, display_last_20, align_left)
+        changed_cells += sum(1 for a, b in zip(old, new) if a != b)
+    if changed_cells == 0:
+      return
+
+    if changed_cells > CLEAR_THRESHOLD and sum(len(row.strip()) for row in frame) < changed_cells:
+      self.lcd_clear()
+      self.framebuffer = [BLANK_ROW] * LCD_ROWS
+
+    for row, new in enumerate(frame):
+      old = self.framebuffer[row]
+      for start, end in changed_runs(old, new):
+        self.lcd_display_string_pos(new[start:end], row + 1, start)
+      self.framebuffer[row] = new
+
+# Return (start, end) slices of the cells that differ between old and new,
+# merging runs that are separated by a short unchanged gap
+def changed_runs(old, new):
+  if old is None:
+    return [(0, len(new))]
+  runs = []
+  for i, (a, b) in enumerate(zip(old, new)):
+    if a == b:
+      continue
+    if runs and i - runs[-1][1] <= MAX_MERGE_GAP:
+      runs[-1][1] = i + 1
+    else:
+      runs.append([i, i + 1])
+  return [(start, end) for start, end in runs]
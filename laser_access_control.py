@@ -1,31 +1,62 @@
 #!/usr/bin/env python
 
-import RPi.GPIO as GPIO
-from mfrc522 import MFRC522 # https://pypi.org/project/mfrc522/
+import hal
+import concurrent.futures
 import db_interface
+import sqlite3
 import improved_lcd
-import time
-import keyboard # https://pypi.org/project/keyboard/
+import threading
+import scheduler
+import button
+import tracing
+import session_log
 import signal
 import sys
-import os
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import log_pipeline
+import os
+import trace_replay
 
 # Laser access control system
 # Set to run on startup by adding the following line to /etc/rc.local:
 #  sudo python3 /home/pi/senior_design_FA23/laser-cutter-rfid/laser_access_control.py &
+# The hardware comes from hal.py, run with LASER_HAL=sim to use the simulator instead
 
 # TODO move constants to laser_access_control class?
 
 DATABASE_DIRECTORY = "/home/pi/senior_design_FA23/laser-cutter-rfid/prod.db"
 AUTHENTICATION_KEY = [0x4A, 0x1E, 0xD9, 0x40, 0xF4, 0x4B]
+CSU_ID_SECTOR = 1
+CSU_ID_BLOCK = CSU_ID_SECTOR * 4
 
 # timing constants
-LASER_OFF_POLLING_RATE_SECONDS = 0.5
-LASER_ON_POLLING_RATE_SECONDS  = 1
+LASER_OFF_POLLING_RATE_SECONDS = 0.5 # also the longest it takes to notice a tap when idle
+LASER_ON_POLLING_RATE_SECONDS  = 0.25 # presence checks are cheap (see check_card_present)
 LASER_ON_GRACE_PERIOD_SECONDS  = 20
 ADD_USER_TIMEOUT_SECONDS       = 30
+ADD_USER_POLLING_RATE_SECONDS  = 1
+COUNTDOWN_REFRESH_SECONDS      = 1
+EXPIRY_SWEEP_INTERVAL_SECONDS  = 3600 # how often expired users are moved to users_archive
+EXPIRY_SWEEP_BATCH_DELAY_SECONDS = 1  # pause between batches while there is a backlog
+# The sweep runs on the main loop, so it only waits this many milliseconds for another
+# writer (Scripts/add_admin.py, a merge or a sync) and tries again a little later
+EXPIRY_SWEEP_BUSY_TIMEOUT_MS = 20
+EXPIRY_SWEEP_RETRY_SECONDS = 5
+# longest a reader transaction (request, anticollision, select, auth and read) is
+# expected to take; a poll is held back if a relay shutoff is due within this time
+READER_TRANSACTION_BUDGET_SECONDS = 0.05
+
+# requests sent before a card is considered missing, see check_card_present
+PRESENCE_CHECK_REQUESTS = 2
+
+# seconds a card that keeps failing sector authentication (not a RamCard, or a
+# RamCard with another key) is not authenticated again, see read_csu_id
+AUTH_FAILURE_MEMO_SECONDS = 30
+MAX_AUTH_FAILURE_MEMO_ENTRIES = 64
+
+# look the user up while the card is authenticated and read the CSU ID after the
+# relay is switched, see pipelined_tap; False runs every step in turn
+PIPELINED_TAPS = True
 
 # pin number constants
 LASER_RELAY_PIN_NUMBER = 8
@@ -34,28 +65,22 @@ RED_LED_PIN_NUMBER = 32
 GREEN_LED_PIN_NUMBER = 33
 BLUE_LED_PIN_NUMBER = 35
 
-# Ensure the 'logs' folder exists
-log_folder = "Logs"
-os.makedirs(log_folder, exist_ok=True)
-
-# Configure logging
-# Creates rotating log files every 30 days at midnight
-log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-log_handler = TimedRotatingFileHandler('Logs/laser_access_control.log', when='midnight', interval=30, backupCount=12)
-log_handler.setFormatter(log_formatter)
-log_handler.setLevel(logging.DEBUG)
-log_handler.suffix = "%Y-%m.log"
+# Log records go through log_pipeline: the controller only enqueues them, a
+# background thread writes Logs/laser_access_control.log (set up in __main__)
+LOG_FILE = 'Logs/laser_access_control.log'
 
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-logger.addHandler(log_handler)
+
+# called from the keyboard thread after every key press while keyboard input is
+# accepted, so that name entry is driven by the key presses (see start_name_entry)
+key_listener = None
 
 shift_chars = {'1':'!', '2':'@', '3':'#', '4':'$', '5':'%', '6':'^', '7':'&', '8':'*', '9':'(', '0':')', '-':'_', '=':'+', '\\':'|', '`':'~', '[':'{', ']':'}', ';':':', '\'':'"', ',':'<', '.':'>', '/':'?'}
 
 # ---------- keyboard handling stuff ---------
 
 def process_key_press(event):
-  global name_from_keyboard, id_from_keyboard, keyboard_done, shift_pressed, accepting_keyboard_input, input_mode
+  global shift_pressed
   
   if event.name == 'shift':
     shift_pressed = True
@@ -63,12 +88,19 @@ def process_key_press(event):
   if not accepting_keyboard_input:
     return
   
+  edit_keyboard_input(event)
+  if key_listener:
+    key_listener()
+
+def edit_keyboard_input(event):
+  global name_from_keyboard, id_from_keyboard, keyboard_done, input_mode
+  
   if event.name == 'enter':
     keyboard_done = True
     if input_mode == 'name':
       input_mode = 'id'
     elif input_mode == 'id' and len(id_from_keyboard) != 9:
-      print("Invalid input. Please enter a 9 digit number.")
+      logger.debug("Invalid CSU ID input, expected a 9 digit number")
       keyboard_done = False
     return
   
@@ -112,136 +144,387 @@ def process_shift_release(event):
 
 # ---------- end keyboard handling stuff -----
 
-# standardize checking done button
-#  since the button is connected between the input pin and ground
-#  when pressed it will pull the pin LOW
-#  when not pressed, the pin is pulled high by a built-in pull-up resistor on the Pi
-def is_done_button_pressed():
-  return not GPIO.input(DONE_BUTTON_PIN_NUMBER)
+# The wiring of one station: which pins drive its relay and LED, which pin its
+# DONE button is on, which SPI chip select its reader is on and which I2C address
+# its LCD is at. The defaults are the wiring of a single station.
+#  reader      keyword arguments for hal.reader_factory, e.g. {'bus': 0, 'device': 1}
+#  poll_phase  fraction of a polling period to offset this station's reader polls by,
+#              so that the readers of several stations are not all polled at once
+class station_config:
+  
+  def __init__(self, name="laser", relay_pin=LASER_RELAY_PIN_NUMBER, done_button_pin=DONE_BUTTON_PIN_NUMBER,
+               led_pins=(RED_LED_PIN_NUMBER, GREEN_LED_PIN_NUMBER, BLUE_LED_PIN_NUMBER), reader=None,
+               lcd_address=None, poll_phase=0):
+    self.name = name
+    self.relay_pin = relay_pin
+    self.done_button_pin = done_button_pin
+    self.led_pins = tuple(led_pins)
+    self.reader = dict(reader or {})
+    self.lcd_address = lcd_address
+    self.poll_phase = poll_phase
 
-class laser_access_control:
+# The card in the reader's field and what has been read from it
+# Starts when the sector of a card is first read and ends when the card leaves the
+# field; until then the CSU ID is taken from here instead of authenticating again
+# (the sector of a RamCard does not change while it is being tapped).
+class card_session:
   
-  def __init__(self):
-    self.setup()
+  def __init__(self, uid, csu_id, block):
+    self.uid = uid
+    self.csu_id = csu_id
+    self.block = block
+    self.reads = 0
+
+# Everything the stations driven by one process share: the main loop, the tracer,
+# the database connection (and with it the user lookup cache) and the session writer
+class shared_resources:
   
-  def setup(self):
+  def __init__(self, station_hal, database=DATABASE_DIRECTORY):
     global shift_pressed, accepting_keyboard_input
     
     shift_pressed = False
     accepting_keyboard_input = False
     
-    # -- keyboard setup --
-    keyboard.on_press(process_key_press)
-    keyboard.on_release_key('shift', process_shift_release)
+    self.hal = station_hal
     
-    # -- GPIO setup --
-    self.GPIO_setup()
+    # -- main loop setup --
+    self.scheduler = scheduler.scheduler(clock=station_hal.clock, wait=station_hal.wait)
+    self.tracer = tracing.tracer(clock_ns=station_hal.clock_ns)
     
-    # -- rfid setup --
-    self.reader = MFRC522()
+    # -- keyboard setup --
+    station_hal.keyboard.on_press(process_key_press)
+    station_hal.keyboard.on_release_key('shift', process_shift_release)
     
     # connect to database
     #  use absolute path because when this script runs at boot (using /etc/rc.local),
     #  it is not launched from this folder that it is in
-    self.db = db_interface.db_interface(DATABASE_DIRECTORY)
+    # The connection is lent to the lookup thread for one lookup at a time (see
+    # pipelined_tap); the main loop waits for the lookup's result before it uses
+    # the connection again, so the two threads never use it at the same time
+    self.db = db_interface.db_interface(database, clock=station_hal.clock, check_same_thread=False,
+                                        wall_clock=station_hal.wall_clock)
+    self.lookups = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-lookup")
+    # laser sessions are written to laser_log by a background thread
+    self.sessions = session_log.session_recorder(database)
+    
+    # every laser_access_control built on these resources adds itself here
+    self.stations = []
+  
+  def all_idle(self):
+    return all(station.state == laser_access_control.IDLE_STATE for station in self.stations)
+  
+  # Move one batch of expired users to users_archive, only while nobody is using any laser
+  # A full batch means there may be more, the next one follows after a short pause
+  def sweep_expired_users(self):
+    if not self.all_idle():
+      return
+    with self.tracer.span("db.sweep"):
+      try:
+        archived = self.db.archive_expired_users(busy_timeout=EXPIRY_SWEEP_BUSY_TIMEOUT_MS)
+      except sqlite3.OperationalError as error:
+        if not db_interface.is_busy(error):
+          raise
+        logger.info("Database busy, sweeping expired users again in %d seconds", EXPIRY_SWEEP_RETRY_SECONDS)
+        self.scheduler.call_later(EXPIRY_SWEEP_RETRY_SECONDS, self.sweep_expired_users)
+        return
+    if archived:
+      logger.info("Archived %d expired users", archived)
+    if archived == db_interface.ARCHIVE_BATCH_SIZE:
+      self.scheduler.call_later(EXPIRY_SWEEP_BATCH_DELAY_SECONDS, self.sweep_expired_users)
+  
+  # the stations must have been closed first
+  def close(self):
+    self.scheduler.stop()
+    self.lookups.shutdown()
+    self.sessions.close()
+    self.db.close()
+    self.hal.GPIO.cleanup()
+
+class laser_access_control:
+  
+  # controller states
+  IDLE_STATE = "IDLE"
+  LASER_ON_STATE = "LASER ON"
+  MESSAGE_STATE = "MESSAGE" # showing a result for a few seconds before going back to idle
+  ADD_USER_STATE = "ADD USER" # an admin is enrolling cards, see add_user_mode
+  
+  # station_hal is a hal.hal, by default the one picked by hal.load()
+  # config is a station_config, by default the wiring of a single station
+  # shared is the shared_resources of the other stations in this process, a station
+  # on its own creates its own
+  def __init__(self, station_hal=None, database=DATABASE_DIRECTORY, config=None, shared=None):
+    if station_hal is None:
+      station_hal = hal.load()
+    self.hal = station_hal
+    self.GPIO = station_hal.GPIO
+    self.sleep = station_hal.sleep
+    self.config = config or station_config()
+    self.setup(database, shared)
+  
+  def setup(self, database=DATABASE_DIRECTORY, shared=None):
+    if shared is None:
+      shared = shared_resources(self.hal, database)
+    self.shared = shared
+    shared.stations.append(self)
+    self.scheduler = shared.scheduler
+    self.tracer = shared.tracer
+    self.db = shared.db
+    self.sessions = shared.sessions
+    
+    # -- GPIO setup --
+    self.GPIO_setup()
+    
+    # -- rfid setup --
+    self.reader = self.hal.reader_factory(**self.config.reader)
     
     # -- LCD setup --
-    self.lcd = improved_lcd.lcd()
+    if self.config.lcd_address is None:
+      self.lcd = improved_lcd.lcd(bus=self.hal.lcd_bus, sleep=self.sleep)
+    else:
+      self.lcd = improved_lcd.lcd(self.config.lcd_address, bus=self.hal.lcd_bus, sleep=self.sleep)
+    # every display_string/display_list_of_strings call ends up in display_frame
+    self.lcd.display_frame = self.tracer.wrap("lcd.write", self.lcd.display_frame)
+    self.lcd.clear = self.tracer.wrap("lcd.clear", self.lcd.clear)
+    
+    # -- controller state --
+    self.state = None
+    self.reader_task = None
+    self.message_task = None
+    self.grace_task = None
+    self.countdown_task = None
+    self.sweep_task = None
+    self.led_color = None
+    # add user mode: which step it is waiting in ('card', 'confirm' or 'name', None
+    # while it shows a message), when it gives up waiting for a card, and the
+    # (uid, csu_id, name of the entry it updates or None) of the card being enrolled
+    self.add_user_step = None
+    self.add_user_deadline = None
+    self.enrollment = None
+    self.tap_started_ns = None
+    self.pipelined = PIPELINED_TAPS
+    # uid -> when a card that failed authentication may be authenticated again
+    self.auth_failures = {}
+    self.auth_failure_hits = 0
+    self.last_auth_failure = None
+    # the card in the field, see card_session
+    self.card = None
+    self.card_session_hits = 0
+    # idle requests in a row that no card answered
+    self.idle_requests_unanswered = 0
+    # the card was halted (or has dropped back to IDLE), so a single WUPA reaches it
+    self.card_halted = False
+    
+    # laser session state
+    self.current_user_uid = None
+    self.current_name = None
+    self.card_missing_deadline = None
+    self.session = None
   
   def GPIO_setup(self):
+    GPIO = self.GPIO
+    config = self.config
     GPIO.setmode(GPIO.BOARD)
     GPIO.setwarnings(False)
-    GPIO.setup(LASER_RELAY_PIN_NUMBER, GPIO.OUT, initial=GPIO.LOW)
-    GPIO.setup(DONE_BUTTON_PIN_NUMBER, GPIO.IN, pull_up_down=GPIO.PUD_UP) # enable Pi's built-in pull-up resistor for this pin
+    GPIO.setup(config.relay_pin, GPIO.OUT, initial=GPIO.LOW)
+    self.relay_level = GPIO.LOW
+    # held while the relay pin and relay_level change, the DONE button interrupt cuts the relay from the GPIO thread
+    self.relay_lock = threading.Lock()
+    GPIO.setup(config.done_button_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP) # enable Pi's built-in pull-up resistor for this pin
+    
+    # the button is connected between the input pin and ground, so when pressed it pulls the pin LOW
+    # presses arrive as edge interrupts and are handed to the main loop as they happen
+    # on a simulated clock waiting for a press has to let simulated time pass
+    simulated = self.hal.wait is not None
+    self.done_button = button.button(GPIO, config.done_button_pin, active_low=True, clock=self.scheduler.clock,
+                                     sleep=self.sleep if simulated else None)
+    self.done_button.add_listener(self.on_button_event)
     
-    GPIO.setup(RED_LED_PIN_NUMBER, GPIO.OUT);
-    GPIO.setup(GREEN_LED_PIN_NUMBER, GPIO.OUT);
-    GPIO.setup(BLUE_LED_PIN_NUMBER, GPIO.OUT);
+    red_pin, green_pin, blue_pin = config.led_pins
+    GPIO.setup(red_pin, GPIO.OUT);
+    GPIO.setup(green_pin, GPIO.OUT);
+    GPIO.setup(blue_pin, GPIO.OUT);
     
-    self.red = GPIO.PWM(RED_LED_PIN_NUMBER, 2);
-    self.green = GPIO.PWM(GREEN_LED_PIN_NUMBER, 2);
-    self.blue = GPIO.PWM(BLUE_LED_PIN_NUMBER, 2);
+    self.red = GPIO.PWM(red_pin, 2);
+    self.green = GPIO.PWM(green_pin, 2);
+    self.blue = GPIO.PWM(blue_pin, 2);
     
     self.green.start(0)
     self.red.start(0)
     self.blue.start(0)
   
   # params should range from 0 - 100, inclusive
+  # the PWM is only touched when the color actually changes
   def set_LED(self, r, g, b):
-    self.red.ChangeDutyCycle(r)
-    self.green.ChangeDutyCycle(g)
-    self.blue.ChangeDutyCycle(b)
+    if self.led_color == (r, g, b):
+      return
+    with self.tracer.span("led"):
+      self.red.ChangeDutyCycle(r)
+      self.green.ChangeDutyCycle(g)
+      self.blue.ChangeDutyCycle(b)
+    self.led_color = (r, g, b)
+  
+  # the pin is only written when the level changes, the DONE button interrupt
+  # may already have turned the relay off by the time the main loop does
+  def set_relay(self, level):
+    with self.relay_lock:
+      if self.relay_level == level:
+        return
+      with self.tracer.span("relay"):
+        self.GPIO.output(self.config.relay_pin, level)
+      self.relay_level = level
   
-  # TODO use new read method to read csu id
+  # called from the GPIO callback thread, so no span is recorded: the main loop
+  # may be going through the tracer's spans
+  def cut_relay(self):
+    with self.relay_lock:
+      self.GPIO.output(self.config.relay_pin, self.GPIO.LOW)
+      self.relay_level = self.GPIO.LOW
+  
+  # Add user mode is a state of the station like the others, each step waits in a
+  # scheduled task or for a DONE press or key press, so the other stations keep
+  # polling their readers and supervising their lasers meanwhile:
+  #  'card'     a new card is polled for every ADD_USER_POLLING_RATE_SECONDS, DONE
+  #             or ADD_USER_TIMEOUT_SECONDS without a card leaves add user mode
+  #  'confirm'  an enrolled card is only updated if DONE is pressed within 7 seconds
+  #  'name'     the new user types their name, enter adds them
   def add_user_mode(self):
+    # there is one keyboard, so only one station adds users at a time
+    if any(station.state == self.ADD_USER_STATE for station in self.shared.stations if station is not self):
+      self.lcd.display_list_of_strings(["", "Another station is", "adding users"])
+      self.show_message(2)
+      return
+    
     # indicate that the system is adding users
+    self.state = self.ADD_USER_STATE
     self.set_LED(100, 0, 100) # purple
     self.lcd.display_string("Adding Users!", 2, clear=True)
-    time.sleep(3)
-
-    while True:
-      # continue_loop = False # Flag to continue the outer loop
-      update_entry = False
-      card_data = self.read_card()
-      
-      # if a card is not read within ADD_USER_TIMEOUT_SECONDS,
-      #  exit add user mode
-      timeout = ADD_USER_TIMEOUT_SECONDS
-      while not card_data:
-        card_data = self.read_card()
-        time.sleep(1)
-        timeout -= 1
-        self.lcd.display_string("Scan new RamCard", 1)
-        self.lcd.display_string("or wait %d seconds" % timeout, 2)
-        self.lcd.display_string("to exit add mode", 3)
-
-        if timeout == 0: 
-          self.lcd.clear()
-          return # exit add user mode if no card is read within ADD_USER_TIMEOUT_SECONDS
-        
-        # Exit adding user mode if DONE button is pressed
-        if is_done_button_pressed():
-          self.lcd.display_string("Exiting add mode", 2, clear=True)
-          time.sleep(2)
-          return
-      
-      uid_to_add, csu_id_to_add = card_data
-      data = self.db.get_row_from_uid(uid_to_add)
-      # check if there is an existing entry with this uid
-      if (data):
-        if data.is_admin(): # admin cards should not be updated
-          self.lcd.display_list_of_strings(["Admin card cannot", "be updated"])
-          time.sleep(1)
-          continue
-        existing_name = data.get_name()[:15]
-        self.lcd.display_list_of_strings(["Update entry for", "%s?" % existing_name, "press and hold", "DONE to confirm"])
-        
-        start_time = time.time()
-        while time.time() - start_time < 7: # give 7 seconds for user to push button
-          if is_done_button_pressed():
-            # only change the entry if the DONE button was pressed
-            self.lcd.display_list_of_strings(["", "Entry will", "be updated"])
-            update_entry = True
-            logger.warning("Updating entry for %s", existing_name)
-            time.sleep(2)
-            break
-        if not update_entry:
-          self.lcd.display_list_of_strings(["", "Entry will not", "be updated"])
-          # continue_loop = True
-          time.sleep(2)
-          continue # go back to top of outer while loop
-      
-      # TODO multiple updated entries or skipped updated entries has not been tested.
-      # user types in their name on the keyboard
-      name_to_add = self.activate_keyboard_and_get_name()
-      
-      # add them to the database as a user
-      self.db.add_user(uid_to_add, csu_id_to_add, name_to_add)
+    self.add_user_message(3)
+  
+  # leave the current display up for a few seconds, then carry on in add user mode
+  def add_user_message(self, seconds, then=None):
+    self.add_user_step = None
+    self.cancel_task('reader_task')
+    self.cancel_task('message_task')
+    self.message_task = self.scheduler.call_later(seconds, then or self.wait_for_new_card)
+  
+  def wait_for_new_card(self):
+    self.message_task = None
+    self.add_user_step = 'card'
+    self.enrollment = None
+    self.add_user_deadline = self.scheduler.clock() + ADD_USER_TIMEOUT_SECONDS
+    self.lcd.clear()
+    # presses from before this step do not count
+    self.done_button.get_events()
+    self.set_reader_polling_rate(ADD_USER_POLLING_RATE_SECONDS)
+  
+  def poll_reader_add_user(self):
+    # the card that is still on the reader (the admin's, or the one just enrolled)
+    # has to leave the field before it is taken again
+    uid_bytes = self.request_card()
+    if uid_bytes is not None and not self.in_card_session(uid_bytes):
+      csu_id = self.read_csu_id(uid_bytes)
+      if csu_id is not None:
+        self.enroll_card(self.uid_to_num(uid_bytes), csu_id)
+        return
+    
+    seconds_left = round(self.add_user_deadline - self.scheduler.clock())
+    if seconds_left <= 0:
+      self.leave_add_user_mode()
+      return
+    self.lcd.display_string("Scan new RamCard", 1)
+    self.lcd.display_string("or wait %d seconds" % seconds_left, 2)
+    self.lcd.display_string("to exit add mode", 3)
+  
+  def enroll_card(self, uid_to_add, csu_id_to_add):
+    self.enrollment = (uid_to_add, csu_id_to_add, None)
+    data = self.db.get_row_from_uid(uid_to_add)
+    # check if there is an existing entry with this uid
+    if data:
+      if data.is_admin(): # admin cards should not be updated
+        self.lcd.display_list_of_strings(["Admin card cannot", "be updated"])
+        self.add_user_message(1)
+        return
+      existing_name = data.get_name()[:15]
+      self.enrollment = (uid_to_add, csu_id_to_add, existing_name)
+      self.lcd.display_list_of_strings(["Update entry for", "%s?" % existing_name, "press and hold", "DONE to confirm"])
       
-      self.lcd.display_list_of_strings(["Added user", name_to_add, "with id", csu_id_to_add])
-      logger.info("Added user %s with ID %s", name_to_add, csu_id_to_add)
-      time.sleep(3)
-      self.lcd.clear()
+      # give 7 seconds for user to push button
+      # only change the entry if the DONE button was pressed
+      self.add_user_message(7, self.update_not_confirmed)
+      self.add_user_step = 'confirm'
+      self.done_button.get_events()
+      return
+    
+    # a returning user whose entry expired and was archived gets it back without retyping it
+    if self.db.get_archived_user(uid_to_add):
+      user = self.db.reinstate_user(uid_to_add)
+      self.lcd.display_list_of_strings(["Reinstated user", user.get_name(), "with id", str(user.get_csu_id())])
+      logger.info("Reinstated user %s with ID %s", user.get_name(), user.get_csu_id())
+      self.add_user_message(3)
+      return
+    
+    self.start_name_entry()
+  
+  def update_confirmed(self):
+    existing_name = self.enrollment[2]
+    self.lcd.display_list_of_strings(["", "Entry will", "be updated"])
+    logger.warning("Updating entry for %s", existing_name)
+    self.add_user_message(2, self.start_name_entry)
+  
+  def update_not_confirmed(self):
+    self.lcd.display_list_of_strings(["", "Entry will not", "be updated"])
+    self.add_user_message(2)
+  
+  # TODO multiple updated entries or skipped updated entries has not been tested.
+  # user types in their name on the keyboard
+  def start_name_entry(self):
+    global name_from_keyboard, keyboard_done, accepting_keyboard_input, input_mode, key_listener
+    
+    self.message_task = None
+    self.add_user_step = 'name'
+    name_from_keyboard = ""
+    keyboard_done = False
+    input_mode = 'name'
+    key_listener = self.on_key_press
+    accepting_keyboard_input = True
+    
+    # Prompt the user to enter their name with the keyboard
+    self.lcd.display_string("Enter your name:", 1, clear=True)
+  
+  # called from the keyboard thread
+  def on_key_press(self):
+    self.scheduler.call_soon_threadsafe(self.handle_name_entry)
+  
+  def handle_name_entry(self):
+    global accepting_keyboard_input, key_listener
+    
+    if self.add_user_step != 'name':
+      return
+    if not keyboard_done:
+      self.lcd.display_string(name_from_keyboard, 2, clear=False)
+      return
+    accepting_keyboard_input = False
+    key_listener = None
+    
+    # add them to the database as a user
+    uid_to_add, csu_id_to_add, existing_name = self.enrollment
+    name_to_add = name_from_keyboard
+    self.db.add_user(uid_to_add, csu_id_to_add, name_to_add)
+    
+    self.lcd.display_list_of_strings(["Added user", name_to_add, "with id", str(csu_id_to_add)])
+    logger.info("Added user %s with ID %s", name_to_add, csu_id_to_add)
+    self.add_user_message(3)
+  
+  def leave_add_user_mode(self):
+    global accepting_keyboard_input, key_listener
+    
+    if self.add_user_step == 'name':
+      accepting_keyboard_input = False
+      key_listener = None
+    self.add_user_step = None
+    self.enrollment = None
+    self.lcd.clear()
+    self.enter_idle()
   
   # Helper function from SimpleMFRC522
   # Converting a list of bytes (represented as integers) into a single decimal number
@@ -251,217 +534,539 @@ class laser_access_control:
         n = n * 256 + uid[i]
     return n
 
-  # Helper function to read the card using the authentication key
-  # Current returns uid and csu id in a list as (uid, id)
-  def read_card(self):
-    (status, uid) = self.reader.MFRC522_Anticoll()
-    if status == self.reader.MI_OK:
-        self.reader.MFRC522_SelectTag(uid)
+  # Run anticollision on the card that answered the last request
+  # Returns the uid as a list of bytes, or None
+  def read_uid(self):
+    with self.tracer.span("reader.anticoll"):
+      (status, uid) = self.reader.MFRC522_Anticoll()
+    if status != self.reader.MI_OK:
+      return None
+    return uid
+
+  # Select the card and read the CSU ID from sector 1 using the authentication key
+  # Returns the CSU ID, or None if the card could not be authenticated or read
+  def read_csu_id(self, uid):
+    if self.in_card_session(uid):
+      return self.card_session_csu_id()
+    if not self.authenticate_card(uid):
+      return None
+    return self.read_authenticated_csu_id(uid)
+  
+  def in_card_session(self, uid):
+    return self.card is not None and self.card.uid == self.uid_to_num(uid)
+  
+  def card_session_csu_id(self):
+    self.card.reads += 1
+    self.card_session_hits += 1
+    return self.card.csu_id
+  
+  # Select the card and authenticate sector 1 with the authentication key
+  # Returns False if the card could not be authenticated
+  # A card that fails authentication twice in a row is not tried again for
+  # AUTH_FAILURE_MEMO_SECONDS (once can be a RamCard pulled away in the middle of the read),
+  # unless the lookup finds it enrolled, see forget_auth_failure()
+  def authenticate_card(self, uid):
+    uid_num = self.uid_to_num(uid)
+    retry_at = self.auth_failures.get(uid_num)
+    if retry_at is not None:
+      if retry_at > self.scheduler.clock():
+        self.auth_failure_hits += 1
+        return False
+      del self.auth_failures[uid_num]
+    
+    with self.tracer.span("reader.select"):
+      self.reader.MFRC522_SelectTag(uid)
 
-        sector = 1  # Replace with the sector number you want to read
-        block_addr = sector * 4  # Calculate the block address based on the sector number
+    with self.tracer.span("reader.auth"):
+      status = self.reader.MFRC522_Auth(self.reader.PICC_AUTHENT1A, CSU_ID_BLOCK, AUTHENTICATION_KEY, uid)
+    if status != self.reader.MI_OK:
+      logger.debug("Card authentication failed")
+      if self.last_auth_failure == uid_num:
+        if len(self.auth_failures) >= MAX_AUTH_FAILURE_MEMO_ENTRIES:
+          self.auth_failures.clear()
+        self.auth_failures[uid_num] = self.scheduler.clock() + AUTH_FAILURE_MEMO_SECONDS
+      self.last_auth_failure = uid_num
+      return False
+    self.last_auth_failure = None
+    return True
+  
+  # An enrolled card that fails authentication was pulled away during the read, however
+  # often that happens, so it is tried again on the next poll instead of being ignored
+  def forget_auth_failure(self, uid):
+    self.auth_failures.pop(uid, None)
+  
+  # Read the CSU ID from the sector authenticate_card() opened and start a card session
+  # Returns the CSU ID, or None if the block could not be read
+  def read_authenticated_csu_id(self, uid):
+    uid_num = self.uid_to_num(uid)
+    with self.tracer.span("reader.read"):
+      data = self.reader.MFRC522_Read(CSU_ID_BLOCK)
+      self.reader.MFRC522_StopCrypto1()
+    if not data:
+      logger.debug("Failed to read data from sector %d", CSU_ID_SECTOR)
+      return None
+    trimmed_data = data[3:8]  # Adjust indices as needed
+    decimal_value = int.from_bytes(trimmed_data, byteorder='big')
+    decimal_value //= 10  # Remove the last digit
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug("Read card %s, CSU ID %d, raw bytes %s", ':'.join('%02x' % i for i in uid), decimal_value, trimmed_data)
+    self.card = card_session(uid_num, decimal_value, list(data))
+    return decimal_value
+  
+  # the card that was read has left the field
+  def end_card_session(self):
+    self.card = None
 
-        status = self.reader.MFRC522_Auth(self.reader.PICC_AUTHENT1A, block_addr, AUTHENTICATION_KEY, uid)
-        if status == self.reader.MI_OK:
-            print("Authentication successful")
-            data = self.reader.MFRC522_Read(block_addr)
-            self.reader.MFRC522_StopCrypto1()
-            if data:
-                print("Data read from sector", sector)
-                trimmed_data = data[3:8]  # Adjust indices as needed
-                decimal_value = int.from_bytes(trimmed_data, byteorder='big')
-                decimal_value //= 10  # Remove the last digit
-                print("Card UID:", ':'.join(hex(i)[2:].zfill(2) for i in uid))
-                print("CSU ID:", decimal_value)
-                print("Raw bytes:", trimmed_data)
-                return self.uid_to_num(uid), decimal_value
-            else:
-                print("Failed to read data from sector", sector)
-        else:
-            print("Authentication failed")
+  # Cheap check for which card is on the reader, without selecting or authenticating it
+  # Returns the uid as a list of bytes, or None if no card answers
+  #
+  # WUPA (PICC_REQALL) is used instead of REQA so that a card that has been halted
+  # still answers. The laser on poll halts the card once its uid matches, so each
+  # tick only needs one request. A card that was just read is still READY or
+  # ACTIVE, it ignores the first request and drops back to IDLE, so then a second
+  # request is sent before the card is considered missing.
+  def check_card_present(self):
+    requests = 1 if self.card_halted else PRESENCE_CHECK_REQUESTS
+    self.card_halted = False
+    for attempt in range(requests):
+      with self.tracer.span("reader.request"):
+        (status, tag_type) = self.reader.MFRC522_Request(self.reader.PICC_REQALL)
+      if status == self.reader.MI_OK:
+        return self.read_uid()
+    # whichever card comes back is in IDLE
+    self.card_halted = True
     return None
   
+  # HLTA, a halted card only answers WUPA and otherwise stays quiet in the field
+  def halt_card(self):
+    with self.tracer.span("reader.halt"):
+      self.reader.MFRC522_Halt()
+    self.card_halted = True
+  
+  # ---------- main loop ----------
+  # main() only sets up the scheduled tasks, all work happens in their callbacks:
+  #  poll_reader()      every LASER_OFF_POLLING_RATE_SECONDS when idle,
+  #                     every LASER_ON_POLLING_RATE_SECONDS while the laser is on
+  #  on_button_event()  as soon as the DONE button interrupt fires
+  #  refresh_countdown  while the card is missing
+  #  time_up()          when the card has been missing for LASER_ON_GRACE_PERIOD_SECONDS
+  #  enter_idle()       when a message has been shown long enough
+  #  handle_name_entry()  after a key press while a new user types their name
+  #  sweep_expired_users()  every EXPIRY_SWEEP_INTERVAL_SECONDS, does nothing while a laser is in use
+  # Between deadlines the scheduler sleeps, so the idle station uses no CPU.
+  #
+  # time_up() runs at PRIORITY_SAFETY, and reader polls declare the time a reader
+  # transaction can take as their budget, so when several stations share the loop
+  # a read on one station is held back rather than delay another station's shutoff.
+  
   def main(self):
-    print("System ready")
-    while True:
-      (status, tag_type) = self.reader.MFRC522_Request(self.reader.PICC_REQIDL)
+    logger.info("System ready")
+    self.enter_idle()
+    self.sweep_task = self.scheduler.call_every(EXPIRY_SWEEP_INTERVAL_SECONDS, self.shared.sweep_expired_users)
+    self.scheduler.run()
+  
+  def set_reader_polling_rate(self, seconds, delay=0):
+    if self.reader_task:
+      self.reader_task.cancel()
+    delay += seconds * self.config.poll_phase
+    self.reader_task = self.scheduler.call_every(seconds, self.poll_reader, delay=delay,
+                                                 budget=READER_TRANSACTION_BUDGET_SECONDS)
+  
+  def cancel_task(self, name):
+    scheduled = getattr(self, name)
+    if scheduled:
+      scheduled.cancel()
+    setattr(self, name, None)
+  
+  def enter_idle(self):
+    self.state = self.IDLE_STATE
+    self.cancel_task('message_task')
+    self.set_LED(0, 0, 100) # Blue
+    self.lcd.display_string("Scan RamCard", row=2, align_left=False, clear=True)
+    self.set_reader_polling_rate(LASER_OFF_POLLING_RATE_SECONDS)
+  
+  # leave the current display up for a few seconds, then go back to idle
+  def show_message(self, seconds):
+    self.state = self.MESSAGE_STATE
+    self.cancel_task('reader_task')
+    self.cancel_task('message_task')
+    self.message_task = self.scheduler.call_later(seconds, self.enter_idle)
+  
+  def poll_reader(self):
+    if self.state == self.IDLE_STATE:
+      self.poll_reader_idle()
+    elif self.state == self.LASER_ON_STATE:
+      with self.tracer.span("recheck"):
+        self.poll_reader_laser_on()
+    elif self.state == self.ADD_USER_STATE:
+      self.poll_reader_add_user()
+  
+  # Ask for a card that has entered the field and run anticollision on it
+  # Returns the uid as a list of bytes, or None
+  def request_card(self):
+    # a card left on the reader by a laser session was halted, only WUPA wakes it
+    request_mode = self.reader.PICC_REQALL if self.card_halted else self.reader.PICC_REQIDL
+    self.card_halted = False
+    with self.tracer.span("reader.request"):
+      (status, tag_type) = self.reader.MFRC522_Request(request_mode)
+    if status != self.reader.MI_OK:
+      # a card that is still in the field ignores every other idle request (see
+      # check_card_present), so it has left when several in a row go unanswered
+      self.idle_requests_unanswered += 1
+      if self.idle_requests_unanswered >= PRESENCE_CHECK_REQUESTS:
+        self.end_card_session()
+      return None
+    self.idle_requests_unanswered = 0
+    return self.read_uid()
+  
+  def poll_reader_idle(self):
+    # a tap is timed from the request that first sees the card
+    request_started_ns = self.tracer.clock_ns()
+    uid_bytes = self.request_card()
+    if uid_bytes is None:
+      return
+    self.tap_started_ns = request_started_ns
+    uid = self.uid_to_num(uid_bytes)
+    # a card that was just looked up and is not enrolled is not authenticated and read
+    # again, its lookup comes from the negative cache (see db_interface.get_row_from_uid)
+    if self.db.is_known_unknown(uid):
+      csu_id = None
+    elif self.pipelined:
+      self.pipelined_tap(uid_bytes, uid)
+      return
+    else:
+      csu_id = self.read_csu_id(uid_bytes)
+      if csu_id is None:
+        # the card could not be read (moved away or not a RamCard), try again next poll
+        if self.db.get_row_from_uid(uid) is not None:
+          self.forget_auth_failure(uid)
+        return
+      logger.debug("Using IDs: %d %d", uid, csu_id)
+    # Card detected, get database entry
+    with self.tracer.span("db.lookup"):
+      row = self.db.get_row_from_uid(uid)
+    self.handle_tap(uid, csu_id, row)
+  
+  # The lookup only needs the uid, so it runs on the lookup thread while the main
+  # loop authenticates the card. Authentication still decides whether the card is
+  # a RamCard at all, but once both are done the relay is switched right away and
+  # the CSU ID, which is only needed for the session and the log, is read after.
+  def pipelined_tap(self, uid_bytes, uid):
+    lookup = self.shared.lookups.submit(self.lookup_user, uid)
+    in_session = self.in_card_session(uid_bytes)
+    authenticated = in_session or self.authenticate_card(uid_bytes)
+    row, lookup_started_ns, lookup_ns = lookup.result()
+    self.tracer.record("db.lookup", lookup_started_ns, lookup_ns)
+    
+    def read_csu_id():
+      return self.card_session_csu_id() if in_session else self.read_authenticated_csu_id(uid_bytes)
+    
+    if not authenticated:
+      # a card that is not enrolled is not recognized whatever it is, an enrolled
+      # one may have been moved away during the read, try again next poll
+      if row is None:
+        self.handle_tap(uid, None, None)
+      else:
+        self.forget_auth_failure(uid)
+      return
+    with self.tracer.span("db.check"):
+      authorized = row is not None and self.db._check_uid(row)
+    if not authorized or self.done_button.is_pressed():
+      csu_id = read_csu_id()
+      if csu_id is None:
+        return
+      self.handle_tap(uid, csu_id, row)
+      return
+    
+    name = row.get_name()
+    self.lcd.display_string(name, 2)
+    self.record_tap("tap.scan_to_decision")
+    self.start_laser(uid, None, name)
+    csu_id = read_csu_id()
+    self.session.csu_id = csu_id
+    if csu_id is None:
+      logger.info("User %s authorized, the CSU ID could not be read", name)
+    else:
+      logger.info("User ID %d authorized", csu_id)
+  
+  # Runs on the lookup thread, the span is recorded by the main loop
+  def lookup_user(self, uid):
+    started_ns = self.tracer.clock_ns()
+    row = self.db.get_row_from_uid(uid)
+    return row, started_ns, self.tracer.clock_ns() - started_ns
+  
+  # What a tap does once the user has been looked up
+  # csu_id is None for a card that was not read (see db_interface.is_known_unknown)
+  def handle_tap(self, uid, csu_id, row):
+    # If the DONE button is pressed
+    if self.done_button.is_pressed():
+      # If user is admin go into add user mode 
+      if row and row.is_admin():
+        self.add_user_mode()
+        return
       
-      if status == self.reader.MI_OK:
-        uid, csu_id = self.read_card()
-        print("Using IDs:", uid, csu_id)
-        # Card detected, get database entry
+      # If the card that was scanned is in the database, display the corresponding name
+      elif row:
+        self.lcd.display_string(row.get_name(), 1, clear=True)
+      
+      # Otherwise, display this generic text
+      else:
+        self.lcd.display_string("Card uid:", 1, clear=True)
+      
+      # and with the first LCD row set up, display the uid on the second row
+      self.lcd.display_string(hex(uid), 2, clear=False)
+      self.show_message(2)
+      return
+    
+    # UID not in database
+    if not row:
+      self.record_tap("tap.scan_to_decision")
+      # Indicate that the card is not recognized and then go back to idle
+      self.set_LED(100, 0, 0) # red
+      self.lcd.display_string(self.lcd.NOT_RECOGNIZED, 3, clear=False, align_left=False)
+      if csu_id is None:
+        logger.error("Unrecognized card %s scanned", hex(uid))
+      else:
+        logger.error("Unauthorized user %d scanned", csu_id)
+      self.show_message(3)
+      return
+    
+    # This uid is in the database, so get corresponding name from uid and display it
+    name = row.get_name()
+    self.lcd.display_string(name, 2)
+    
+    # If this user is not authorized to use the laser (i.e. if their acces has expired) 
+    with self.tracer.span("db.check"):
+      authorized = self.db._check_uid(row)
+    self.record_tap("tap.scan_to_decision")
+    if not authorized:
+      # Indicate that this user is not authorized and then go back to idle
+      self.set_LED(100, 0, 0) # red
+      self.lcd.display_string(self.lcd.NOT_AUTHORIZED, 3)
+      logger.error("Unauthorized user %d scanned", csu_id)
+      self.show_message(3)
+      return
+    
+    self.start_laser(uid, csu_id, name)
+  
+  # csu_id is None when it is read after the relay is switched (see pipelined_tap)
+  def start_laser(self, uid, csu_id, name):
+    # This user is authorized, so turn on the laser
+    if csu_id is not None:
+      logger.info("User ID %d authorized", csu_id)
+    self.lcd.display_string(self.lcd.AUTHORIZED, 3, clear=False)
+    self.set_LED(0, 100, 0) # Green
+    self.set_relay(self.GPIO.HIGH)
+    self.record_tap("tap.scan_to_relay")
+    self.start_session(uid, csu_id, name)
+    
+    self.state = self.LASER_ON_STATE
+    self.current_user_uid = uid
+    self.current_name = name
+    self.card_missing_deadline = None
+    # presses from before the laser was turned on do not count
+    self.done_button.get_events()
+    # the card was just read, the first presence check is one polling period from now
+    self.set_reader_polling_rate(LASER_ON_POLLING_RATE_SECONDS, delay=LASER_ON_POLLING_RATE_SECONDS)
+  
+  # record the time from the request that saw the card to now
+  def record_tap(self, stage):
+    if self.tap_started_ns is not None:
+      self.tracer.record(stage, self.tap_started_ns, self.tracer.clock_ns() - self.tap_started_ns)
+  
+  def stop_laser(self, reason):
+    self.set_relay(self.GPIO.LOW) # laser and chiller OFF
+    self.end_session(reason)
+    self.cancel_task('grace_task')
+    self.cancel_task('countdown_task')
+    self.card_missing_deadline = None
+    self.current_user_uid = None
+    self.tap_started_ns = None
+  
+  # the start of a session is recorded right away, so that a power cut while the laser
+  # is on does not lose it, the end record completes it (see session_log)
+  def start_session(self, uid, csu_id, name):
+    self.session = session_log.laser_session(uid, csu_id, name, self.hal.wall_clock(), self.config.name)
+    self.sessions.record(self.session)
+  
+  # hand the current session to the recorder, this only queues it
+  def end_session(self, reason):
+    if self.session:
+      self.session.finish(self.hal.wall_clock(), reason)
+      self.sessions.record(self.session)
+      self.session = None
+  
+  # called from the GPIO callback thread
+  # the relay is cut right here, the main loop may be busy with another station's reader
+  def on_button_event(self):
+    if self.state == self.LASER_ON_STATE and self.done_button.is_pressed():
+      self.cut_relay()
+    self.scheduler.call_soon_threadsafe(self.handle_button_events)
+  
+  def handle_button_events(self):
+    events = self.done_button.get_events()
+    pressed = any(event.kind == button.button.PRESS for event in events)
+    # if the user pressed the DONE button turn off the laser and wait for the user to remove their card
+    if pressed and self.state == self.LASER_ON_STATE:
+      self.stop_laser(session_log.END_DONE)
+      self.lcd.display_string(self.current_name + " DONE", 2)
+      self.lcd.display_string("Remove RamCard", 3, clear=False)
+      self.show_message(5)
+    # Exit adding user mode if DONE button is pressed
+    elif pressed and self.add_user_step == 'card':
+      self.lcd.display_string("Exiting add mode", 2, clear=True)
+      self.add_user_message(2, self.leave_add_user_mode)
+    elif pressed and self.add_user_step == 'confirm':
+      self.update_confirmed()
+  
+  def poll_reader_laser_on(self):
+    display_card_missing = True
+    
+    # Check if card is present
+    # the same card as the one that started the session only needs its uid compared,
+    # the sector read is only done when a different card shows up
+    uid_bytes = self.check_card_present()
+    if uid_bytes is not None and self.uid_to_num(uid_bytes) == self.current_user_uid:
+      self.halt_card()
+      self.card_returned()
+      return
+    if uid_bytes is None or self.card and self.card.uid != self.uid_to_num(uid_bytes):
+      self.end_card_session()
+    
+    csu_id = self.read_csu_id(uid_bytes) if uid_bytes is not None else None
+    if csu_id is not None:
+      uid = self.uid_to_num(uid_bytes)
+      with self.tracer.span("db.lookup"):
         row = self.db.get_row_from_uid(uid)
-        
-        # If the DONE button is pressed
-        if is_done_button_pressed():
-          # If user is admin go into add user mode 
-          if row and row.is_admin():
-            self.add_user_mode()
-            continue # Go back to the top of this while loop
-          
-          # If the card that was scanned is in the database, display the corresponding name
-          elif row:
-            self.lcd.display_string(row.get_name(), 1)
-          
-          # Otherwise, display this generic textprint("Card UID: ", ':'.join(hex(i)[2:].zfill(2) for i in uid))
-          else:
-            self.lcd.display_string("Card uid:", 1)
-          
-          # and with the first LCD row set up, display the uid on the second row
-          self.lcd.display_string(hex(uid), 2, clear=False)
-          time.sleep(2)
-          continue
-        
-        # UID not in database
-        if not row:
-          # Indicate that the card is not recognized  and then go back to the top of this while loop
-          self.set_LED(100, 0, 0) # red
-          self.lcd.display_string(self.lcd.NOT_RECOGNIZED, 3, clear=False, align_left=False)
-          logger.error("Unauthorized user %d scanned", csu_id)
-          time.sleep(3)
-          self.lcd.clear()
-          continue
-        
-        # This uid is in the database, so get corresponding name from uid and display it
+      
+      if row:
         name = row.get_name()
-        self.lcd.display_string(name, 2)
+        self.lcd.display_string(name, 2, clear=False)
         
-        # If this user is not authorized to use the laser (i.e. if their acces has expired) 
-        if not self.db._check_uid(row):
-          # Indicate that this user is not authorized and then go back to the top of this while loop
-          self.set_LED(100, 0, 0) # red
-          self.lcd.display_string(self.lcd.NOT_AUTHORIZED, 3)
-          logger.error("Unauthorized user %d scanned", csu_id)
-          time.sleep(3)
-          self.lcd.clear()
-          continue
-        
-        # This user is authorized, so turn on the laser
-        logger.info("User ID %d authorized", csu_id)
-        self.lcd.display_string(self.lcd.AUTHORIZED, 3, clear=False)
-        self.set_LED(0, 100, 0) # Green
-        GPIO.output(LASER_RELAY_PIN_NUMBER, GPIO.HIGH)
-        
-        times_card_missing = 0
-        max_times_card_missing = LASER_ON_GRACE_PERIOD_SECONDS / LASER_ON_POLLING_RATE_SECONDS
-        current_user_uid = uid
+        # if the new uid is authorized, hand the laser over to them
+        with self.tracer.span("db.check"):
+          authorized = self.db._check_uid(row)
+        if authorized:
+          self.current_user_uid = uid
+          self.current_name = name
+          logger.info("User ID %d authorized", self.current_user_uid)
+          self.end_session(session_log.END_HANDOFF)
+          self.start_session(uid, csu_id, name)
+          self.card_returned()
+          return
         
-        while True:
-          time.sleep(LASER_ON_POLLING_RATE_SECONDS)
-          
-          display_card_missing = True
-          
-          # if the user is pressing the DONE button turn off the laser wait for the user to remove their card and break out of this inner while loop
-          if is_done_button_pressed():
-            GPIO.output(LASER_RELAY_PIN_NUMBER, GPIO.LOW)
-            self.lcd.display_string(name + " DONE", 2)
-            self.lcd.display_string("Remove RamCard", 3, clear=False)
-            time.sleep(5)
-            self.lcd.clear()
-            break
-          
-          # if the card is missing for too long, shut off the laser and break out of this inner while loop
-          if times_card_missing >= max_times_card_missing:
-            self.lcd.display_string("Time's up!", 2)
-            GPIO.output(LASER_RELAY_PIN_NUMBER, GPIO.LOW) # laser and chiller OFF
-            self.set_LED(100, 0, 0) # red
-            time.sleep(2)
-            self.lcd.clear()
-            break
-          
-          # Check if card is present
-          if self.reader.MFRC522_Request(self.reader.PICC_REQIDL)[0] == self.reader.MI_OK:
-            uid, csu_id = self.read_card()
-            if uid == current_user_uid:
-              times_card_missing = 0
-              self.set_LED(0, 100, 0) # green
-              self.lcd.display_string(name, 2)
-              self.lcd.display_string(self.lcd.AUTHORIZED, 3, clear=False)
-              continue
-            
-            row = self.db.get_row_from_uid(uid)
-            
-            if row:
-              name = row.get_name()
-              self.lcd.display_string(name, 2, clear=False)
-              
-              # if the new uid is authorized, update LED and LCD and go back to the top of this inner while loop
-              if self.db._check_uid(row):
-                current_user_uid = uid
-                logger.info("User ID %d authorized", current_user_uid)
-                times_card_missing = 0
-                self.set_LED(0, 100, 0) # green
-                self.lcd.display_string(self.lcd.AUTHORIZED, 3, clear=False)
-                continue
-              
-              self.set_LED(100, 0, 0) # red
-              display_card_missing = False
-              self.lcd.display_string(self.lcd.NOT_AUTHORIZED, 3, clear=False)
-            
-            else:
-              self.set_LED(100, 0, 0) # red
-              display_card_missing = False
-              self.lcd.display_string(self.lcd.NOT_RECOGNIZED, 2, clear=False)
-          
-          if self.reader.MFRC522_Request(self.reader.PICC_REQIDL)[0] != self.reader.MI_OK:
-            # A card is not present or the card is not valid, so increment the number of times a check has not detected a valid card
-            times_card_missing += 1
-            
-            # alert the user that they need to return their card to the reader and update how much time they have left to do so
-            if display_card_missing:
-              self.lcd.display_string("Card missing!", 2)
-              self.set_LED(50, 0, 0) # blink red at 2 Hz  
-            
-            time_str = "%d sec to return" % ((max_times_card_missing - times_card_missing) * LASER_ON_POLLING_RATE_SECONDS)
-            self.lcd.display_string(time_str, 3, clear=False)
+        self.set_LED(100, 0, 0) # red
+        display_card_missing = False
+        self.lcd.display_string(self.lcd.NOT_AUTHORIZED, 3, clear=False)
       
-      # If no card is detected 
       else:
-        # Display the idle message, wait, and then go back to the top of this while loop
-        self.set_LED(0, 0, 100) # Blue
-        self.lcd.display_string("Scan RamCard", row=2, align_left=False, clear=False)
-        continue
+        self.set_LED(100, 0, 0) # red
+        display_card_missing = False
+        self.lcd.display_string(self.lcd.NOT_RECOGNIZED, 2, clear=False)
+    
+    # A card is not present or the card is not valid
+    self.card_missing(display_card_missing)
   
-  def cleanup(self):
-    # if this program errors out, "turn off" the lcd and LED and close the connection to the database before exiting
+  def card_returned(self):
+    self.cancel_task('grace_task')
+    self.cancel_task('countdown_task')
+    self.card_missing_deadline = None
+    if self.session:
+      self.session.card_returned(self.hal.wall_clock())
+    self.set_LED(0, 100, 0) # green
+    self.lcd.display_string(self.current_name, 2)
+    self.lcd.display_string(self.lcd.AUTHORIZED, 3, clear=False)
+  
+  def card_missing(self, display_card_missing):
+    # start the grace period the first time the card is found missing
+    if self.card_missing_deadline is None:
+      self.card_missing_deadline = self.scheduler.clock() + LASER_ON_GRACE_PERIOD_SECONDS
+      self.grace_task = self.scheduler.call_at(self.card_missing_deadline, self.time_up, priority=scheduler.PRIORITY_SAFETY)
+      self.countdown_task = self.scheduler.call_every(COUNTDOWN_REFRESH_SECONDS, self.refresh_countdown)
+      if self.session:
+        self.session.card_missing(self.hal.wall_clock())
+    
+    # alert the user that they need to return their card to the reader
+    if display_card_missing:
+      self.lcd.display_string("Card missing!", 2)
+      self.set_LED(50, 0, 0) # blink red at 2 Hz  
+    self.refresh_countdown()
+  
+  # update how much time the user has left to return their card
+  def refresh_countdown(self):
+    if self.card_missing_deadline is None:
+      return
+    seconds_left = max(0, self.card_missing_deadline - self.scheduler.clock())
+    time_str = "%d sec to return" % round(seconds_left)
+    self.lcd.display_string(time_str, 3, clear=False)
+  
+  # the card has been missing for too long, shut off the laser
+  def time_up(self):
+    self.grace_task = None
+    self.stop_laser(session_log.END_TIME_UP)
+    self.lcd.display_string("Time's up!", 2)
+    self.set_LED(100, 0, 0) # red
+    self.show_message(2)
+  
+  # counters of the caches that save reader and database work
+  def cache_stats(self):
+    stats = dict(self.db.cache_stats())
+    stats['auth_failure_hits'] = self.auth_failure_hits
+    stats['auth_failure_size'] = len(self.auth_failures)
+    stats['card_session_hits'] = self.card_session_hits
+    return stats
+  
+  # "turn off" the lcd and LED of this station and release its reader
+  def close_station(self):
+    self.end_session(session_log.END_SHUTDOWN)
+    self.done_button.close()
     self.lcd.clear()
     self.lcd.backlight(0)
     self.set_LED(0, 0, 0)
-    self.db.close()
     self.reader.Close_MFRC522()
-    GPIO.cleanup()
   
-  def activate_keyboard_and_get_name(self):
-    global name_from_keyboard, keyboard_done, accepting_keyboard_input, input_mode
-    
-    name_from_keyboard = ""
-    keyboard_done = False
-    accepting_keyboard_input = True
-    
-    # Prompt the user to enter their name with the keyboard
-    input_mode = 'name'
-    self.lcd.display_string("Enter your name:", 1, clear=True)
-    
-    while not keyboard_done:
-      self.lcd.display_string(name_from_keyboard, 2, clear=False)
-      #time.sleep(0.25)
-    
-    accepting_keyboard_input = False
-    
-    return name_from_keyboard
+  def cleanup(self):
+    # if this program errors out, "turn off" the lcd and LED and close the connection to the database before exiting
+    self.scheduler.stop()
+    self.close_station()
+    self.shared.close()
 
 def signal_handler(sig, frame):
     access_controller.cleanup()
+    log_listener.stop()
+    if recorder:
+      recorder.close()
     sys.exit(0)
 
-signal.signal(signal.SIGINT, signal_handler)
+# kill -USR1 <pid> logs the latency summary of every traced stage and the cache counters
+# (logged by the main loop, the log queue's lock may be held by the code the signal interrupted)
+def dump_trace_handler(sig, frame):
+    access_controller.scheduler.call_soon_from_signal(log_trace_summary)
+
+def log_trace_summary():
+    logger.info("Latency summary:\n%s", access_controller.tracer.format_summary())
+    logger.info("Cache counters: %s", access_controller.cache_stats())
   
 if __name__ == "__main__":
-  access_controller = laser_access_control()
+  log_listener = log_pipeline.setup_logging(LOG_FILE)
+  signal.signal(signal.SIGINT, signal_handler)
+  signal.signal(signal.SIGUSR1, dump_trace_handler)
+  station_hal = hal.load()
+  # LASER_TRACE=<file> records the station's traffic for trace_replay.py
+  recorder = None
+  if os.environ.get(trace_replay.TRACE_ENVIRONMENT_VARIABLE):
+    recorder = trace_replay.trace_recorder(os.environ[trace_replay.TRACE_ENVIRONMENT_VARIABLE],
+                                           station_hal.clock, station_hal.wall_clock)
+    logger.info("Recording the station's traffic to %s", recorder.path)
+    station_hal = recorder.wrap(station_hal)
+  access_controller = laser_access_control(station_hal)
   
   try:
     access_controller.main()
   except Exception as e:
-    print(f"An exception occurred: {e}")
+    logger.exception("An exception occurred: %s", e)
     access_controller.cleanup()
+    log_listener.stop()
+    if recorder:
+      recorder.close()
     raise e
\ No newline at end of file
@@ -0,0 +1,93 @@
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+
+# Non-blocking logging for the controller process
+#
+# Logging calls only put the record on a bounded in-memory queue. A background
+# thread (logging.handlers.QueueListener) formats the records and writes them
+# to the SD card, so a slow write or a log rotation never delays the relay.
+# If the writer falls behind and the queue fills up, new records are dropped
+# and counted instead of blocking; the number dropped is logged once there is
+# room again.
+#
+# Log files rotate by size and rotated files are gzip compressed, so the logs
+# never take more than about max_bytes * (backup_count + 1) on the card.
+
+LOG_QUEUE_SIZE = 10000
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 12
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+class dropping_queue_handler(logging.handlers.QueueHandler):
+
+  def __init__(self, log_queue):
+    super().__init__(log_queue)
+    self.dropped = 0
+    self._unreported_drops = 0
+
+  # The record is queued as is: merging the message with its arguments and
+  # formatting exceptions is left to the writer thread. Arguments must not be
+  # changed after the logging call, which holds for the ints and strings logged here.
+  def prepare(self, record):
+    return record
+
+  def enqueue(self, record):
+    if self._unreported_drops:
+      dropped_record = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                         "%d log records were dropped, the log writer fell behind",
+                                         (self._unreported_drops,), None)
+      try:
+        self.queue.put_nowait(dropped_record)
+        self._unreported_drops = 0
+      except queue.Full:
+        pass
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+      self._unreported_drops += 1
+
+# RotatingFileHandler whose rotated files are gzip compressed
+class compressed_rotating_file_handler(logging.handlers.RotatingFileHandler):
+
+  def __init__(self, filename, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+    super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count)
+    self.namer = self._compressed_name
+    self.rotator = self._compress
+
+  @staticmethod
+  def _compressed_name(name):
+    return name + ".gz"
+
+  @staticmethod
+  def _compress(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+      shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+# Route every record sent to the root logger through the queue
+# Returns the listener, call stop() on it at exit to flush what is still queued
+def setup_logging(log_file, level=logging.DEBUG, queue_size=LOG_QUEUE_SIZE,
+                  max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+  log_folder = os.path.dirname(log_file)
+  if log_folder:
+    os.makedirs(log_folder, exist_ok=True)
+
+  file_handler = compressed_rotating_file_handler(log_file, max_bytes, backup_count)
+  file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+  file_handler.setLevel(level)
+
+  log_queue = queue.Queue(maxsize=queue_size)
+  queue_handler = dropping_queue_handler(log_queue)
+
+  root = logging.getLogger()
+  root.setLevel(level)
+  root.addHandler(queue_handler)
+
+  listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+  listener.start()
+  return listener
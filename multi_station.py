@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import hal
+import json
+import laser_access_control
+import log_pipeline
+import logging
+import os
+import signal
+import sys
+
+# Several laser stations driven by one process
+#
+# Each station has its own reader, relay, DONE button, LED and LCD, and its own
+# state machine (a laser_access_control), while all of them share one main loop,
+# one database connection with its lookup cache and one session writer.
+# The stations are listed in a JSON config file:
+#
+#  {
+#    "database": "/home/pi/senior_design_FA23/laser-cutter-rfid/prod.db",
+#    "stations": [
+#      {"name": "big laser", "relay_pin": 8, "done_button_pin": 10, "led_pins": [32, 33, 35],
+#       "reader": {"bus": 0, "device": 0}, "lcd_address": 39},
+#      {"name": "small laser", "relay_pin": 11, "done_button_pin": 13, "led_pins": [36, 37, 38],
+#       "reader": {"bus": 0, "device": 1}, "lcd_address": 38}
+#    ]
+#  }
+#
+# A key that is left out uses the single station default from laser_access_control.py.
+# The readers share the SPI bus, one chip select each, and the LCDs share the I2C
+# bus, one address each. The reader polls of the stations are spread over the
+# polling period.
+#
+# Run with: sudo python3 multi_station.py /home/pi/senior_design_FA23/stations.json
+
+LOG_FILE = 'Logs/multi_station.log'
+
+STATION_KEYS = ('name', 'relay_pin', 'done_button_pin', 'led_pins', 'reader', 'lcd_address')
+
+logger = logging.getLogger()
+
+def load_config(path):
+  with open(path) as f:
+    config = json.load(f)
+  if not config.get('stations'):
+    raise Exception("%s lists no stations" % path)
+  return config
+
+def station_configs(config):
+  stations = config['stations']
+  configs = []
+  for i, station in enumerate(stations):
+    unknown = set(station) - set(STATION_KEYS)
+    if unknown:
+      raise Exception("Unknown station settings %s" % ', '.join(sorted(unknown)))
+    kwargs = {key: station[key] for key in STATION_KEYS if key in station}
+    kwargs.setdefault('name', "station %d" % (i + 1))
+    configs.append(laser_access_control.station_config(poll_phase=i / len(stations), **kwargs))
+  return configs
+
+# Two stations wired to the same pin, chip select or LCD address would drive each other's hardware
+def check_wiring(configs):
+  used = {}
+  for config in configs:
+    for resource in ([('pin', config.relay_pin), ('pin', config.done_button_pin)] +
+                     [('pin', pin) for pin in config.led_pins] +
+                     [('reader', tuple(sorted(config.reader.items()))), ('lcd', config.lcd_address)]):
+      if resource in used:
+        raise Exception("%s and %s both use %s %s" % (used[resource], config.name, resource[0], resource[1]))
+      used[resource] = config.name
+
+class multi_station:
+
+  # station_hal is a hal.hal, by default the one picked by hal.load()
+  # configs is a list of laser_access_control.station_config
+  def __init__(self, configs, station_hal=None, database=laser_access_control.DATABASE_DIRECTORY):
+    if station_hal is None:
+      station_hal = hal.load()
+    check_wiring(configs)
+    self.hal = station_hal
+    self.shared = laser_access_control.shared_resources(station_hal, database)
+    self.scheduler = self.shared.scheduler
+    self.stations = [laser_access_control.laser_access_control(station_hal, database, config, self.shared)
+                     for config in configs]
+    self.sweep_task = None
+
+  def main(self):
+    logger.info("%d stations ready: %s", len(self.stations), ', '.join(s.config.name for s in self.stations))
+    for station in self.stations:
+      station.enter_idle()
+    self.sweep_task = self.scheduler.call_every(laser_access_control.EXPIRY_SWEEP_INTERVAL_SECONDS,
+                                                self.shared.sweep_expired_users)
+    self.scheduler.run()
+
+  def cleanup(self):
+    self.scheduler.stop()
+    for station in self.stations:
+      station.close_station()
+    self.shared.close()
+
+def signal_handler(sig, frame):
+    controller.cleanup()
+    log_listener.stop()
+    sys.exit(0)
+
+# kill -USR1 <pid> logs the latency summary of every traced stage and the cache counters
+# (logged by the main loop, the log queue's lock may be held by the code the signal interrupted)
+def dump_trace_handler(sig, frame):
+    controller.scheduler.call_soon_from_signal(log_trace_summary)
+
+def log_trace_summary():
+    logger.info("Latency summary:\n%s", controller.shared.tracer.format_summary())
+    for station in controller.stations:
+      logger.info("Cache counters of %s: %s", station.config.name, station.cache_stats())
+
+if __name__ == "__main__":
+  if len(sys.argv) != 2:
+    print("Usage: %s <stations.json>" % os.path.basename(sys.argv[0]))
+    sys.exit(1)
+  config = load_config(sys.argv[1])
+  log_listener = log_pipeline.setup_logging(LOG_FILE)
+  signal.signal(signal.SIGINT, signal_handler)
+  signal.signal(signal.SIGUSR1, dump_trace_handler)
+  controller = multi_station(station_configs(config), database=config.get('database', laser_access_control.DATABASE_DIRECTORY))
+
+  try:
+    controller.main()
+  except Exception as e:
+    logger.exception("An exception occurred: %s", e)
+    controller.cleanup()
+    log_listener.stop()
+    raise e
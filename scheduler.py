@@ -0,0 +1,157 @@
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+# Single threaded deadline scheduler for the controller's main loop
+#
+# Everything the controller does (polling the reader, watching the DONE button,
+# refreshing the LCD, grace period timers) is a task with a deadline on a
+# monotonic clock. Between deadlines the loop blocks, so an idle station uses no
+# CPU. Other threads (GPIO and keyboard callbacks) hand work to the loop with
+# call_soon_threadsafe(), which also wakes it up immediately.
+#
+# Tasks that are due at the same time run in priority order. A task can also
+# declare a budget, the time it may block the loop (a reader transaction, for
+# example); it is held back while a higher priority task is due within its
+# budget, so a slow read never delays something like turning a relay off.
+
+PRIORITY_NORMAL = 0
+PRIORITY_SAFETY = 10
+
+class task:
+
+  def __init__(self, deadline, callback, args, interval=None, priority=PRIORITY_NORMAL, budget=0):
+    self.deadline = deadline
+    self.callback = callback
+    self.args = args
+    self.interval = interval
+    self.priority = priority
+    self.budget = budget
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+class scheduler:
+
+  # clock returns the current time in seconds and must never go backwards
+  # wait(timeout) blocks until the timeout passes or wake() is called,
+  #  timeout is None when nothing is scheduled
+  def __init__(self, clock=time.monotonic, wait=None):
+    self.clock = clock
+    self._wait = wait
+    self._queue = []
+    self._counter = itertools.count()
+    self._wakeup = threading.Event()
+    self._pending = collections.deque()
+    self._running = False
+
+  def _push(self, new_task):
+    heapq.heappush(self._queue, (new_task.deadline, next(self._counter), new_task))
+    return new_task
+
+  def call_at(self, deadline, callback, *args, priority=PRIORITY_NORMAL, budget=0):
+    return self._push(task(deadline, callback, args, priority=priority, budget=budget))
+
+  def call_later(self, delay, callback, *args, priority=PRIORITY_NORMAL, budget=0):
+    return self.call_at(self.clock() + delay, callback, *args, priority=priority, budget=budget)
+
+  # Run callback every interval seconds, the first run is after one interval
+  # unless delay is given. Ticks are kept on the original grid (no drift), and
+  # ticks that were missed because the loop was busy are skipped, not queued up.
+  def call_every(self, interval, callback, *args, delay=None, priority=PRIORITY_NORMAL, budget=0):
+    if delay is None:
+      delay = interval
+    return self._push(task(self.clock() + delay, callback, args, interval, priority, budget))
+
+  # may be called from any thread
+  def call_soon_threadsafe(self, callback, *args):
+    self._pending.append((callback, args))
+    self.wake()
+
+  # May be called from a signal handler. The callback is only queued, it runs the
+  # next time the loop wakes up; waking it here would take the wakeup event's
+  # lock, which the interrupted main thread may be holding.
+  def call_soon_from_signal(self, callback, *args):
+    self._pending.append((callback, args))
+
+  def wake(self):
+    self._wakeup.set()
+
+  def stop(self):
+    self._running = False
+    self.wake()
+
+  # deadline of the next task that will run, None if nothing is scheduled
+  def next_deadline(self):
+    while self._queue and self._queue[0][2].cancelled:
+      heapq.heappop(self._queue)
+    if self._queue:
+      return self._queue[0][0]
+    return None
+
+  # earliest deadline of a task with a higher priority than the given one, None if there is none
+  def _next_priority_deadline(self, priority):
+    deadlines = [deadline for deadline, _, queued in self._queue if queued.priority > priority and not queued.cancelled]
+    return min(deadlines) if deadlines else None
+
+  # Run everything that was due when this was called, returns the deadline of the next task
+  # (tasks that become due while this runs wait for the next call, so a slow task cannot
+  # starve the rest of the loop)
+  def run_once(self):
+    while self._pending:
+      callback, args = self._pending.popleft()
+      callback(*args)
+
+    now = self.clock()
+    due = []
+    while self._queue and self._queue[0][0] <= now:
+      entry = heapq.heappop(self._queue)
+      if not entry[2].cancelled:
+        due.append(entry)
+    # highest priority first, then by deadline
+    due.sort(key=lambda entry: (-entry[2].priority, entry[0], entry[1]))
+
+    for _, _, due_task in due:
+      if due_task.cancelled:
+        continue
+      if due_task.budget:
+        # hold the task back if it could still be running when a more important one is due
+        priority_deadline = self._next_priority_deadline(due_task.priority)
+        if priority_deadline is not None and priority_deadline < self.clock() + due_task.budget:
+          heapq.heappush(self._queue, (priority_deadline, next(self._counter), due_task))
+          continue
+      if due_task.interval is not None:
+        # due_task.deadline is still the tick on the grid when the task was held back
+        missed = int((now - due_task.deadline) // due_task.interval)
+        due_task.deadline += (missed + 1) * due_task.interval
+        self._push(due_task)
+      due_task.callback(*due_task.args)
+      # run callbacks handed over from other threads before the next timer
+      while self._pending:
+        callback, args = self._pending.popleft()
+        callback(*args)
+
+    return self.next_deadline()
+
+  def _block_until(self, deadline):
+    timeout = None
+    if deadline is not None:
+      timeout = max(0, deadline - self.clock())
+    if self._wait:
+      self._wait(timeout)
+    elif timeout is None or timeout > 0:
+      self._wakeup.wait(timeout)
+    self._wakeup.clear()
+
+  def run(self):
+    self._running = True
+    while self._running:
+      deadline = self.run_once()
+      if not self._running:
+        break
+      if self._pending:
+        continue
+      self._block_until(deadline)
@@ -0,0 +1,212 @@
+import itertools
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import db_interface
+
+# Laser session records
+#
+# Every time the laser is turned on a laser_session is started; it collects the
+# intervals during which the card was missing and is ended with the reason the
+# laser went off. A session is handed to a session_recorder when it starts and
+# again when it ends, the recorder writes it to the laser_log table from its own
+# thread and its own connection:
+#
+#  laser_log(timestamp, action, data)
+#    timestamp  when the session started (seconds since the epoch)
+#    action     SESSION_ACTION
+#    data       the session as JSON, see laser_session.to_dict()
+#
+# The first record of a session inserts its row and the end record updates that
+# row, so a session that was cut short by a crash or a power cut is still in the
+# log, with no end (None in read_sessions()).
+#
+# record() only puts a copy of the session on a queue. The writer thread collects
+# what arrives for up to flush_interval seconds and writes it in one transaction,
+# so the controller never waits on a commit or an fsync when the relay switches.
+# A batch that cannot be written is kept and retried every flush_interval, up to
+# max_retained sessions (the oldest are dropped past that); what is still
+# unwritten when the recorder is closed is dropped. Both are counted in dropped.
+
+SESSION_ACTION = "SESSION"
+
+# why a session ended
+END_DONE = "DONE"           # the DONE button was pressed
+END_TIME_UP = "TIME UP"     # the card was missing for the whole grace period
+END_HANDOFF = "HANDOFF"     # another authorized card took over the laser
+END_SHUTDOWN = "SHUTDOWN"   # the controller exited while the laser was on
+
+FLUSH_INTERVAL_SECONDS = 5
+MAX_BATCH_SIZE = 100
+MAX_RETAINED_SESSIONS = 1000
+
+logger = logging.getLogger(__name__)
+
+# tells the records of one session apart from those of the others
+_session_ids = itertools.count()
+
+class laser_session:
+
+  # station is the name of the station the laser belongs to, see laser_access_control.station_config
+  def __init__(self, uid, csu_id, name, start, station=None):
+    self.uid = uid
+    self.csu_id = csu_id
+    self.name = name
+    self.start = start
+    self.station = station
+    self.id = next(_session_ids)
+    self.end = None
+    self.end_reason = None
+    self.card_missing_intervals = []
+    self._card_missing_since = None
+
+  def card_missing(self, t):
+    if self._card_missing_since is None:
+      self._card_missing_since = t
+
+  def card_returned(self, t):
+    if self._card_missing_since is not None:
+      self.card_missing_intervals.append((self._card_missing_since, t))
+      self._card_missing_since = None
+
+  def finish(self, t, reason):
+    # a card that is still missing is missing until the end of the session
+    self.card_returned(t)
+    self.end = t
+    self.end_reason = reason
+
+  def to_dict(self):
+    return {'uid': self.uid, 'csu_id': self.csu_id, 'name': self.name, 'station': self.station,
+            'start': self.start, 'end': self.end, 'end_reason': self.end_reason,
+            'card_missing': [list(interval) for interval in self.card_missing_intervals]}
+
+# What record() queues, the session as it was when it was recorded
+class session_record:
+
+  def __init__(self, session):
+    self.session_id = session.id
+    self.start = session.start
+    self.ended = session.end is not None
+    self.data = session.to_dict()
+
+class session_recorder:
+
+  _STOP = object()
+
+  def __init__(self, db_name, flush_interval=FLUSH_INTERVAL_SECONDS, max_batch_size=MAX_BATCH_SIZE,
+               max_retained=MAX_RETAINED_SESSIONS):
+    self.db_name = db_name
+    self.flush_interval = flush_interval
+    self.max_batch_size = max_batch_size
+    self.max_retained = max_retained
+    self._queue = queue.Queue()
+    self.recorded = 0
+    self.write_errors = 0
+    self.dropped = 0
+    # session id -> laser_log rowid of the sessions whose start has been written
+    self._rowids = {}
+    self._thread = threading.Thread(target=self._run, name="session_recorder", daemon=True)
+    self._thread.start()
+
+  # called by the controller when a session starts and when it ends, never blocks on the database
+  def record(self, session):
+    self._queue.put(session_record(session))
+
+  # write everything recorded so far and wait until it is committed
+  def flush(self):
+    done = threading.Event()
+    self._queue.put(done)
+    done.wait()
+
+  def close(self):
+    if self._thread.is_alive():
+      self._queue.put(self._STOP)
+      self._thread.join()
+
+  def _run(self):
+    db = db_interface.connect(self.db_name)
+    batch = []
+    deadline = None
+    failing = False
+    try:
+      while True:
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        try:
+          item = self._queue.get(timeout=timeout)
+        except queue.Empty:
+          item = None
+
+        if isinstance(item, session_record):
+          batch.append(item)
+          if deadline is None:
+            deadline = time.monotonic() + self.flush_interval
+          # a full batch is written right away, unless the last write failed
+          if (failing or len(batch) < self.max_batch_size) and time.monotonic() < deadline:
+            continue
+
+        # the interval is up, the batch is full, or someone is waiting for the flush
+        if batch:
+          failing = not self._write(db, batch)
+          if not failing:
+            batch = []
+          elif len(batch) > self.max_retained:
+            self._drop(batch[:-self.max_retained], "more than %d laser sessions are waiting" % self.max_retained)
+            del batch[:-self.max_retained]
+        deadline = time.monotonic() + self.flush_interval if batch else None
+
+        if isinstance(item, threading.Event):
+          item.set()
+        elif item is self._STOP:
+          if batch:
+            self._drop(batch, "the recorder is closing")
+          return
+    finally:
+      db.close()
+
+  # write a batch in one transaction, a failed batch is kept and retried at the next flush
+  # A session recorded more than once in the batch is only written as it was recorded last.
+  def _write(self, db, batch):
+    latest = {}
+    for record in batch:
+      latest[record.session_id] = record
+    rowids = {}
+    try:
+      with db:
+        for record in latest.values():
+          data = json.dumps(record.data)
+          rowid = self._rowids.get(record.session_id)
+          if rowid is None:
+            rowid = db.execute("INSERT INTO laser_log(timestamp, action, data) VALUES (?, ?, ?)",
+                               [int(record.start), SESSION_ACTION, data]).lastrowid
+          else:
+            db.execute("UPDATE laser_log SET data = ? WHERE rowid = ?", [data, rowid])
+          rowids[record.session_id] = rowid
+    except sqlite3.Error as e:
+      self.write_errors += 1
+      logger.error("Could not write %d laser sessions: %s", len(latest), e)
+      return False
+    # an ended session is not written again
+    for record in latest.values():
+      if record.ended:
+        self._rowids.pop(record.session_id, None)
+      else:
+        self._rowids[record.session_id] = rowids[record.session_id]
+    self.recorded += len(latest)
+    return True
+
+  def _drop(self, sessions, why):
+    self.dropped += len(sessions)
+    logger.error("Dropped %d unwritten laser sessions, %s (%d dropped so far)", len(sessions), why, self.dropped)
+
+# the recorded sessions, oldest first, as dicts
+# end and end_reason are None for a session that has not ended, or never did
+def read_sessions(db_name):
+  db = sqlite3.connect(db_name)
+  try:
+    res = db.execute("SELECT data FROM laser_log WHERE action = ? ORDER BY rowid", [SESSION_ACTION])
+    return [json.loads(row[0]) for row in res.fetchall()]
+  finally:
+    db.close()
@@ -0,0 +1,418 @@
+import heapq
+import itertools
+import time
+import fake_gpio
+import hal
+import RPi_I2C_driver
+
+# Software simulator for the whole station
+#
+# simulated_hal() builds a hal.hal where the reader, GPIO, LCD bus and keyboard
+# are simulated and time is a virtual_clock, so laser_access_control can run
+# its full state machine on any Linux box, as fast as the CPU allows:
+#
+#  station_hal = simulator.simulated_hal()
+#  controller = laser_access_control.laser_access_control(station_hal, "sim.db")
+#  card = simulator.sim_card(0x01020304, 123456789)
+#  station_hal.clock_source.call_at(1, station_hal.reader.present, card)
+#  station_hal.clock_source.call_at(30, station_hal.reader.remove)
+#  simulator.run(controller, until=60)
+#
+# Events from the outside world (cards, button presses, keys) are scheduled on
+# the clock and fire when virtual time passes them, including in the middle of
+# a reader command, just like a card being pulled away during a read.
+
+class simulation_finished(Exception):
+  pass
+
+class virtual_clock:
+
+  def __init__(self, start=0.0):
+    self.now = start
+    self._events = []
+    self._counter = itertools.count()
+
+  def monotonic(self):
+    return self.now
+
+  def monotonic_ns(self):
+    return int(round(self.now * 1e9))
+
+  # schedule an outside world event at virtual time t
+  def call_at(self, t, callback, *args):
+    heapq.heappush(self._events, (t, next(self._counter), callback, args))
+
+  def call_later(self, delay, callback, *args):
+    self.call_at(self.now + delay, callback, *args)
+
+  def advance_to(self, t):
+    while self._events and self._events[0][0] <= t:
+      event_time, _, callback, args = heapq.heappop(self._events)
+      self.now = max(self.now, event_time)
+      callback(*args)
+    self.now = max(self.now, t)
+
+  def sleep(self, seconds):
+    self.advance_to(self.now + seconds)
+
+  # scheduler wait: jump to the next deadline, or to the next outside event
+  # when nothing is scheduled (there is nothing left to do if there is none)
+  def wait(self, timeout):
+    if timeout is not None:
+      self.advance_to(self.now + timeout)
+    elif self._events:
+      self.advance_to(self._events[0][0])
+    else:
+      raise simulation_finished()
+
+# ========================== READER ==========================
+
+# A Mifare Classic card as seen by the reader
+# uid is the 4 byte serial number, the reader adds the BCC byte
+# the CSU ID is stored in sector 1 block 4 the way read_csu_id() expects it:
+#  bytes 3-7 big endian, followed by one check digit
+class sim_card:
+
+  DEFAULT_KEY = [0x4A, 0x1E, 0xD9, 0x40, 0xF4, 0x4B]
+
+  def __init__(self, uid, csu_id, key=DEFAULT_KEY, check_digit=0):
+    self.uid = list(uid.to_bytes(4, 'big'))
+    bcc = self.uid[0] ^ self.uid[1] ^ self.uid[2] ^ self.uid[3]
+    self.uid_with_bcc = self.uid + [bcc]
+    self.key = list(key)
+    self.block4 = [0] * 3 + list((csu_id * 10 + check_digit).to_bytes(5, 'big')) + [0] * 8
+
+  # the number laser_access_control.uid_to_num() makes out of this card's uid
+  def uid_number(self):
+    n = 0
+    for byte in self.uid_with_bcc:
+      n = n * 256 + byte
+    return n
+
+class sim_mfrc522:
+
+  MI_OK = 0
+  MI_NOTAGERR = 1
+  MI_ERR = 2
+
+  PICC_REQIDL = 0x26
+  PICC_REQALL = 0x52
+  PICC_HALT = 0x50
+  PICC_AUTHENT1A = 0x60
+  PICC_AUTHENT1B = 0x61
+
+  # ISO 14443-3 card states
+  CARD_IDLE = "IDLE"
+  CARD_READY = "READY"
+  CARD_ACTIVE = "ACTIVE"
+  CARD_HALT = "HALT"
+
+  # Rough time each call takes with the Python driver on a Pi 3 (SPI register
+  # traffic plus the RF exchange). A request with no card waits for the timeout,
+  # and so does a halt, which the card never answers.
+  COMMAND_LATENCY_SECONDS = {
+    'request': 0.002,
+    'request_no_card': 0.005,
+    'anticoll': 0.003,
+    'select': 0.003,
+    'auth': 0.006,
+    'read': 0.004,
+    'stop_crypto': 0.0005,
+    'halt': 0.005,
+  }
+
+  def __init__(self, clock=None):
+    self.clock = clock
+    self.card = None
+    self.card_state = None
+    self.authenticated = False
+    # number of calls per command, for checking how much work a path does
+    self.command_counts = {name: 0 for name in self.COMMAND_LATENCY_SECONDS}
+
+  def _command(self, name):
+    self.command_counts[name] += 1
+    if self.clock:
+      self.clock.sleep(self.COMMAND_LATENCY_SECONDS[name])
+
+  def transactions(self):
+    return sum(self.command_counts.values())
+
+  # ----- simulation helpers -----
+
+  def present(self, card):
+    self.card = card
+    self.card_state = self.CARD_IDLE
+    self.authenticated = False
+
+  def remove(self):
+    self.card = None
+    self.card_state = None
+    self.authenticated = False
+
+  # ----- MFRC522 interface -----
+
+  def MFRC522_Request(self, reqMode):
+    if not self.card:
+      self._command('request_no_card')
+      return (self.MI_ERR, 0)
+    self._command('request')
+    wakes = [self.CARD_IDLE]
+    if reqMode == self.PICC_REQALL:
+      wakes.append(self.CARD_HALT)
+    if self.card_state in wakes:
+      self.card_state = self.CARD_READY
+      return (self.MI_OK, 0x10)
+    # a READY or ACTIVE card ignores the request and falls back to IDLE
+    self.card_state = self.CARD_IDLE
+    self.authenticated = False
+    return (self.MI_ERR, 0)
+
+  def MFRC522_Anticoll(self):
+    self._command('anticoll')
+    if not self.card or self.card_state != self.CARD_READY:
+      return (self.MI_ERR, [])
+    return (self.MI_OK, list(self.card.uid_with_bcc))
+
+  def MFRC522_SelectTag(self, serNum):
+    self._command('select')
+    if not self.card or self.card_state != self.CARD_READY or list(serNum) != self.card.uid_with_bcc:
+      return 0
+    self.card_state = self.CARD_ACTIVE
+    return 0x08
+
+  def MFRC522_Auth(self, authMode, BlockAddr, Sectorkey, serNum):
+    self._command('auth')
+    if not self.card or self.card_state != self.CARD_ACTIVE or list(Sectorkey) != self.card.key:
+      self.authenticated = False
+      return self.MI_ERR
+    self.authenticated = True
+    return self.MI_OK
+
+  def MFRC522_Read(self, blockAddr):
+    self._command('read')
+    if not self.card or not self.authenticated:
+      return None
+    if blockAddr == 4:
+      return list(self.card.block4)
+    return [0] * 16
+
+  def MFRC522_StopCrypto1(self):
+    self._command('stop_crypto')
+    self.authenticated = False
+
+  def MFRC522_Halt(self):
+    self._command('halt')
+    # only a selected card halts, one that is READY takes HLTA as an unexpected
+    # command and falls back to IDLE
+    if self.card_state == self.CARD_ACTIVE:
+      self.card_state = self.CARD_HALT
+    elif self.card_state == self.CARD_READY:
+      self.card_state = self.CARD_IDLE
+    self.authenticated = False
+
+  def Close_MFRC522(self):
+    pass
+
+# ========================== LCD BUS ==========================
+
+LCD_ROW_ADDRESSES = [0x00, 0x40, 0x14, 0x54]
+
+# One HD44780 display behind a PCF8574, decoding the byte stream sent by
+# RPi_I2C_driver back into instructions and keeping the resulting screen
+class sim_display:
+
+  def __init__(self, rows=4, columns=20):
+    self.rows = rows
+    self.columns = columns
+    self.screen_cells = [[' '] * columns for _ in range(rows)]
+    self.address_counter = 0
+    self.backlight = False
+    self._last_output = 0
+    self._high_nibble = None
+    self.instructions = 0
+    self.characters = 0
+
+  def output(self, value):
+    self.backlight = bool(value & RPi_I2C_driver.LCD_BACKLIGHT)
+    # the display latches the data lines when EN goes from high to low
+    if self._last_output & RPi_I2C_driver.En and not value & RPi_I2C_driver.En:
+      self._nibble(value)
+    self._last_output = value
+
+  def _nibble(self, value):
+    nibble = value & 0xF0
+    if self._high_nibble is None:
+      self._high_nibble = nibble
+      return
+    byte = self._high_nibble | (nibble >> 4)
+    self._high_nibble = None
+    if value & RPi_I2C_driver.Rs:
+      self._write_data(byte)
+    else:
+      self._instruction(byte)
+
+  def _instruction(self, byte):
+    self.instructions += 1
+    if byte & RPi_I2C_driver.LCD_SETDDRAMADDR:
+      self.address_counter = byte & 0x7F
+    elif byte == RPi_I2C_driver.LCD_CLEARDISPLAY:
+      self.screen_cells = [[' '] * self.columns for _ in range(self.rows)]
+      self.address_counter = 0
+    elif byte & 0xFE == RPi_I2C_driver.LCD_RETURNHOME:
+      self.address_counter = 0
+
+  def _write_data(self, byte):
+    self.characters += 1
+    for row, start in enumerate(LCD_ROW_ADDRESSES[:self.rows]):
+      if start <= self.address_counter < start + self.columns:
+        self.screen_cells[row][self.address_counter - start] = chr(byte)
+        break
+    self.address_counter = (self.address_counter + 1) & 0x7F
+
+  def screen(self):
+    return [''.join(row) for row in self.screen_cells]
+
+# SMBus stub with a sim_display at every address that is written to
+# screen() and the counters without an address are for the default LCD address
+class sim_smbus:
+
+  def __init__(self, rows=4, columns=20):
+    self.rows = rows
+    self.columns = columns
+    self.displays = {}
+    self._last_output = {}
+    # traffic counters, for the whole bus
+    self.transactions = 0
+    self.bytes_written = 0
+
+  def display(self, addr=RPi_I2C_driver.ADDRESS):
+    if addr not in self.displays:
+      self.displays[addr] = sim_display(self.rows, self.columns)
+    return self.displays[addr]
+
+  # ----- SMBus interface -----
+
+  def write_byte(self, addr, value):
+    self.transactions += 1
+    self._output(addr, value)
+
+  def write_byte_data(self, addr, cmd, value):
+    self.transactions += 1
+    self._output(addr, cmd)
+    self._output(addr, value)
+
+  def write_i2c_block_data(self, addr, cmd, values):
+    self.transactions += 1
+    self._output(addr, cmd)
+    for value in values:
+      self._output(addr, value)
+
+  def read_byte(self, addr):
+    return self._last_output.get(addr, 0)
+
+  def _output(self, addr, value):
+    self.bytes_written += 1
+    self._last_output[addr] = value
+    self.display(addr).output(value)
+
+  # ----- state of a display -----
+
+  @property
+  def instructions(self):
+    return self.display().instructions
+
+  @property
+  def characters(self):
+    return self.display().characters
+
+  @property
+  def backlight(self):
+    return self.display().backlight
+
+  def screen(self, addr=RPi_I2C_driver.ADDRESS):
+    return self.display(addr).screen()
+
+# ========================== KEYBOARD ==========================
+
+class sim_key_event:
+
+  def __init__(self, name, event_type):
+    self.name = name
+    self.event_type = event_type
+
+# stand-in for the keyboard module, keys are typed with press()/release()/write()
+class sim_keyboard:
+
+  def __init__(self):
+    self._press_callbacks = []
+    self._release_callbacks = {}
+
+  def on_press(self, callback):
+    self._press_callbacks.append(callback)
+
+  def on_release_key(self, key, callback):
+    self._release_callbacks.setdefault(key, []).append(callback)
+
+  def press(self, name):
+    for callback in self._press_callbacks:
+      callback(sim_key_event(name, 'down'))
+
+  def release(self, name):
+    for callback in self._release_callbacks.get(name, []):
+      callback(sim_key_event(name, 'up'))
+
+  # type text followed by enter
+  def write(self, text):
+    for char in text:
+      name = 'space' if char == ' ' else char
+      if char.isupper():
+        self.press('shift')
+        self.press(char.lower())
+        self.release('shift')
+      else:
+        self.press(name)
+    self.press('enter')
+
+# ========================== STATION ==========================
+
+# The returned hal also carries the simulated parts so tests can drive them:
+#  clock_source  the virtual_clock
+#  readers       {(bus, device): sim_mfrc522}, one reader per SPI chip select,
+#                created the first time the controller asks for it
+#  reader        the reader on bus 0, chip select 0, the one a single station uses
+# Its wall clock is started (seconds since the epoch, now when None) plus the virtual time.
+def simulated_hal(clock=None, started=None):
+  if clock is None:
+    clock = virtual_clock()
+  if started is None:
+    started = time.time()
+  readers = {(0, 0): sim_mfrc522(clock)}
+  def reader_factory(bus=0, device=0):
+    if (bus, device) not in readers:
+      readers[(bus, device)] = sim_mfrc522(clock)
+    return readers[(bus, device)]
+  station_hal = hal.hal(
+    GPIO=fake_gpio.fake_gpio(),
+    reader_factory=reader_factory,
+    keyboard=sim_keyboard(),
+    lcd_bus=sim_smbus(),
+    clock=clock.monotonic,
+    clock_ns=clock.monotonic_ns,
+    wall_clock=lambda: started + clock.monotonic(),
+    sleep=clock.sleep,
+    wait=clock.wait,
+  )
+  station_hal.clock_source = clock
+  station_hal.readers = readers
+  station_hal.reader = readers[(0, 0)]
+  return station_hal
+
+# Run a controller built on a simulated hal until virtual time reaches until
+# (or until nothing is left to happen)
+def run(controller, until):
+  clock = controller.hal.clock_source
+  clock.call_at(until, controller.scheduler.stop)
+  try:
+    controller.main()
+  except simulation_finished:
+    pass
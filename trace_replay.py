@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import gzip
+import hal
+import json
+import os
+import simulator
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+# Recording a station's traffic and replaying it on the simulator
+#
+# The recorder wraps a hal and writes what the outside world did to the station
+# into a trace file, one short JSON array per line, times in milliseconds since
+# recording started:
+#
+#  {"trace": 1, "started": 1700000000.0}      header, wall clock time of t = 0
+#  [1520, "card", "0102030404"]               a card (uid with BCC) entered the field
+#  [1544, "data", "0102030404", "000000..."]  sector 1 block 4 of that card as read
+#  [1544, "foreign", "0a0b0c0d00"]            that card refused the authentication key
+#  [9210, "remove"]                           the card left the field
+#  [5012, "button", 10, 0]                    an input pin changed level (debounced)
+#  [5012, "output", 8, 0]                     an output pin was set (the relay)
+#  [7003, "key", "a", "down"]                 a key was pressed or released
+#
+# Cards are only seen when the reader is polled, so a card's arrival is the time
+# of the request that first saw it and its removal that of the first of the
+# unanswered requests that followed (or of the request it answered just before
+# leaving). The trace holds card uids and whatever is typed on the keyboard
+# (names during add user mode), keep it like the database.
+#
+# Record by setting LASER_TRACE to the trace file when starting the controller:
+#  sudo LASER_TRACE=/home/pi/traces/monday.trace python3 laser_access_control.py
+# A trace is never overwritten: when the station restarts with the same file
+# set, the new recording goes to monday.1.trace, then monday.2.trace and so on.
+#
+# The replayer builds a station on the simulator with a copy of the database,
+# schedules the events on the virtual clock and runs the controller, so a day of
+# traffic takes seconds. The station's wall clock runs from the time the trace
+# was started, so users expire in the replay as they did while it was recorded.
+# Its report (JSON, like the benchmarks in Tests/) has the relay switches of the
+# replay and of the recording, the tap latencies and the LCD traffic, to compare
+# between versions:
+#  python3 trace_replay.py /home/pi/traces/monday.trace prod.db --output before.json
+
+TRACE_ENVIRONMENT_VARIABLE = "LASER_TRACE"
+TRACE_VERSION = 1
+
+# unanswered requests in a row before a card counts as removed, see
+# laser_access_control.check_card_present
+MISSED_REQUESTS_FOR_REMOVAL = 2
+
+# Cards are put in the field (and taken out) this long before the request that
+# saw them (or missed them), the recorded times are rounded to the millisecond
+CARD_LEAD_SECONDS = 0.001
+
+# how long the replay runs after the last event, long enough for a grace period to end
+REPLAY_TAIL_SECONDS = 60
+
+LATENCY_STAGES = ("tap.scan_to_decision", "tap.scan_to_relay", "db.lookup", "lcd.write", "lcd.clear")
+
+def _hex(data):
+  return bytes(data).hex()
+
+# ========================== RECORDING ==========================
+
+# Create a trace file at path, or at the first of path.1, path.2, ... (before the
+# extension) that does not exist yet; returns the file and its path
+def create_trace_file(path):
+  root, extension = os.path.splitext(path)
+  candidate = path
+  number = 0
+  while True:
+    try:
+      return open(candidate, 'x'), candidate
+    except FileExistsError:
+      number += 1
+      candidate = "%s.%d%s" % (root, number, extension)
+
+class trace_recorder:
+
+  # clock is the station's monotonic clock in seconds, the trace starts at its current time
+  # path is where the trace goes, see create_trace_file() for where it ends up
+  def __init__(self, path, clock=time.monotonic, wall_clock=time.time):
+    self.clock = clock
+    self.started = clock()
+    self._lock = threading.Lock()
+    # events come from the main loop, the GPIO callback thread and the keyboard
+    # thread; every line is flushed so a crash loses nothing
+    self._file, self.path = create_trace_file(path)
+    self._write({'trace': TRACE_VERSION, 'started': wall_clock()})
+
+  def _write(self, value):
+    with self._lock:
+      if self._file is None:
+        return
+      self._file.write(json.dumps(value, separators=(',', ':')) + '\n')
+      self._file.flush()
+
+  def now_ms(self):
+    return int(round((self.clock() - self.started) * 1000))
+
+  def record(self, kind, *args, at_ms=None):
+    self._write([self.now_ms() if at_ms is None else at_ms, kind] + list(args))
+
+  # a hal that records through this recorder, see recording_reader, recording_gpio and recording_keyboard
+  def wrap(self, station_hal):
+    readers = []
+    def reader_factory(**kwargs):
+      if readers:
+        raise Exception("A trace records one station, it has a single reader")
+      readers.append(recording_reader(station_hal.reader_factory(**kwargs), self))
+      return readers[0]
+    recording_hal = hal.hal(
+      GPIO=recording_gpio(station_hal.GPIO, self),
+      reader_factory=reader_factory,
+      keyboard=recording_keyboard(station_hal.keyboard, self),
+      lcd_bus=station_hal.lcd_bus,
+      clock=station_hal.clock,
+      sleep=station_hal.sleep,
+      wait=station_hal.wait,
+      clock_ns=station_hal.clock_ns,
+      wall_clock=station_hal.wall_clock,
+    )
+    # whatever else the hal carries (the simulated parts of a simulated one) is passed along
+    for name, value in vars(station_hal).items():
+      if not hasattr(recording_hal, name):
+        setattr(recording_hal, name, value)
+    return recording_hal
+
+  def close(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+
+# MFRC522 reader that records cards entering and leaving its field
+class recording_reader:
+
+  def __init__(self, reader, recorder):
+    self._reader = reader
+    self._recorder = recorder
+    self.card = None
+    self._request_at_ms = None
+    self._unanswered = 0
+    self._first_unanswered_at_ms = None
+    self._authenticating = None
+
+  def __getattr__(self, name):
+    return getattr(self._reader, name)
+
+  def MFRC522_Request(self, reqMode):
+    at_ms = self._recorder.now_ms()
+    (status, tag_type) = self._reader.MFRC522_Request(reqMode)
+    if status == self._reader.MI_OK:
+      self._request_at_ms = at_ms
+      self._unanswered = 0
+      return (status, tag_type)
+    if self._unanswered == 0:
+      self._first_unanswered_at_ms = at_ms
+    self._unanswered += 1
+    if self._unanswered == MISSED_REQUESTS_FOR_REMOVAL and self.card is not None:
+      self._recorder.record("remove", at_ms=self._first_unanswered_at_ms)
+      self.card = None
+    return (status, tag_type)
+
+  def MFRC522_Anticoll(self):
+    (status, uid) = self._reader.MFRC522_Anticoll()
+    if status == self._reader.MI_OK and uid:
+      card = _hex(uid)
+      if card != self.card:
+        self._recorder.record("card", card, at_ms=self._request_at_ms)
+        self.card = card
+    elif self.card is not None:
+      # the card answered the request and left before anticollision
+      self._recorder.record("remove", at_ms=self._request_at_ms)
+      self.card = None
+    return (status, uid)
+
+  def MFRC522_Auth(self, authMode, BlockAddr, Sectorkey, serNum):
+    status = self._reader.MFRC522_Auth(authMode, BlockAddr, Sectorkey, serNum)
+    self._authenticating = _hex(serNum)
+    if status != self._reader.MI_OK:
+      self._recorder.record("foreign", self._authenticating)
+    return status
+
+  def MFRC522_Read(self, blockAddr):
+    data = self._reader.MFRC522_Read(blockAddr)
+    if data and self._authenticating:
+      self._recorder.record("data", self._authenticating, _hex(data))
+    return data
+
+# RPi.GPIO that records output levels and the level of an input at each edge
+class recording_gpio:
+
+  def __init__(self, gpio, recorder):
+    self._gpio = gpio
+    self._recorder = recorder
+    self._input_levels = {}
+
+  def __getattr__(self, name):
+    return getattr(self._gpio, name)
+
+  def output(self, pin, level):
+    self._gpio.output(pin, level)
+    self._recorder.record("output", pin, 1 if level else 0)
+
+  def add_event_detect(self, pin, edge, callback=None, **kwargs):
+    def recorded(channel):
+      level = self._gpio.input(pin)
+      # bounces show up as several edges, only the level changes are kept
+      if self._input_levels.get(pin) != level:
+        self._input_levels[pin] = level
+        self._recorder.record("button", pin, level)
+      if callback:
+        callback(channel)
+    self._input_levels[pin] = self._gpio.input(pin)
+    self._gpio.add_event_detect(pin, edge, callback=recorded, **kwargs)
+
+# keyboard module that records the keys the controller listens to
+class recording_keyboard:
+
+  def __init__(self, keyboard, recorder):
+    self._keyboard = keyboard
+    self._recorder = recorder
+
+  def __getattr__(self, name):
+    return getattr(self._keyboard, name)
+
+  def on_press(self, callback):
+    def recorded(event):
+      self._recorder.record("key", event.name, "down")
+      callback(event)
+    return self._keyboard.on_press(recorded)
+
+  def on_release_key(self, key, callback):
+    def recorded(event):
+      self._recorder.record("key", event.name, "up")
+      callback(event)
+    return self._keyboard.on_release_key(key, recorded)
+
+# ========================== REPLAY ==========================
+
+trace_event = collections.namedtuple('trace_event', ['seconds', 'kind', 'args'])
+
+# Returns the header and the list of trace_event, a trace compressed with gzip can be read as is
+def read_trace(path):
+  opener = gzip.open if path.endswith('.gz') else open
+  with opener(path, 'rt') as f:
+    lines = [line for line in f if line.strip()]
+  if not lines:
+    raise Exception("%s is empty" % path)
+  header = json.loads(lines[0])
+  if header.get('trace') != TRACE_VERSION:
+    raise Exception("%s is not a version %d trace" % (path, TRACE_VERSION))
+  events = []
+  for line in lines[1:]:
+    try:
+      value = json.loads(line)
+    except ValueError:
+      # the last line of a trace whose recorder was killed mid write
+      continue
+    events.append(trace_event(value[0] / 1000, value[1], value[2:]))
+  return header, events
+
+# The cards of a trace as simulator.sim_cards, by uid, with the block and key they were read with
+def trace_cards(events):
+  cards = {}
+  def card(uid):
+    if uid not in cards:
+      cards[uid] = simulator.sim_card(int(uid[:8], 16), 0)
+    return cards[uid]
+  for event in events:
+    if event.kind == "card":
+      card(event.args[0])
+    elif event.kind == "data":
+      card(event.args[0]).block4 = list(bytes.fromhex(event.args[1]))
+  # a card that was read at least once has the right key, a failed
+  # authentication then only means it was pulled away during the read
+  read = {event.args[0] for event in events if event.kind == "data"}
+  for event in events:
+    if event.kind == "foreign" and event.args[0] not in read:
+      card(event.args[0]).key = [0xFF] * 6
+  return cards
+
+class replay_report:
+
+  def __init__(self):
+    self.trace_seconds = 0
+    self.replay_seconds = 0
+    self.events = collections.Counter()
+    self.recorded_relay = []
+    self.replayed_relay = []
+    self.latency = {}
+    self.lcd = {}
+
+  # time the relay spent on, from a list of (seconds, level)
+  @staticmethod
+  def on_seconds(switches, end):
+    total = 0
+    on_since = None
+    for seconds, level in switches:
+      if level and on_since is None:
+        on_since = seconds
+      elif not level and on_since is not None:
+        total += seconds - on_since
+        on_since = None
+    if on_since is not None:
+      total += end - on_since
+    return total
+
+  # largest difference between a replayed relay switch and the recorded one, None
+  # when the replay switched the relay a different number of times or to other levels
+  def relay_drift_seconds(self):
+    if [level for _, level in self.recorded_relay] != [level for _, level in self.replayed_relay]:
+      return None
+    return max((abs(replayed - recorded) for (recorded, _), (replayed, _) in zip(self.recorded_relay, self.replayed_relay)), default=0)
+
+  def to_dict(self):
+    end = self.trace_seconds
+    return {
+      'trace_seconds': self.trace_seconds,
+      'replay_seconds': self.replay_seconds,
+      'events': dict(self.events),
+      'relay': {
+        'recorded': self.recorded_relay,
+        'replayed': self.replayed_relay,
+        'recorded_on_seconds': self.on_seconds(self.recorded_relay, end),
+        'replayed_on_seconds': self.on_seconds(self.replayed_relay, end),
+        'drift_seconds': self.relay_drift_seconds(),
+      },
+      'latency_ms': self.latency,
+      'lcd': self.lcd,
+    }
+
+# Replay the trace at trace_path against a copy of database
+# Returns a replay_report, the database itself is not changed
+def replay(trace_path, database, until=None):
+  # imported here, laser_access_control imports this module to record
+  import laser_access_control
+  header, events = read_trace(trace_path)
+  report = replay_report()
+  report.trace_seconds = max((event.seconds for event in events), default=0)
+  report.events.update(event.kind for event in events)
+
+  with tempfile.TemporaryDirectory() as temp_dir:
+    replay_db = os.path.join(temp_dir, "replay.db")
+    if os.path.exists(database):
+      source = sqlite3.connect(database)
+      target = sqlite3.connect(replay_db)
+      with target:
+        source.backup(target)
+      source.close()
+      target.close()
+
+    station_hal = simulator.simulated_hal(started=header['started'])
+    clock = station_hal.clock_source
+    controller = laser_access_control.laser_access_control(station_hal, replay_db)
+    relay_pin = controller.config.relay_pin
+    report.recorded_relay = [(event.seconds, event.args[1]) for event in events
+                             if event.kind == "output" and event.args[0] == relay_pin]
+    schedule_events(station_hal, events)
+
+    replayed_relay = report.replayed_relay
+    output = station_hal.GPIO.output
+    def traced_output(pin, level):
+      output(pin, level)
+      if pin == relay_pin:
+        replayed_relay.append((clock.monotonic(), 1 if level else 0))
+    station_hal.GPIO.output = traced_output
+
+    started = time.perf_counter()
+    try:
+      simulator.run(controller, until=report.trace_seconds + REPLAY_TAIL_SECONDS if until is None else until)
+    finally:
+      report.replay_seconds = time.perf_counter() - started
+      controller.cleanup()
+
+    summary = controller.tracer.summary()
+    report.latency = {stage: {key: value if key == 'count' else value / 1e6 for key, value in summary[stage].items()}
+                      for stage in LATENCY_STAGES if stage in summary}
+    report.lcd = {'i2c_transactions': station_hal.lcd_bus.transactions,
+                  'i2c_bytes': station_hal.lcd_bus.bytes_written}
+  return report
+
+# put the events of a trace on the virtual clock of a simulated hal
+def schedule_events(station_hal, events):
+  clock = station_hal.clock_source
+  reader = station_hal.reader
+  cards = trace_cards(events)
+  for event in events:
+    if event.kind == "card":
+      clock.call_at(event.seconds - CARD_LEAD_SECONDS, reader.present, cards[event.args[0]])
+    elif event.kind == "remove":
+      clock.call_at(event.seconds - CARD_LEAD_SECONDS, reader.remove)
+    elif event.kind == "button":
+      clock.call_at(event.seconds, station_hal.GPIO.set_input, event.args[0], event.args[1])
+    elif event.kind == "key":
+      name, direction = event.args
+      clock.call_at(event.seconds, station_hal.keyboard.press if direction == "down" else station_hal.keyboard.release, name)
+
+def main():
+  parser = argparse.ArgumentParser(description="Replay a recorded station trace on the simulator")
+  parser.add_argument('trace', help="trace file recorded with %s set" % TRACE_ENVIRONMENT_VARIABLE)
+  parser.add_argument('database', help="database the station used, a copy is replayed against")
+  parser.add_argument('--until', type=float, default=None, help="seconds of the trace to replay (default: all of it)")
+  parser.add_argument('--output', default=None, help="JSON report file")
+  args = parser.parse_args()
+
+  report = replay(args.trace, args.database, args.until).to_dict()
+  relay = report['relay']
+  print("Replayed %.0f s of traffic in %.2f s" % (report['trace_seconds'], report['replay_seconds']))
+  print("Relay switches: %d recorded, %d replayed, drift %s" % (
+    len(relay['recorded']), len(relay['replayed']),
+    "n/a (switches differ)" if relay['drift_seconds'] is None else "%.3f s" % relay['drift_seconds']))
+  print("Relay on: %.1f s recorded, %.1f s replayed" % (relay['recorded_on_seconds'], relay['replayed_on_seconds']))
+  for stage, stats in report['latency_ms'].items():
+    print("  %-22s count %6d  p50 %8.3f ms  p99 %8.3f ms" % (stage, stats['count'], stats['p50'], stats['p99']))
+  print("LCD: %d I2C transactions, %d bytes" % (report['lcd']['i2c_transactions'], report['lcd']['i2c_bytes']))
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+    print("Report written to %s" % args.output)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
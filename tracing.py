@@ -0,0 +1,83 @@
+import collections
+import contextlib
+import time
+
+# Latency tracing for the tap pipeline
+#
+# Stages are timed with a monotonic nanosecond clock:
+#
+#  with controller.tracer.span("db.lookup"):
+#    row = db.get_row_from_uid(uid)
+#
+# Every span goes into a fixed size ring buffer (the most recent spans, in
+# order) and into a per-stage window of recent durations that summary()
+# turns into p50/p95/p99. Recording is a couple of deque appends, cheap
+# enough to leave on in production; send the controller SIGUSR1 to log the
+# summary.
+
+RING_BUFFER_SIZE = 4096
+SAMPLES_PER_STAGE = 1024
+PERCENTILES = (50, 95, 99)
+
+span_record = collections.namedtuple('span_record', ['stage', 'start_ns', 'duration_ns'])
+
+class tracer:
+
+  def __init__(self, clock_ns=time.monotonic_ns, capacity=RING_BUFFER_SIZE, samples_per_stage=SAMPLES_PER_STAGE):
+    self.clock_ns = clock_ns
+    self.spans = collections.deque(maxlen=capacity)
+    self.samples_per_stage = samples_per_stage
+    self._samples = {}
+    self._counts = collections.Counter()
+
+  @contextlib.contextmanager
+  def span(self, stage):
+    start_ns = self.clock_ns()
+    try:
+      yield
+    finally:
+      self.record(stage, start_ns, self.clock_ns() - start_ns)
+
+  # wrap a function so every call is recorded as a span
+  def wrap(self, stage, function):
+    def traced(*args, **kwargs):
+      with self.span(stage):
+        return function(*args, **kwargs)
+    return traced
+
+  def record(self, stage, start_ns, duration_ns):
+    self.spans.append(span_record(stage, start_ns, duration_ns))
+    samples = self._samples.get(stage)
+    if samples is None:
+      samples = self._samples[stage] = collections.deque(maxlen=self.samples_per_stage)
+    samples.append(duration_ns)
+    self._counts[stage] += 1
+
+  def stages(self):
+    return sorted(self._samples)
+
+  # {stage: {'count', 'p50', 'p95', 'p99', 'max'}} in nanoseconds,
+  # percentiles are over the last samples_per_stage spans of each stage
+  def summary(self):
+    result = {}
+    for stage, samples in self._samples.items():
+      ordered = sorted(samples)
+      stats = {'count': self._counts[stage], 'max': ordered[-1]}
+      for percentile in PERCENTILES:
+        # nearest rank
+        rank = max(0, -(-percentile * len(ordered) // 100) - 1)
+        stats['p%d' % percentile] = ordered[rank]
+      result[stage] = stats
+    return result
+
+  def format_summary(self):
+    lines = ["%-24s %8s %10s %10s %10s %10s" % ("stage (ms)", "count", "p50", "p95", "p99", "max")]
+    for stage, stats in sorted(self.summary().items()):
+      lines.append("%-24s %8d %10.3f %10.3f %10.3f %10.3f" % (
+        stage, stats['count'], stats['p50'] / 1e6, stats['p95'] / 1e6, stats['p99'] / 1e6, stats['max'] / 1e6))
+    return '\n'.join(lines)
+
+  def clear(self):
+    self.spans.clear()
+    self._samples.clear()
+    self._counts.clear()